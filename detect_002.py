@@ -4,25 +4,64 @@
 
 # v0.11
 
-import pygame, sys
-from pygame.locals import *
-pygame.init()
-windowSurfaceObj = pygame.display.set_mode((320,450),1, 24)
-pygame.display.set_caption("Review Captures" ) 
+import sys
+# --headless runs without the review window, use the control API (wildlife/control.py) instead
+# --split runs the review window in its own process, see below
+headless = "--headless" in sys.argv or "--split" in sys.argv
+if not headless:
+    import pygame
+    from pygame.locals import *
+    pygame.init()
+    windowSurfaceObj = pygame.display.set_mode((320,450),1, 24)
+    pygame.display.set_caption("Review Captures" ) 
 
 import argparse
 import cv2
-from picamera2 import MappedArray, Picamera2, Preview
-from picamera2.devices import Hailo
-from picamera2.encoders import H264Encoder
-from picamera2.outputs import CircularOutput
-from libcamera import controls
+# --replay runs on any Linux box, with stand-ins for the camera, Hailo, encoder and LED
+replaying = any(a.startswith("--replay") for a in sys.argv)
+if replaying:
+    from wildlife import replay
+    from wildlife.replay import MappedArray, Picamera2, Preview, Hailo, H264Encoder, CircularOutput, controls, LED
+else:
+    from picamera2 import MappedArray, Picamera2, Preview
+    from picamera2.devices import Hailo
+    from picamera2.encoders import H264Encoder
+    from picamera2.outputs import CircularOutput
+    from libcamera import controls
+    from gpiozero import LED
 import time
+import threading
+import atexit
+import signal
 import os
-import glob
 import datetime
-import shutil
-from gpiozero import LED
+import glob
+from wildlife import decode, pipeline
+from wildlife.remux import RemuxService
+from wildlife.mp4mux import CircularMp4Output
+from wildlife.overlay import Overlay
+from wildlife.index import CaptureIndex
+from wildlife.thumbs import ThumbCache, neighbours, from_frame
+if not headless:
+    from wildlife.ui import Panel
+from wildlife.tracker import Tracker
+from wildlife.motion import MotionGate
+from wildlife.scheduler import RateScheduler
+from wildlife.metrics import Metrics
+from wildlife.storage import StorageManager, Tier, MB
+from wildlife.offload import OffloadEngine
+from wildlife.control import Controller, MODES, serve
+from wildlife.startup import Startup, retry
+from wildlife.catalog import Catalog
+from wildlife.multicam import SharedDevice, CameraUnit
+from wildlife.policy import Policy, DetectionLog
+from wildlife.encoding import EncoderController
+from wildlife.proxy import ProxyService, ProxyPlayer
+from wildlife.snapshot import SnapshotWriter
+from wildlife.ipc import FrameRing, EventSender, Supervisor
+
+# time the startup, the slow parts of it run concurrently
+startup = Startup()
 
 # detection objects
 objects = ["cat","bear","bird","clock"]
@@ -33,14 +72,21 @@ v_height     = 1088  # video height
 v_length     = 5     # seconds, minimum video length
 pre_frames   = 5     # seconds, defines length of pre-detection buffer
 fps          = 25    # video frame rate
+bitrate      = 2000000 # bits/s, video bitrate, the starting one if adaptive_enc = 1
 mp4_fps      = 25    # mp4 frame rate
-mp4_timer    = 10    # seconds, convert h264s to mp4s after this time if no detections
+mp4_timer    = 10    # seconds, refresh review window after this time if no detections
+mp4_workers  = 1     # number of background h264 to mp4 conversions
+direct_mp4   = 1     # record straight to mp4 files in Videos, 0 = h264 in RAM then ffmpeg
 mp4_anno     = 1     # show timestamps on video, 1 = yes, 0 = no
 show_detects = 0     # show detections on video, 1 = yes, 0 = no
 led          = 21    # recording led gpio
 mode         = 1     # camera mode, 0-3 = manual,normal,short,long
 speed        = 1000  # manual shutter speed in mS
 gain         = 0     # set camera gain
+in_flight    = 2     # hailo inference requests in flight
+lores_pool   = 1     # 1 = reuse preallocated lores frames, 0 = a new array every frame
+snapshot_slots = 4   # trigger pictures that can wait to be written in the background
+queue_policy = pipeline.DROP_OLDEST # full frame queues drop oldest frame, or pipeline.BLOCK
 
 # mp4_annotation parameters
 colour    = (255, 255, 255)
@@ -53,10 +99,71 @@ thickness = 2
 sd_hour = 20
 sd_mins = 0
 auto_sd = 0  # set to 1 to shutdown at set time
+sd_usb_wait = 900 # seconds, max wait for moves to USB before the shutdown, it shuts down anyway
 
 # ram limit
 ram_limit = 150 # stops recording if ram below this
 
+# SD card retention, captures are deleted to stay inside these limits
+sd_min_free  = 500      # MB, keep at least this much free on the SD card
+sd_budget    = 0        # MB, max space for Pictures and Videos, 0 = no limit
+sd_max_days  = 0        # days to keep captures, 0 = forever
+evict_policy = "oldest" # delete "oldest" or "lowest_score" captures first
+usb_rate     = 8        # MB/s, max speed of moves to USB so the SD card isn't starved
+
+# adaptive encoder settings, bitrate (and frame rate with direct_mp4 = 1) chosen between clips
+# from the measured write speed, the space left and recent clip lengths (see wildlife/encoding.py)
+adaptive_enc = 1 # 1 = on, 0 = always bitrate and fps
+enc_ladder   = [(4000000, 25), (2000000, 25), (1200000, 20), (800000, 15)] # (bitrate, fps), best first
+
+# trigger confirmation
+confirm_frames = 0 # 0 = record on first detection, else detections needed in confirm_window frames
+confirm_window = 5 # frames, max 8
+
+# motion gate, skip inference on static scenes
+motion_gate = 1 # 1 = only run inference when there is motion, 0 = every frame
+min_infer   = 2 # seconds, run inference at least this often
+
+# adaptive inference rate, full rate while recording, stepping down when idle
+adaptive    = 1                # 1 = on, 0 = off
+rates       = (25, 10, 5, 2)   # inference rates (fps), fastest first
+rate_step   = 60               # seconds without a detection before stepping down
+rate_windows = [("22:00", "05:00", 1)] # ("HH:MM","HH:MM",max fps) time of day limits
+
+# stage timings and counters, kill -USR1 writes a snapshot to profile_file
+metrics_file = "/run/shm/wildlife.prom" # prometheus text file, "" = off
+metrics_port = 0                        # serve metrics on http://127.0.0.1:port, 0 = off
+profile_file = "/run/shm/wildlife_profile.json"
+
+# local control API, see wildlife/control.py
+api_socket = "/run/shm/wildlife.sock" # JSON over HTTP on a Unix socket, "" = off
+api_port   = 0                        # also serve on http://127.0.0.1:port, 0 = off
+
+# extra cameras sharing the Hailo (the Pi5 has 2 CSI ports), camera 0 is the one in the review window.
+# extra cameras record to Pictures and Videos with their name after the timestamp, eg 240518_061502_cam1.mp4
+extra_cameras = [] # [(camera number, video width, video height, pre-buffer seconds)], eg [(1, 1456, 1088, 5)]
+
+# event catalog, start/stop, files and detections of every recording (see wildlife/catalog.py)
+catalog_file = "wildlife/catalog.db" # relative to the home folder
+
+# trigger policy, per class thresholds, box sizes and include/exclude zones (see wildlife/policy.py)
+policy_file = "Det_Policy01.json" # if it doesn't exist the objects above trigger at --score_thresh
+detect_log  = ""                  # folder to log every frame's detections for policy dry runs, "" = off
+
+# proxy clips, small previews of each video made in the background, click the picture to play one
+proxy_clips = 1   # 1 = make them (kept next to catalog_file), 0 = off
+proxy_width = 320 # pixels wide
+proxy_fps   = 2   # frames per second kept and played
+
+# review window image cache
+thumb_mb = 32 # MB of scaled images to keep
+prefetch = 2  # captures either side of the current one to load in advance
+
+# review window in its own process (--split), fed by a --headless run (see wildlife/ipc.py and wildlife/review.py)
+ui_ring   = "wildlife_ring"             # shared memory ring of the latest trigger pictures, in /dev/shm, "" = off
+ui_slots  = 4                           # trigger pictures kept in the ring, 1.2MB each
+ui_events = "/run/shm/wildlife_ui.sock" # where trigger and status events are sent, "" = off
+
 config_file = "Det_Config01.txt"
 
 # check Det_configXX.txt exists, if not then write default values
@@ -78,17 +185,12 @@ mode  = defaults[0]
 speed = defaults[1]
 gain  = defaults[2]
 
+# review window drawing, updated once per frame with the changed areas only
+if not headless:
+    panel = Panel(windowSurfaceObj)
+
 def text(msg,cr,cg,cb,x,y,ft,bw):
-    pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(x,y,bw,20))
-    if os.path.exists ('/usr/share/fonts/truetype/freefont/FreeSerif.ttf'):
-        fontObj = pygame.font.Font('/usr/share/fonts/truetype/freefont/FreeSerif.ttf',ft)
-    else:
-        fontObj = pygame.font.Font(None,ft)
-    msgSurfaceObj = fontObj.render(msg, False, (cr,cg,cb))
-    msgRectobj = msgSurfaceObj.get_rect()
-    msgRectobj.topleft = (x,y)
-    windowSurfaceObj.blit(msgSurfaceObj, msgRectobj)
-    pygame.display.update()
+    panel.text(msg,(cr,cg,cb),x,y,ft,bw)
 
 # initialise
 Users  = []
@@ -96,282 +198,673 @@ Users.append(os.getlogin())
 user   = Users[0]
 h_user = "/home/" + os.getlogin( )
 m_user = "/media/" + os.getlogin( )
+
+# Parse command-line arguments.
+parser = argparse.ArgumentParser(description="Detection Example")
+parser.add_argument("-m", "--model", help="Path for the HEF model.",
+                    default="/usr/share/hailo-models/yolov8s_h8l.hef")
+parser.add_argument("-l", "--labels", default="/home/" + user + "/picamera2/examples/hailo/coco.txt",
+                    help="Path to a text file containing labels.")
+parser.add_argument("-s", "--score_thresh", type=float, default=0.5,
+                    help="Score threshold, must be a float between 0 and 1.")
+parser.add_argument("--replay", metavar="SOURCE",
+                    help="Replay 'synthetic' frames, a folder of images or a video file instead of using the camera.")
+parser.add_argument("--detections", help="With --replay, an .npz of recorded detections to use instead of the Hailo.")
+parser.add_argument("--headless", action="store_true", help="Run without the review and live windows.")
+parser.add_argument("--split", action="store_true",
+                    help="Run the camera (--headless) and the review window as separate processes, each restarted on its own.")
+args = parser.parse_args()
+
+# the camera and the review window each get their own interpreter, if either stops it is restarted
+# and the other carries on
+if args.split:
+    if api_socket == "":
+        parser.error("--split needs api_socket")
+    capture = [sys.executable, os.path.abspath(sys.argv[0]), "--headless"] + [a for a in sys.argv[1:] if a != "--split"]
+    review  = [sys.executable, "-m", "wildlife.review", "--api", api_socket, "--events", ui_events, "--ring", ui_ring,
+               "--pictures", h_user + '/Pictures', "--videos", h_user + '/Videos', "--media", m_user,
+               "--proxies", os.path.join(os.path.dirname(h_user + '/' + catalog_file), "proxies") if proxy_clips == 1 else "",
+               "--proxy_fps", str(proxy_fps), "--thumb_mb", str(thumb_mb), "--prefetch", str(prefetch)]
+    sys.exit(Supervisor({"capture": capture, "review": review}, cwd=os.path.dirname(os.path.abspath(__file__))).run())
+if replaying:
+    replay.setup(args.replay, args.detections)
+
+# open the camera, load the model and labels and scan the captures concurrently,
+# retrying the camera and Hailo until they are ready instead of sleeping
+def load_model():
+    return Hailo(args.model)
+
+def read_labels(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().splitlines()
+
+startup.submit("camera", retry, Picamera2)
+for num, *_ in extra_cameras:
+    startup.submit("camera%d" % num, retry, lambda num=num: Picamera2(num))
+startup.submit("hailo", retry, load_model)
+startup.submit("labels", read_labels, args.labels)
+startup.submit("index", CaptureIndex, h_user + '/Pictures', h_user + '/Videos')
+startup.submit("storage", StorageManager, [
+    Tier("ram", ["/run/shm"], evictable=False, refresh=1.0),
+    Tier("sd", [h_user + '/Pictures', h_user + '/Videos'], budget=sd_budget * MB, min_free=sd_min_free * MB,
+         max_age=sd_max_days * 86400, policy=evict_policy)])
 start_up = time.monotonic()
 startmp4 = time.monotonic()
 rec_led  = LED(led)
 rec_led.off()
 p = 0
-modes = ['manual','normal','short','long']
-pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(1,1,80,50),1)
-pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(80,1,80,50),1)
-pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(160,1,80,50),1)
-pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(240,1,80,50),1)
-pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(1,400,80,50),1)
-pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(80,400,80,50),1)
-pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(240,400,80,50),1)
-text("PREV",100,100,100,10,15,18,60)
-pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(160,400,80,50),1)
-text("NEXT",100,100,100,90,15,18,60)
-text("MODE",100,100,100,90,402,18,60)
-text(str(modes[mode]),100,100,100,95,420,18,60)
-if mode == 0:
-    text("SPEED",100,100,100,170,402,18,60)
-    text(str(speed),100,100,100,170,420,18,60)
-text("GAIN",100,100,100,250,402,18,60)
-if gain != 0:
-    text(str(gain),100,100,100,250,420,18,60)
-else:
-    text("Auto",100,100,100,250,420,18,60)
-text("Please wait...",100,100,100,10,60,18,60)
-time.sleep(10)
-text("",100,100,100,10,60,18,100)
+if not headless:
+    pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(1,1,80,50),1)
+    pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(80,1,80,50),1)
+    pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(160,1,80,50),1)
+    pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(240,1,80,50),1)
+    pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(1,400,80,50),1)
+    pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(80,400,80,50),1)
+    pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(240,400,80,50),1)
+    text("PREV",100,100,100,10,15,18,60)
+    pygame.draw.rect(windowSurfaceObj,(100,100,100),Rect(160,400,80,50),1)
+    text("NEXT",100,100,100,90,15,18,60)
+    text("MODE",100,100,100,90,402,18,60)
+    text("GAIN",100,100,100,250,402,18,60)
+    text("Please wait...",100,100,100,10,60,18,60)
+    pygame.display.update()
+
+# index of captured pictures and videos, kept up to date as files change
+index = startup.result("index")
+
+# review images, with the neighbouring captures loaded in the background
+thumbs = ThumbCache(max_bytes = thumb_mb * 1024 * 1024) if not headless else None
+
+def dropped(stem):
+    if thumbs is not None:
+        thumbs.invalidate(stem)
+
+# events and their detections, kept after the files are deleted
+os.makedirs(os.path.dirname(h_user + '/' + catalog_file), exist_ok=True)
+catalog = Catalog(h_user + '/' + catalog_file)
+
+# proxy clips, removed with their videos
+proxies = None
+if proxy_clips == 1:
+    proxies = ProxyService(os.path.join(os.path.dirname(h_user + '/' + catalog_file), "proxies"),
+                           width = proxy_width, fps = proxy_fps)
+player = ProxyPlayer(fps = proxy_fps) if not headless else None
+
+def deleted(stem):
+    dropped(stem)
+    catalog.forget_files(stem)
+    if proxies is not None:
+        proxies.remove(stem)
+
+# storage tiers, tracked as files are written, moved and deleted
+def evicted(tier, stem, paths):
+    deleted(stem)
+    index.remove(stem)
+    control.changed()
+
+storage = startup.result("storage")
+storage.on_evict = evicted
+
+# moves to USB run in the background and resume after a restart or a pulled drive
+def moved_off(src, dest):
+    stem = index.stem_of(src)
+    if src.endswith(".jpg"):
+        dropped(stem)
+        index.remove_picture(stem)
+        catalog.set_picture(stem, dest)
+    else:
+        index.remove_video(stem)
+        catalog.set_video(stem, dest)
+        if proxies is not None:
+            proxies.remove(stem)
+    storage.remove("sd", src)
+    control.changed()
+
+offload = OffloadEngine(h_user + '/.wildlife_offload.json', usb_rate * MB, on_moved=moved_off)
+
+# camera settings, deletes and moves to USB, for both the review window and the control API
+control = Controller(index, storage, offload, config_file, m_user, mode, speed, gain, on_delete=deleted,
+                     catalog=catalog)
+storage.enforce("sd")
+
+def show_capture(p):
+    player.stop()
+    image = thumbs.get(index.stem(p), index.picture(p))
+    panel.blit(image,(0,51))
+    thumbs.prefetch(neighbours(index, p, prefetch))
+
+def show_settings():
+    text(str(MODES[control.mode]),100,100,100,95,420,18,60)
+    if control.mode == 0:
+        text("SPEED",100,100,100,170,402,18,60)
+        text(str(control.speed),100,100,100,170,420,18,60)
+    else:
+        text(" ",100,100,100,170,402,18,60)
+        text(" ",100,100,100,170,420,18,60)
+    if control.gain != 0:
+        text(str(control.gain),100,100,100,250,420,18,60)
+    else:
+        text("Auto",100,100,100,250,420,18,60)
+
+def show_buttons(p):
+    if len(index) > 0:
+        if index.has_video(p):
+            text("DELETE",100,100,100,163,15,18,60)
+            text("DEL ALL",100,100,100,10,415,16,60)
+            USB_Files  = []
+            USB_Files  = (os.listdir(m_user))
+            if len(USB_Files) > 0:
+                text("  to USB",100,100,100,243,15,18,60)
+        else:
+            text("    ",100,100,100,163,15,18,70)
+            text("    ",100,100,100,243,15,18,70)
+            text("    ",100,100,100,10,415,18,70)
+    else:
+        text("    ",100,100,100,163,15,18,70)
+        text("    ",100,100,100,243,15,18,70)
+        text("    ",100,100,100,10,415,18,70)
+    if len(index) > 0:
+        msg = str(p+1) + "/" + str(len(index))
+        text(index.name(p),100,120,100,160,375,18,320)
+    else:
+        msg = str(len(index))
+    text(msg,100,120,100,10,375,18,60)
+
+if not headless:
+    show_settings()
 
 # show last captured image
-Pics = glob.glob(h_user + '/Pictures/*.jpg')
-Pics.sort()
-if len(Pics) > 0:
-    p = len(Pics) - 1
-    image = pygame.image.load(Pics[p])
-    image = pygame.transform.scale(image,(320,320))
-    windowSurfaceObj.blit(image,(0,51))
+if len(index) > 0 and not headless:
+    p = len(index) - 1
+    show_capture(p)
     text(str(p+1) + "/" + str(p+1),100,120,100,10,375,18,60)
-    pic = Pics[p].split("/")
-    pipc = h_user + '/Videos/' + pic[4][:-3] + "mp4"
-    text(str(pic[4]),100,120,100,160,375,18,320)
-    if os.path.exists(pipc):
+    text(index.name(p),100,120,100,160,375,18,320)
+    if index.has_video(p):
         text("DELETE",100,100,100,163,15,18,60)
         text("DEL ALL",100,100,100,10,415,16,60)
         USB_Files  = []
         USB_Files  = (os.listdir(m_user))
         if len(USB_Files) > 0:
             text("  to USB",100,100,100,243,15,18,60)
-    pygame.display.update()
-pygame.display.update()
-
-def extract_detections(hailo_output, w, h, class_names, threshold=0.5):
-    """Extract detections from the HailoRT-postprocess output."""
-    results = []
-    for class_id, detections in enumerate(hailo_output):
-        for detection in detections:
-            score = detection[4]
-            if score >= threshold:
-                y0, x0, y1, x1 = detection[:4]
-                bbox = (int(x0 * w), int(y0 * h), int(x1 * w), int(y1 * h))
-                results.append([class_names[class_id], bbox, score])
-    return results
-
-def draw_objects(request):
-    current_detections = detections
-    if current_detections:
-        with MappedArray(request, "main") as m:
-            for class_name, bbox, score in current_detections:
-                x0, y0, x1, y1 = bbox
-                label = f"{class_name} %{int(score * 100)}"
-                cv2.rectangle(m.array, (x0, y0), (x1, y1), (0, 255, 0, 0), 2)
-                cv2.putText(m.array, label, (x0 + 5, y0 + 15),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0, 0), 1, cv2.LINE_AA)
-
-# apply timestamp to videos
-def apply_timestamp(request):
-  global mp4_anno
-  if mp4_anno == 1:
-      timestamp = time.strftime("%Y/%m/%d %T")
-      with MappedArray(request, "main") as m:
-          lst = list(origin)
-          lst[0] += 365
-          lst[1] -= 20
-          end_point = tuple(lst)
-          cv2.rectangle(m.array, origin, end_point, (0,0,0), -1) 
-          cv2.putText(m.array, timestamp, origin, font, scale, colour, thickness)
-
-def Camera_Version():
-    global cam1
-    if os.path.exists('/run/shm/libcams.txt'):
-        os.rename('/run/shm/libcams.txt', '/run/shm/oldlibcams.txt')
-    os.system("rpicam-vid --list-cameras >> /run/shm/libcams.txt")
-    time.sleep(0.5)
-    # read libcams.txt file
-    camstxt = []
-    with open("/run/shm/libcams.txt", "r") as file:
-        line = file.readline()
-        while line:
-            camstxt.append(line.strip())
-            line = file.readline()
-    cam1 = camstxt[2][4:10]
-          
+if not headless:
+    panel.flush(full=True)
+
+def extract_detections(dets, w, h, class_names, threshold=0.5):
+    """Extract detections from the decoded HailoRT-postprocess output."""
+    return decode.labelled(decode.select(dets, threshold, strict=False), w, h, class_names)
+
+# apply timestamp and detection boxes to videos, in one pass
+overlay = Overlay(origin, font, scale, colour, thickness, timestamp = mp4_anno == 1, boxes = show_detects == 1)
+
+def annotator(overlay):
+    def annotate(request):
+        if overlay.timestamp or overlay.boxes:
+            with MappedArray(request, "main") as m:
+                overlay.draw(m.array)
+    return annotate
+
+annotate = annotator(overlay)
+
 if __name__ == "__main__":
 
-    # read coco.txt file and set detection object numbers
-    names = []
-    objts = []
-    with open('/home/' + user + '/picamera2/examples/hailo/coco.txt', "r") as file:
-       line = file.readline()
-       while line:
-          names.append(line.strip())
-          line = file.readline()
-    for x in range(0,len(objects)):
-        for y in range(0,len(names)):
-            if objects[x] == names[y]:
-                objts.append(y)
-
-    # get camera version
-    Camera_Version()
-
-    # Parse command-line arguments.
-    parser = argparse.ArgumentParser(description="Detection Example")
-    parser.add_argument("-m", "--model", help="Path for the HEF model.",
-                        default="/usr/share/hailo-models/yolov8s_h8l.hef")
-    parser.add_argument("-l", "--labels", default="/home/" + user + "/picamera2/examples/hailo/coco.txt",
-                        help="Path to a text file containing labels.")
-    parser.add_argument("-s", "--score_thresh", type=float, default=0.5,
-                        help="Score threshold, must be a float between 0 and 1.")
-    args = parser.parse_args()
+    # coco.txt labels
+    names = startup.result("labels")
+    catalog.set_classes(names)
+
+    # trigger policy, only the detection objects can trigger unless policy_file says otherwise
+    policy = Policy.load(policy_file, names, objects, args.score_thresh)
+    print("Trigger policy", policy.name)
+    detlog = DetectionLog(detect_log) if detect_log != "" else None
+    if detlog is not None:
+        # keep the last part file on exit, SIGTERM (eg from --split or systemd) exits the same way
+        atexit.register(detlog.close)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if confirm_frames > 0:
+        tracker = Tracker(confirm_frames, confirm_window)
 
     # Get the Hailo model, the input size it wants, and the size of our preview stream.
-    with Hailo(args.model) as hailo:
+    with startup.result("hailo") as hailo:
         model_h, model_w, _ = hailo.get_input_shape()
         video_w, video_h    = v_width,v_height
+        class_names = names
 
-        # Load class names from the labels file
-        with open(args.labels, 'r', encoding="utf-8") as f:
-            class_names = f.read().splitlines()
-
-        # The list of detected objects to draw.
-        detections = None
+        # with extra cameras they all share the Hailo through a round robin scheduler
+        shared = SharedDevice(hailo, in_flight) if extra_cameras else None
+        device = shared.lane("cam0") if shared is not None else hailo
 
         # Configure and start Picamera2.
-        with Picamera2() as picam2:
+        with startup.result("camera") as picam2:
+            # camera model, eg imx708 or imx708_wide
+            cam1 = picam2.camera_properties.get("Model", "")
             main  = {'size': (video_w, video_h), 'format': 'XRGB8888'}
             lores = {'size': (model_w, model_h), 'format': 'RGB888'}
-            if cam1 == "imx708":
+            if cam1.startswith("imx708"):
                 controls2 = {'FrameRate': fps,"AfMode": controls.AfModeEnum.Continuous,"AfTrigger": controls.AfTriggerEnum.Start}
             else:
                 controls2 = {'FrameRate': fps}
             config = picam2.create_preview_configuration(main, lores=lores, controls=controls2)
             picam2.configure(config)
-            encoder = H264Encoder(2000000, repeat=True)
-            encoder.output = CircularOutput(buffersize = pre_frames * fps)
-            picam2.pre_callback = apply_timestamp
-            picam2.start_preview(Preview.QTGL, x=0, y=0, width=480, height=480)
+            encoder = H264Encoder(bitrate, repeat=True)
+            if direct_mp4 == 1:
+                encoder.output = CircularMp4Output(pre_frames * fps, video_w, video_h, fps)
+            else:
+                encoder.output = CircularOutput(buffersize = pre_frames * fps)
+            picam2.pre_callback = annotate
+            if not headless:
+                picam2.start_preview(Preview.QTGL, x=0, y=0, width=480, height=480)
             picam2.start()
             picam2.title_fields = ["ExposureTime"]
             picam2.start_encoder(encoder)
             encoding = False
-            if show_detects == 1:
-                picam2.pre_callback = draw_objects
-            picam2.set_controls({"AnalogueGain": gain})
-            if mode == 0:
-                picam2.set_controls({"AeEnable": False,"ExposureTime": speed})
-            else:
-                if mode == 1:
-                    picam2.set_controls({"AeEnable": True,"AeExposureMode": controls.AeExposureModeEnum.Normal})
-                elif mode == 2:
-                    picam2.set_controls({"AeEnable": True,"AeExposureMode": controls.AeExposureModeEnum.Short})
-                elif mode == 3:
-                    picam2.set_controls({"AeEnable": True,"AeExposureMode": controls.AeExposureModeEnum.Long})
+
+            # MODE, SHUTTER SPEED and GAIN, set from the review window or the control API, on every camera
+            cameras = [picam2]
+
+            def apply_controls(mode, speed, gain):
+                for cam in cameras:
+                    if mode == 0:
+                        cam.set_controls({"AeEnable": False,"ExposureTime": speed,"AnalogueGain": gain})
+                    elif mode == 1:
+                        cam.set_controls({"AeEnable": True,"AeExposureMode": controls.AeExposureModeEnum.Normal,"AnalogueGain": gain})
+                    elif mode == 2:
+                        cam.set_controls({"AeEnable": True,"AeExposureMode": controls.AeExposureModeEnum.Short,"AnalogueGain": gain})
+                    elif mode == 3:
+                        cam.set_controls({"AeEnable": True,"AeExposureMode": controls.AeExposureModeEnum.Long,"AnalogueGain": gain})
+
+            control.camera = apply_controls
+            control.apply()
             
+            # extra cameras, started below
+            units = []
+
+            def recording():
+                """Stems of the captures being recorded, by any camera."""
+                stems = {os.path.basename(u.clip).split(".")[0] for u in units if u.encoding}
+                if encoding:
+                    stems.add(str(timestamp))
+                return stems
+
+            # convert h264s to mp4s in the background, including any left from a previous run
+            def clip_done(mp4):
+                index.add_video(mp4)
+                storage.add("sd", mp4)
+                catalog.set_video(index.stem_of(mp4), mp4)
+                if proxies is not None:
+                    proxies.submit(mp4)
+                # make room for the next clip, keeping this one and those still being recorded
+                storage.enforce("sd", need = (v_length + pre_frames) * encoder.bitrate // 8 * 2,
+                                keep = recording() | {index.stem_of(mp4)})
+
+            # direct mp4 clips are renamed once the writer thread has closed them
+            def mp4_closed(part):
+                os.replace(part, part[:-5])
+                clip_done(part[:-5])
+
+            if direct_mp4 == 1:
+                encoder.output.on_closed = mp4_closed
+
+            remux = RemuxService(h_user + '/Videos', '/run/shm/remux_jobs.json', mp4_workers, framerate=mp4_fps,
+                                 on_done=clip_done)
+            remux.scan('/run/shm/2*.h264')
+
+            # fragmented mp4s cut short by a power cut are playable up to the last whole GOP
+            for part in glob.glob(h_user + '/Videos/2*.mp4.part'):
+                os.replace(part, part[:-5])
+                clip_done(part[:-5])
+
+            # proxies for videos that don't have one yet, and none for videos that have gone
+            if proxies is not None:
+                proxies.scan(glob.glob(h_user + '/Videos/2*.mp4'))
+
+            # bitrate and frame rate for the next clip, from what the last ones took to write
+            enc_ctl = EncoderController(enc_ladder, v_length + pre_frames, start=bitrate) if adaptive_enc == 1 else None
+            enc_written = [0, 0.0]
+            enc_fps = fps
+
+            def adapt_encoder():
+                global enc_fps
+                if direct_mp4 == 1:
+                    # clips are written straight to the SD card
+                    written, seconds = encoder.output.written, encoder.output.write_seconds
+                    free = storage.free("sd")
+                else:
+                    # clips are staged in /run/shm, recording stops below ram_limit
+                    rs = remux.status()
+                    written, seconds = rs["moved"], rs["move_seconds"]
+                    free = (storage.free_mb("ram") - ram_limit) * MB
+                enc_ctl.wrote(written - enc_written[0], seconds - enc_written[1])
+                enc_written[:] = [written, seconds]
+                new_bitrate, new_fps = enc_ctl.choose(free)
+                if new_bitrate != encoder.bitrate:
+                    # the bitrate is set when the encoder starts, the pre-buffer carries on across.
+                    # the restart is in the detection loop, so only when the bitrate changes
+                    encoder.output.fileoutput = None
+                    picam2.stop_encoder(encoder)
+                    encoder.bitrate = new_bitrate
+                    picam2.start_encoder(encoder)
+                # a lower frame rate skips frames in the encoder, the camera, lores stream and inference
+                # stay at fps.  Only direct mp4 clips, .h264 clips are remuxed at mp4_fps, and only with a
+                # picamera2 that can skip frames
+                if direct_mp4 == 1 and hasattr(encoder, "frame_skip_count"):
+                    skip = max(round(fps / min(new_fps, fps)), 1)
+                    if skip != encoder.frame_skip_count:
+                        encoder.frame_skip_count = skip
+                        # the pre-buffer counts frames, keep it at pre_frames seconds
+                        encoder.output.resize(pre_frames * fps // skip)
+                    enc_fps = fps / skip
+                print("Encoder", enc_ctl.status(), "clip fps %g" % enc_fps)
+
+            if enc_ctl is not None:
+                adapt_encoder()
+
+            # trigger pictures are JPEG encoded and written in the background
+            snapshots = SnapshotWriter(snapshot_slots)
+
+            # extra cameras have no thumbnail from the frame, their pictures are listed once they are on disk.
+            # the main camera's is listed at the trigger, and taken out again if it couldn't be written
+            def picture_written(score, add_to_index=False):
+                def done(path, ok):
+                    if ok:
+                        storage.add("sd", path, score)
+                        if add_to_index:
+                            index.add_picture(path)
+                    elif not add_to_index:
+                        stem = index.stem_of(path)
+                        index.remove_picture(stem)
+                        dropped(stem)
+                        control.changed()
+                return done
+
+            # trigger pictures and status for a review window in another process, sent without waiting for it
+            ring   = FrameRing(ui_ring, (model_h, model_w, 3), ui_slots) if headless and ui_ring != "" else None
+            events = EventSender(ui_events) if headless and ui_events != "" else None
+            status_sent = 0.0
+
+            def publish(stem, pic, frame):
+                n = ring.put(frame, {"stem": stem}) if ring is not None else 0
+                if events is not None:
+                    events.send("trigger", stem=stem, picture=pic, n=n)
+
+            def ui_status():
+                rs = remux.status()
+                op = offload.progress()
+                return {"recording": encoding or any(u.encoding for u in units), "version": control.version,
+                        "captures": len(index), "videos": len(index.vids), "mp4": rs["pending"] + rs["running"],
+                        "usb_error": op["error"], "usb_left": op["files_left"]}
+
+            # capture and run inference on low resolution frames in background threads
+            gate = MotionGate(min_interval = min_infer) if motion_gate == 1 else None
+            sched = RateScheduler(rates, rate_step, rate_windows) if adaptive == 1 else None
+
+            def infer_gate(frame):
+                if sched is not None and not sched.due(encoding):
+                    return False
+                if gate is not None and not gate(frame):
+                    return False
+                # only a frame that is inferred uses up the scheduler's slot
+                if sched is not None:
+                    sched.ran()
+                return True
+
+            pipe = pipeline.Pipeline(picam2, device, 'lores', in_flight, pool=lores_pool == 1, mapped=MappedArray,
+                                     capture_policy=queue_policy, result_policy=queue_policy, gate=infer_gate).start()
+
+            # instrumentation
+            metrics = Metrics().start(metrics_file, metrics_port, profile_path=profile_file)
+            metrics.collect(pipe.stats)
+            lap = metrics.lap()
+
+            # recordings in progress on any camera, the extra ones start and stop in their own threads.
+            # conversions and proxies are held and the LED lit from the first start to the last stop
+            recordings = 0
+            rec_lock = threading.Lock()
+
+            def recording_started():
+                global recordings
+                with rec_lock:
+                    recordings += 1
+                    if recordings == 1:
+                        rec_led.on()
+                        remux.hold()
+                        if proxies is not None:
+                            proxies.hold()
+
+            def recording_stopped():
+                global recordings
+                with rec_lock:
+                    recordings = max(recordings - 1, 0)
+                    if recordings == 0:
+                        rec_led.off()
+                        remux.release()
+                        if proxies is not None:
+                            proxies.release()
+
+            # extra cameras, each with its own pipeline, trigger state and recording in a thread
+            def start_clip(unit, frame, hit):
+                stem = datetime.datetime.now().strftime("%y%m%d_%H%M%S") + "_" + unit.unit
+                pic = h_user + "/Pictures/" + stem + ".jpg"
+                snapshots.write(pic, frame, picture_written(float(hit["score"]), add_to_index=True))
+                publish(stem, pic, frame)
+                catalog.begin(stem, time.time(), pic, int(hit["class_id"]), float(hit["score"]))
+                metrics.inc("triggers")
+                print("New  Detection", stem, names[hit["class_id"]])
+                recording_started()
+                if direct_mp4 == 1:
+                    return h_user + "/Videos/" + stem + ".mp4.part"
+                return "/run/shm/" + stem + ".h264"
+
+            def stop_clip(unit, path):
+                print("Stopped Record", unit.unit, datetime.datetime.now().strftime("%y%m%d_%H%M%S"))
+                catalog.end(os.path.basename(path).split(".")[0], time.time())
+                if direct_mp4 == 0:
+                    remux.submit(path)
+                metrics.inc("clips")
+                recording_stopped()
+
+            def unit_frame(unit, item, dets):
+                if unit.encoding and item.results is not None:
+                    catalog.detections(os.path.basename(unit.clip).split(".")[0], item.seq, time.time(),
+                                       decode.select(dets, args.score_thresh, strict=False))
+
+            for num, w, h, pre in extra_cameras:
+                cam = startup.result("camera%d" % num)
+                cam.configure(cam.create_preview_configuration({'size': (w, h), 'format': 'XRGB8888'},
+                                                               lores=lores, controls={'FrameRate': fps}))
+                enc = H264Encoder(bitrate, repeat=True)
+                if direct_mp4 == 1:
+                    enc.output = CircularMp4Output(pre * fps, w, h, fps, on_closed=mp4_closed)
+                else:
+                    enc.output = CircularOutput(buffersize = pre * fps)
+                cam.pre_callback = annotator(Overlay((10, h - 50), font, scale, colour, thickness, timestamp = mp4_anno == 1))
+                cam.start()
+                cam.start_encoder(enc)
+                cameras.append(cam)
+                units.append(CameraUnit("cam%d" % num, cam, shared.lane("cam%d" % num), enc.output, policy.apply, v_length,
+                                        gate = MotionGate(min_interval = min_infer) if motion_gate == 1 else None,
+                                        tracker = Tracker(confirm_frames, confirm_window) if confirm_frames > 0 else None,
+                                        start_clip=start_clip, stop_clip=stop_clip, on_frame=unit_frame,
+                                        pool = lores_pool == 1, mapped = MappedArray))
+            control.apply()
+            for unit in units:
+                unit.start()
+            if shared is not None:
+                metrics.collect(lambda: {"fps_" + name: s["fps"] for name, s in shared.stats().items() if name != "duty"})
+
+            # local control API
+            control.collect(lambda: {"recording": encoding, "pipeline": pipe.stats(), "remux": remux.status(),
+                                     "sd_free_mb": storage.free_mb("sd"), "ram_free_mb": storage.free_mb("ram"),
+                                     "cameras": {u.unit: u.stats() for u in units},
+                                     "hailo": shared.stats() if shared is not None else None,
+                                     "proxies": proxies.status() if proxies is not None else None,
+                                     "snapshots": snapshots.stats(),
+                                     "ui_events": events.stats() if events is not None else None,
+                                     "encoder": dict(enc_ctl.status(), clip_fps=enc_fps) if enc_ctl is not None else {"bitrate": bitrate, "fps": fps}})
+            serve(control, api_socket, api_port)
+            shown = control.version
+
+            # recording again, report how long that took
+            startup.mark("recording")
+            metrics.gauge("startup_seconds", startup.report()["total"])
+            if not headless and len(index) == 0:
+                text("",100,100,100,10,60,18,100)
+
             # Process each low resolution camera frame.
             while True:
                 # get free ram space
-                st = os.statvfs("/run/shm/")
-                freeram = (st.f_bavail * st.f_frsize)/1100000
+                freeram = storage.free_mb("ram")
+                lap("storage")
                 
-                # capture frame
-                frame = picam2.capture_array('lores')
-
-                # Run inference on the preprocessed frame
-                results = hailo.run(frame)
+                # get next frame and its inference results
+                item = pipe.get()
+                frame = item.frame
+                results = item.results
+                lap("wait_frame")
+                metrics.inc("frames")
+                if results is not None:
+                    metrics.inc("inferences")
                 
+                # decode all detections in one pass, results is None if the motion gate skipped the frame
+                if results is not None:
+                    dets = decode.decode(results[0])
+                else:
+                    dets = decode.EMPTY
+
                 # Extract detections from the inference results
                 if show_detects == 1:
-                    detections = extract_detections(results[0], video_w, video_h, class_names, args.score_thresh)
+                    overlay.detections = extract_detections(dets, video_w, video_h, class_names, args.score_thresh)
+                lap("decode")
+
+                if detlog is not None:
+                    detlog.add(dets, datetime.datetime.now().strftime("%y%m%d_%H%M%S"))
 
                 # detection
-                for d in range(0,len(objts)):
-                    if len(results[0][objts[d]]) != 0:
-                        out1 = str(results[0][objts[d]])[2:-2].split(" ")
-                        out1 = [x for x in out1 if x != '']
-                        value = float(out1[4][0:5])
-                        if value > args.score_thresh and value < 1:
-                            startrec = time.monotonic()
-                            startmp4 = time.monotonic()
-                            # start recording
-                            if not encoding and freeram > ram_limit:
-                                now = datetime.datetime.now()
-                                timestamp = now.strftime("%y%m%d_%H%M%S")
-                                encoder.output.fileoutput = "/run/shm/" + str(timestamp) + '.h264'
-                                encoder.output.start()
-                                encoding = True
-                                print("New  Detection",timestamp,names[objts[d]])
-                                rec_led.on()
-                                # save lores image
-                                cv2.imwrite(h_user + "/Pictures/" + str(timestamp) + ".jpg",frame)
-                                # show captured lores trigger image
-                                Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                Pics.sort()
-                                p = len(Pics)-1
-                                img = cv2.cvtColor(frame,cv2.COLOR_RGB2BGR)
-                                image = pygame.surfarray.make_surface(img)
-                                image = pygame.transform.scale(image,(320,320))
-                                image = pygame.transform.rotate(image,int(90))
-                                image = pygame.transform.flip(image,0,1)
-                                windowSurfaceObj.blit(image,(0,51))
-                                text(str(p+1) + "/" + str(p+1),100,120,100,10,375,18,60)
-                                #pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,371,320,20))
-                                pic = Pics[p].split("/")
-                                text(str(pic[4]),100,120,100,160,375,18,320)
-                                text("    ",100,100,100,163,15,18,70)
-                                text("    ",100,100,100,243,15,18,70)
-                                pygame.display.update()
+                hits = policy.apply(dets)
+                hits = hits[hits["score"] < 1]
+                hit = decode.best(hits)
+                if sched is not None and results is not None:
+                    sched.record(hit is not None)
+                triggered = hit is not None
+                if confirm_frames > 0:
+                    # only confirmed tracks trigger, and keep recording while one is in view,
+                    # frames the motion gate or scheduler skipped aren't misses
+                    if results is not None:
+                        triggered = len(tracker.update(hits)) > 0 or tracker.active()
+                    else:
+                        triggered = tracker.active()
+                if triggered:
+                    startrec = time.monotonic()
+                    startmp4 = time.monotonic()
+                    # start recording
+                    if not encoding and freeram > ram_limit and hit is not None:
+                        now = datetime.datetime.now()
+                        timestamp = now.strftime("%y%m%d_%H%M%S")
+                        if direct_mp4 == 1:
+                            h264_file = h_user + "/Videos/" + str(timestamp) + '.mp4.part'
+                        else:
+                            h264_file = "/run/shm/" + str(timestamp) + '.h264'
+                        encoder.output.fileoutput = h264_file
+                        encoder.output.start()
+                        encoding = True
+                        recstart = time.monotonic()
+                        recording_started()
+                        metrics.inc("triggers")
+                        print("New  Detection",timestamp,names[hit["class_id"]])
+                        # save lores image, in the background
+                        index.add_picture(h_user + "/Pictures/" + str(timestamp) + ".jpg")
+                        snapshots.write(h_user + "/Pictures/" + str(timestamp) + ".jpg", frame, picture_written(float(hit["score"])))
+                        publish(str(timestamp), h_user + "/Pictures/" + str(timestamp) + ".jpg", frame)
+                        catalog.begin(str(timestamp), time.time(), h_user + "/Pictures/" + str(timestamp) + ".jpg",
+                                      int(hit["class_id"]), float(hit["score"]))
+                        # show captured lores trigger image
+                        p = len(index)-1
+                        if not headless:
+                            player.stop()
+                            image = from_frame(frame, (320,320))
+                            thumbs.put(str(timestamp), image)
+                            panel.blit(image,(0,51))
+                            text(str(p+1) + "/" + str(p+1),100,120,100,10,375,18,60)
+                            #pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,371,320,20))
+                            text(index.name(p),100,120,100,160,375,18,320)
+                            text("    ",100,100,100,163,15,18,70)
+                            text("    ",100,100,100,243,15,18,70)
+
+                # record everything seen while recording
+                if encoding and results is not None:
+                    catalog.detections(str(timestamp), item.seq, time.time(), decode.select(dets, args.score_thresh, strict=False))
+
+                lap("trigger")
+
+                # run inference on every frame while recording
+                if gate is not None:
+                    gate.force = encoding
 
                 # stop recording
                 if encoding and (time.monotonic() - startrec > v_length or freeram <= ram_limit):
                     now = datetime.datetime.now()
                     timestamp2 = now.strftime("%y%m%d_%H%M%S")
                     print("Stopped Record", timestamp2)
+                    ps = pipe.stats()
+                    print("Pipeline fps %.1f, dropped frames %d, skipped inferences %d" % (ps["fps"], ps["dropped_capture"] + ps["dropped_results"], ps["skipped"]))
+                    if sched is not None:
+                        print("Inference rate", sched.status())
+                    if shared is not None:
+                        print("Camera fps", ", ".join("%s %.1f" % (name, s["fps"]) for name, s in shared.stats().items() if name != "duty"))
                     encoder.output.stop()
                     encoding = False
+                    catalog.end(str(timestamp), time.time())
+                    if direct_mp4 == 0:
+                        remux.submit(h264_file)
+                    if enc_ctl is not None:
+                        enc_ctl.clip_done(time.monotonic() - recstart + pre_frames)
+                        adapt_encoder()
                     startmp4 = time.monotonic()
-                    rec_led.off()
+                    recording_stopped()
+                    metrics.inc("clips")
+                lap("record")
+
+                # status for a review window in another process, once a second
+                if events is not None and time.monotonic() - status_sent > 1:
+                    status_sent = time.monotonic()
+                    events.send("status", **ui_status())
 
-                # make mp4s
+                # refresh review window
                 if time.monotonic() - startmp4 > mp4_timer and not encoding:
                     startmp4 = time.monotonic()
-                    # convert h264 to mp4
-                    h264s = glob.glob('/run/shm/2*.h264')
-                    h264s.sort(reverse = False)
-                    for x in range(0,len(h264s)):
-                        print(h264s[x][:-5] + '.mp4')
-                        cmd = 'ffmpeg -framerate ' + str(mp4_fps) + ' -i ' + h264s[x] + " -c copy " + h264s[x][:-5] + '.mp4'
-                        os.system(cmd)
-                        os.remove(h264s[x])
-                        print("Saved",h264s[x][:-5] + '.mp4')
-                    Videos = glob.glob('/run/shm/*.mp4')
-                    Videos.sort()
-                    # move Video RAM mp4s to SD card
-                    for xx in range(0,len(Videos)):
-                        if not os.path.exists(h_user + "/" + '/Videos/' + Videos[xx]):
-                            shutil.move(Videos[xx], h_user + '/Videos/')
-                    Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                    Pics.sort()
-                    if len(Pics) > 0:
-                      pic = Pics[p].split("/")
-                      pipc = h_user + '/Videos/' + pic[4][:-3] + "mp4"
-                      if os.path.exists(pipc):
-                        text("DELETE",100,100,100,163,15,18,60)
-                        text("DEL ALL",100,100,100,10,415,16,60)
-                        USB_Files  = []
-                        USB_Files  = (os.listdir(m_user))
-                        if len(USB_Files) > 0:
-                            text("  to USB",100,100,100,243,15,18,60)
-                      else:
-                        text("    ",100,100,100,163,15,18,70)
-                        text("    ",100,100,100,243,15,18,70)
-                        text("    ",100,100,100,10,415,18,70)
-                    else:
-                        text("    ",100,100,100,163,15,18,70)
-                        text("    ",100,100,100,243,15,18,70)
-                        text("    ",100,100,100,10,415,18,70)
+                    # captures may have been evicted to free space
+                    if p > len(index) - 1:
+                        p = max(len(index) - 1, 0)
+                    if not headless:
+                        # show conversion and USB move status
+                        rs = remux.status()
+                        if rs["pending"] + rs["running"] > 0:
+                            text("mp4 " + str(rs["pending"] + rs["running"]),100,100,100,80,375,18,75)
+                        else:
+                            text("    ",100,100,100,80,375,18,75)
+                        op = offload.progress()
+                        if op["error"] is not None:
+                            text("USB error",150,50,50,243,30,14,70)
+                        elif op["files_left"] > 0:
+                            text(str(op["files_left"]) + " to move",100,100,100,243,30,14,70)
+                        else:
+                            text("    ",100,100,100,243,30,14,70)
+                        if len(index) > 0:
+                          if index.has_video(p):
+                            text("DELETE",100,100,100,163,15,18,60)
+                            text("DEL ALL",100,100,100,10,415,16,60)
+                            USB_Files  = []
+                            USB_Files  = (os.listdir(m_user))
+                            if len(USB_Files) > 0:
+                                text("  to USB",100,100,100,243,15,18,60)
+                          else:
+                            text("    ",100,100,100,163,15,18,70)
+                            text("    ",100,100,100,243,15,18,70)
+                            text("    ",100,100,100,10,415,18,70)
+                        else:
+                            text("    ",100,100,100,163,15,18,70)
+                            text("    ",100,100,100,243,15,18,70)
+                            text("    ",100,100,100,10,415,18,70)
+
+                    lap("refresh")
 
                     # auto shutdown
                     if auto_sd == 1:
@@ -383,234 +876,135 @@ if __name__ == "__main__":
                         # check current hour and shutdown
                         now = datetime.datetime.now()
                         sd_time = now.replace(hour=sd_hour, minute=sd_mins, second=0, microsecond=0)
-                        if now >= sd_time and time.monotonic() - startup > 300 and synced == 1:
+                        if now >= sd_time and time.monotonic() - start_up > 300 and synced == 1:
                             # move jpgs and mp4s to USB if present
-                            time.sleep(2 * mp4_timer)
-                            USB_Files  = []
-                            USB_Files  = (os.listdir(m_user))
-                            if len(USB_Files) > 0:
-                                usedusb = os.statvfs(m_user + "/" + USB_Files[0] + "/")
-                                USB_storage = ((1 - (usedusb.f_bavail / usedusb.f_blocks)) * 100)
-                            if len(USB_Files) > 0 and USB_storage < 90:
-                                Videos = glob.glob(h_user + '/Videos/*.mp4')
-                                Videos.sort()
-                                for xx in range(0,len(Videos)):
-                                    movi = Videos[xx].split("/")
-                                    if not os.path.exists(m_user + "/" + USB_Files[0] + "/Videos/" + movi[4]):
-                                        shutil.move(Videos[xx],m_user + "/" + USB_Files[0] + "/Videos/")
-                                Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                Pics.sort()
-                                for xx in range(0,len(Pics)):
-                                    pic = Pics[xx].split("/")
-                                    if not os.path.exists(m_user + "/" + USB_Files[0] + "/Pictures/" + pic[4]):
-                                        shutil.move(Pics[xx],m_user + "/" + USB_Files[0] + "/Pictures/")
+                            remux.wait(2 * mp4_timer)
+                            snapshots.wait()
+                            if direct_mp4 == 1:
+                                for output in [encoder.output] + [u.output for u in units]:
+                                    output.wait()
+                            try:
+                                control.offload()
+                                if not offload.wait(sd_usb_wait):
+                                    print("USB moves not finished, shutting down anyway", offload.progress())
+                            except OSError as e:
+                                print("USB", e)
+                            if detlog is not None:
+                                detlog.close()
                             time.sleep(5)
                             # shutdown
                             os.system("sudo shutdown -h now")
 
+                if headless:
+                    continue
+
+                # redraw after changes, including those made through the control API and captures evicted or
+                # moved to USB in the background, before a click can use a position that has gone
+                if control.version != shown:
+                    shown = control.version
+                    show_settings()
+                    if p > len(index) - 1:
+                        p = max(len(index) - 1, 0)
+                    if len(index) > 0:
+                        show_capture(p)
+                    else:
+                        panel.rect((0,0,0),Rect(0,51,320,344))
+                    show_buttons(p)
+
                 #check for any mouse button presses
                 for event in pygame.event.get():
                     if (event.type == MOUSEBUTTONUP):
                         mousex, mousey = event.pos
                         # delete ALL Pictures and Videos
                         if mousex < 80 and mousey > 400 and event.button == 3:
-                            Videos = glob.glob(h_user + '/Videos/*.mp4')
-                            Videos.sort()
-                            for w in range(0,len(Videos)):
-                                os.remove(Videos[w])
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
-                            for w in range(0,len(Pics)):
-                                os.remove(Pics[w])
-                            pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,371,320,28))
-                            pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,51,320,320))
+                            control.delete_all()
+                            thumbs.clear()
+                            panel.rect((0,0,0),Rect(0,371,320,28))
+                            panel.rect((0,0,0),Rect(0,51,320,320))
                             p = 0
                         # camera control
                         # MODE
                         if mousex > 80 and mousex < 160 and mousey > 400:
                             if event.button == 3 or event.button == 5:
-                                mode -=1
-                                if mode < 0:
-                                    mode = 3
-                            else:
-                                mode +=1
-                                if mode > 3:
-                                    mode = 0
-                            text(str(modes[mode]),100,100,100,95,420,18,60)
-                            if mode == 0:
-                                picam2.set_controls({"AeEnable": False,"ExposureTime": speed,"AnalogueGain": gain})
-                                text("SPEED",100,100,100,170,402,18,60)
-                                text(str(speed),100,100,100,170,420,18,60)
+                                control.set(mode = (control.mode - 1) % 4)
                             else:
-                                if mode == 1:
-                                    picam2.set_controls({"AeEnable": True,"AeExposureMode": controls.AeExposureModeEnum.Normal,"AnalogueGain": gain})
-                                elif mode == 2:
-                                    picam2.set_controls({"AeEnable": True,"AeExposureMode": controls.AeExposureModeEnum.Short,"AnalogueGain": gain})
-                                elif mode == 3:
-                                    picam2.set_controls({"AeEnable": True,"AeExposureMode": controls.AeExposureModeEnum.Long,"AnalogueGain": gain})
-                                text(" ",100,100,100,170,402,18,60)
-                                text(" ",100,100,100,170,420,18,60)
+                                control.set(mode = (control.mode + 1) % 4)
                         # SHUTTER SPEED
-                        if mousex > 160 and mousex < 240 and mousey > 400 and mode == 0:
+                        if mousex > 160 and mousex < 240 and mousey > 400 and control.mode == 0:
                             if event.button == 3 or event.button == 5:
-                                speed -=1000
-                                speed = max(1000,speed)
+                                control.set(speed = max(1000,control.speed - 1000))
                             else:
-                                speed += 1000
-                                speed = min(100000,speed)
-                            picam2.set_controls({"AeEnable": False,"ExposureTime": speed,"AnalogueGain": gain})
-                            text("SPEED",100,100,100,170,402,18,60)
-                            text(str(speed),100,100,100,170,420,18,60)
+                                control.set(speed = min(100000,control.speed + 1000))
                         # GAIN
                         if mousex > 240 and mousey > 400:
                             if event.button == 3 or event.button == 5:
-                                gain -=1
-                                gain = max(0,gain)
+                                control.set(gain = max(0,control.gain - 1))
                             else:
-                                gain +=1
-                                gain = min(64,gain)
-                            picam2.set_controls({"AnalogueGain": gain})
-                            text("GAIN",100,100,100,250,402,18,60)
-                            if gain != 0:
-                                text(str(gain),100,100,100,250,420,18,60)
-                            else:
-                                text("Auto",100,100,100,250,420,18,60)
+                                control.set(gain = min(64,control.gain + 1))
                             
                         # show previous
                         elif mousex < 80 and mousey < 50:
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
                             p -= 1
                             if p < 0:
                                 p = 0
-                            if len(Pics) > 0:
-                                image = pygame.image.load(Pics[p])
-                                image = pygame.transform.scale(image,(320,320))
-                                windowSurfaceObj.blit(image,(0,51))
+                            if len(index) > 0:
+                                show_capture(p)
                                 text(str(p+1) + "/" + str(p+1),100,120,100,10,375,18,60)
-                                pic = Pics[p].split("/")
-                                text(str(pic[4]),100,120,100,160,375,18,320)
-                                pygame.display.update()
+                                text(index.name(p),100,120,100,160,375,18,320)
                         # show next
                         elif mousex > 80 and mousex < 160 and mousey < 50:
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
                             p += 1
-                            if p > len(Pics)-1:
-                                p = len(Pics)-1
-                            if len(Pics) > 0:
-                                image = pygame.image.load(Pics[p])
-                                image = pygame.transform.scale(image,(320,320))
-                                windowSurfaceObj.blit(image,(0,51))
-                                pic = Pics[p].split("/")
-                                text(str(pic[4]),100,120,100,160,375,18,320)
+                            if p > len(index)-1:
+                                p = len(index)-1
+                            if len(index) > 0:
+                                show_capture(p)
+                                text(index.name(p),100,120,100,160,375,18,320)
                                 text(str(p+1) + "/" + str(p+1),100,120,100,10,375,18,60)
-                                pygame.display.update()
                         # delete picture and video
                         elif mousex > 160 and mousex < 240 and mousey < 50 and event.button == 3:
-                            pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,51,320,320))
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
-                            Videos = glob.glob(h_user + '/Videos/*.mp4')
-                            Videos.sort()
-                            if len(Pics) > 0:
-                                pic = Pics[p].split("/")
-                                pipc = h_user + '/Videos/' + pic[4][:-3] + "mp4"
-                                if os.path.exists(pipc):
-                                   os.remove(Pics[p])
-                                   if len(Videos) > 0:
-                                       os.remove(pipc)
-                                       print("DELETED", pipc)
-                                Videos = glob.glob(h_user + '/Videos/*.mp4')
-                                Videos.sort()
-                                Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                Pics.sort()
-                            if p > len(Pics) - 1:
+                            panel.rect((0,0,0),Rect(0,51,320,320))
+                            if len(index) > 0:
+                                if index.has_video(p):
+                                   control.delete(index.stem(p))
+                            if p > len(index) - 1:
                                 p -= 1
-                            if len(Pics) > 0:
-                                image = pygame.image.load(Pics[p])
-                                image = pygame.transform.scale(image,(320,320))
-                                windowSurfaceObj.blit(image,(0,51))
-                                pic = Pics[p].split("/")
-                                text(str(pic[4]),100,120,100,160,375,18,320)
+                            if len(index) > 0:
+                                show_capture(p)
+                                text(index.name(p),100,120,100,160,375,18,320)
                             else:
-                                pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,375,320,20))
-                            pygame.display.update()
+                                panel.rect((0,0,0),Rect(0,375,320,20))
                         # move picture and video to USB
                         elif mousex > 240 and mousey < 50:
-                            pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,51,320,320))
-                            Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                            Pics.sort()
-                            Videos = glob.glob(h_user + '/Videos/*.mp4')
-                            Videos.sort()
-                            if len(Pics) > 0:
-                                pic = Pics[p].split("/")
-                                pipc = h_user + '/Videos/' + pic[4][:-3] + "mp4"
-                                # move mp4s to USB if present
-                                USB_Files  = []
-                                USB_Files  = (os.listdir(m_user))
-                                if len(USB_Files) > 0:
-                                    usedusb = os.statvfs(m_user + "/" + USB_Files[0] + "/")
-                                    USB_storage = ((1 - (usedusb.f_bavail / usedusb.f_blocks)) * 100)
-                                if len(USB_Files) > 0 and USB_storage < 90 and os.path.exists(pipc):
-                                    if not os.path.exists(m_user + "/" + USB_Files[0] + "/Pictures/" + pic[4]):
-                                        shutil.move(Pics[p],m_user + "/" + USB_Files[0] + "/Pictures/")
-                                    if os.path.exists(pipc):
-                                        vid = pipc.split("/")
-                                        if not os.path.exists(m_user + "/" + USB_Files[0] + "/Videos/" + vid[4]):
-                                            shutil.move(Videos[p],m_user + "/" + USB_Files[0] + "/Videos/")
-                                Videos = glob.glob(h_user + '/Videos/*.mp4')
-                                Videos.sort()
-                                Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                                Pics.sort()
-                            if p > len(Pics) - 1:
+                            panel.rect((0,0,0),Rect(0,51,320,320))
+                            if len(index) > 0 and index.has_video(p):
+                                try:
+                                    control.offload([index.stem(p)])
+                                except OSError as e:
+                                    print("USB", e)
+                            if p > len(index) - 1:
                                 p -= 1
-                            if len(Pics) > 0:
-                                image = pygame.image.load(Pics[p])
-                                image = pygame.transform.scale(image,(320,320))
-                                windowSurfaceObj.blit(image,(0,51))
-                                pic = Pics[p].split("/")
-                                text(str(pic[4]),100,120,100,160,375,18,320)
-                            else:
-                                pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,375,320,20))
-                            pygame.display.update()
-                        Videos = glob.glob(h_user + '/Videos/*.mp4')
-                        Videos.sort()
-                        Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                        Pics.sort()
-                        Pics = glob.glob(h_user + '/Pictures/*.jpg')
-                        Pics.sort()
-                        if len(Pics) > 0:
-                            pic = Pics[p].split("/")
-                            pipc = h_user + '/Videos/' + pic[4][:-3] + "mp4"
-                            if os.path.exists(pipc):
-                                text("DELETE",100,100,100,163,15,18,60)
-                                text("DEL ALL",100,100,100,10,415,16,60)
-                                USB_Files  = []
-                                USB_Files  = (os.listdir(m_user))
-                                if len(USB_Files) > 0:
-                                    text("  to USB",100,100,100,243,15,18,60)
+                            if len(index) > 0:
+                                show_capture(p)
+                                text(index.name(p),100,120,100,160,375,18,320)
                             else:
-                                text("    ",100,100,100,163,15,18,70)
-                                text("    ",100,100,100,243,15,18,70)
-                                text("    ",100,100,100,10,415,18,70)
-                        else:
-                            text("    ",100,100,100,163,15,18,70)
-                            text("    ",100,100,100,243,15,18,70)
-                            text("    ",100,100,100,10,415,18,70)
-
-                        if len(Pics) > 0:
-                            msg = str(p+1) + "/" + str(len(Pics))
-                            pic = Pics[p].split("/")
-                            text(str(pic[4]),100,120,100,160,375,18,320)
-                        else:
-                            msg = str(len(Pics))
-                        text(msg,100,120,100,10,375,18,60)
-                        pygame.display.update()
-
-                        defaults[0] = mode
-                        defaults[1] = speed
-                        defaults[2] = gain
-                        with open(config_file, 'w') as f:
-                            for item in defaults:
-                                f.write("%s\n" % item)
+                                panel.rect((0,0,0),Rect(0,375,320,20))
+                        # play the proxy clip of the capture, click again to stop
+                        elif mousey > 50 and mousey < 371 and len(index) > 0:
+                            if player.playing:
+                                show_capture(p)
+                            elif proxies is not None and proxies.get(index.stem(p)) is not None:
+                                if player.start(index.stem(p), proxies.get(index.stem(p))):
+                                    panel.rect((0,0,0),Rect(0,51,320,320))
+                        show_buttons(p)
+
+                # proxy clip playing, one small frame when it is due
+                if player.playing:
+                    image = player.frame()
+                    if image is not None:
+                        panel.blit(image,(0,51 + max(320 - image.get_height(), 0) // 2))
+                    elif not player.playing:
+                        show_capture(p)
+
+                # update the changed parts of the review window
+                panel.flush()
+                lap("ui")
@@ -0,0 +1 @@
+"""Helper modules for detect_002.py (Pi5 + Hailo wildlife camera)."""
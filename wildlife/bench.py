@@ -0,0 +1,154 @@
+"""Offline benchmark suite for the detection loop.
+
+Runs the capture -> inference -> trigger loop of detect_002.py against the
+replay stand-ins and reports loop fps, per-stage latency, trigger latency and
+the files written, for a few configurations.  --all also runs the micro
+benchmarks of the individual modules.
+
+    python3 -m wildlife.bench [--seconds 10] [--latency 0.02] [--all]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from . import decode, pipeline, replay
+from .motion import MotionGate
+from .tracker import Tracker
+
+LORES = (640, 640)
+MAIN = (1456, 1088)
+
+
+def _ms(values):
+    if not values:
+        return "    -  "
+    v = np.asarray(values) * 1000.0
+    return "%5.1f/%5.1f" % (np.median(v), np.percentile(v, 95))
+
+
+def run_loop(seconds=10.0, motion_gate=False, confirm=0, in_flight=2, latency=0.02,
+             fps=25, appear=75, v_length=2.0, out=None, pool=False):
+    """One replayed run of the detection loop, returns a report dict."""
+    replay.setup("synthetic", fps=fps, latency=latency, appear=appear)
+    tmp = tempfile.TemporaryDirectory(prefix="wildlife_bench_") if out is None else None
+    out = out or tmp.name
+    cam = replay.Picamera2()
+    cam.configure(cam.create_preview_configuration({"size": MAIN, "format": "XRGB8888"},
+                                                   lores={"size": LORES, "format": "RGB888"},
+                                                   controls={"FrameRate": fps}))
+    encoder = replay.H264Encoder(2000000, repeat=True)
+    encoder.output = replay.CircularOutput(buffersize=5 * fps)
+    cam.start()
+    cam.start_encoder(encoder)
+    hailo = replay.Hailo()
+    thresholds = decode.class_thresholds(replay.NUM_CLASSES, [replay.ANIMAL_CLASS], 0.5)
+    gate = MotionGate() if motion_gate else None
+    tracker = Tracker(confirm, max(confirm, 5)) if confirm else None
+    stages = {"capture->result": [], "inference": [], "decode": [], "trigger": [], "loop": []}
+    encoding = False
+    startrec = 0.0
+    trigger_latency = None
+    snapshots = []
+    pipe = pipeline.Pipeline(cam, hailo, in_flight=in_flight, gate=gate, pool=pool,
+                             mapped=replay.MappedArray).start()
+    end = time.monotonic() + seconds
+    try:
+        while time.monotonic() < end:
+            t0 = time.monotonic()
+            item = pipe.get(timeout=1)
+            if item is None:
+                continue
+            t1 = time.monotonic()
+            stages["capture->result"].append(t1 - item.captured)
+            if item.inferred is not None:
+                stages["inference"].append(item.inferred - item.captured)
+            dets = decode.decode(item.results[0]) if item.results is not None else decode.EMPTY
+            t2 = time.monotonic()
+            stages["decode"].append(t2 - t1)
+            hits = decode.select(dets, thresholds)
+            triggered = len(hits) > 0
+            if tracker is not None:
+                if item.results is not None:
+                    triggered = len(tracker.update(hits)) > 0 or tracker.active()
+                else:
+                    triggered = tracker.active()
+            if gate is not None:
+                gate.force = encoding
+            if triggered:
+                startrec = time.monotonic()
+                if not encoding:
+                    name = os.path.join(out, "%06d" % item.seq)
+                    encoder.output.fileoutput = name + ".h264"
+                    encoder.output.start()
+                    encoding = True
+                    item.frame.tofile(name + ".rgb")
+                    snapshots.append(name + ".rgb")
+                    if trigger_latency is None:
+                        trigger_latency = (item.seq - appear - 1) / fps + time.monotonic() - item.captured
+            if encoding and time.monotonic() - startrec > v_length:
+                encoder.output.stop()
+                encoding = False
+            t3 = time.monotonic()
+            stages["trigger"].append(t3 - t2)
+            stages["loop"].append(t3 - t0)
+    finally:
+        pipe.stop()
+        if encoding:
+            encoder.output.stop()
+    s = pipe.stats()
+    files = encoder.output.files + snapshots
+    report = {"fps": s["fps"], "dropped": s["dropped_capture"] + s["dropped_results"],
+              "inferred": s["inferred"], "skipped": s["skipped"], "stages": stages,
+              "trigger_latency": trigger_latency, "files": len(files),
+              "bytes": sum(os.path.getsize(f) for f in files if os.path.exists(f))}
+    if tmp is not None:
+        tmp.cleanup()
+    return report
+
+
+def report(name, r):
+    print("%-22s fps %5.1f  dropped %3d  inferred %4d  skipped %4d  trigger %s  files %d (%.1f MB)" %
+          (name, r["fps"], r["dropped"], r["inferred"], r["skipped"],
+           "%6.0f ms" % (1000 * r["trigger_latency"]) if r["trigger_latency"] is not None else "  none  ",
+           r["files"], r["bytes"] / 1e6))
+    print("    " + "  ".join("%s %s" % (k, _ms(v)) for k, v in r["stages"].items()) + "  (median/p95 ms)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline detection loop benchmarks")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated hailo.run() seconds")
+    parser.add_argument("--all", action="store_true", help="also run the module micro benchmarks")
+    args = parser.parse_args(argv)
+
+    runs = [("every frame", {}),
+            ("motion gate", {"motion_gate": True}),
+            ("confirm 3 of 5", {"confirm": 3}),
+            ("in_flight 1", {"in_flight": 1}),
+            ("lores pool", {"pool": True})]
+    for name, kw in runs:
+        report(name, run_loop(args.seconds, latency=args.latency, **kw))
+
+    if args.all:
+        from . import ipc, motion, multicam, overlay, scheduler, snapshot, thumbs, tracker
+        for key, usec in decode.benchmark(500).items():
+            print("decode %-14s %8.1f us/frame" % (key, usec))
+        for key, usec in overlay.benchmark(500, *MAIN).items():
+            print("overlay %-17s %8.1f us/frame" % (key, usec))
+        for key, ms in thumbs.benchmark(clicks=100, think_ms=20).items():
+            print("thumbs %-9s %6.2f ms stall per click" % (key, ms))
+        print("tracker 3 of 5", tracker.replay(tracker.synthetic_sequences(60)))
+        print("motion", motion.replay(runs=2, length=300))
+        print("scheduler", scheduler.simulate(hours=2, visits=2))
+        print("2 cameras, 1 hailo", multicam.measure(cameras=2, seconds=3, latency=args.latency))
+        print("snapshots", snapshot.benchmark())
+        for key, r in ipc.benchmark(seconds=2).items():
+            print("review window %-10s loop %5.1f ms 95%%, %5.1f ms worst" % (key, r["p95_ms"], r["max_ms"]))
+
+
+if __name__ == "__main__":
+    main()
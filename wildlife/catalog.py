@@ -0,0 +1,284 @@
+"""SQLite catalog of detection events.
+
+Each recording is an event, keyed by its timestamp stem, with its start and
+stop time, picture and video paths, the trigger class and score, every
+detection seen while it was recording and the best score per class.  The
+main loop only queues calls; a writer thread applies them in one
+transaction per batch, so the capture loop never waits on the SD card.
+
+Queries use their own read connection (the database is in WAL mode), eg
+
+    Catalog(path).events(since=time.time() - 7 * 86400, class_name="bear")
+
+Files that are deleted or evicted are set to NULL but the event and its
+detections are kept, moves to USB update the paths.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS classes (
+    class_id INTEGER PRIMARY KEY,
+    name TEXT);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    stem TEXT UNIQUE NOT NULL,
+    start REAL NOT NULL,
+    stop REAL,
+    picture TEXT,
+    video TEXT,
+    class_id INTEGER,
+    score REAL,
+    frames INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS detections (
+    event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+    seq INTEGER,
+    t REAL,
+    class_id INTEGER,
+    score REAL,
+    x0 REAL, y0 REAL, x1 REAL, y1 REAL);
+CREATE TABLE IF NOT EXISTS event_classes (
+    event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+    class_id INTEGER NOT NULL,
+    best REAL,
+    count INTEGER,
+    PRIMARY KEY (event_id, class_id));
+CREATE INDEX IF NOT EXISTS events_start ON events(start);
+CREATE INDEX IF NOT EXISTS detections_event ON detections(event_id);
+CREATE INDEX IF NOT EXISTS event_classes_class ON event_classes(class_id, best);
+"""
+
+
+class Catalog:
+
+    def __init__(self, path, batch=256, interval=1.0, maxsize=10000):
+        """Up to batch queued calls, or interval seconds worth, go in one transaction."""
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.written = 0
+        self.open = {}
+        conn = self._connect()
+        with conn:
+            conn.executescript(SCHEMA)
+        conn.close()
+        self.thread = threading.Thread(target=self._writer, name="catalog", daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _put(self, *call):
+        try:
+            self.queue.put_nowait(call)
+        except queue.Full:
+            self.dropped += 1
+
+    # writes, queued
+    def set_classes(self, names):
+        self._put("classes", list(names))
+
+    def begin(self, stem, start, picture=None, class_id=None, score=None):
+        """An event started recording, class_id and score are what triggered it."""
+        self._put("begin", stem, start, picture, class_id, score)
+
+    def detections(self, stem, seq, t, dets):
+        """Detections (a decode.DETECTION_DTYPE array) of frame seq of an event."""
+        rows = [(seq, t, int(d["class_id"]), float(d["score"])) + tuple(map(float, d["bbox"]))
+                for d in dets]
+        self._put("detections", stem, rows)
+
+    def end(self, stem, stop):
+        self._put("end", stem, stop)
+
+    def set_video(self, stem, path):
+        self._put("file", stem, "video", path)
+
+    def set_picture(self, stem, path):
+        self._put("file", stem, "picture", path)
+
+    def forget_files(self, stem):
+        """The event's files are gone, keep the event and its detections."""
+        self._put("file", stem, "picture", None)
+        self._put("file", stem, "video", None)
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far is written."""
+        done = threading.Event()
+        self._put("flush", done)
+        return done.wait(timeout)
+
+    # writer
+    def _event_id(self, conn, stem):
+        eid = self.open.get(stem)
+        if eid is None:
+            row = conn.execute("SELECT id FROM events WHERE stem = ?", (stem,)).fetchone()
+            eid = row[0] if row else None
+        return eid
+
+    def _apply(self, conn, call):
+        kind = call[0]
+        if kind == "classes":
+            conn.executemany("INSERT OR REPLACE INTO classes(class_id, name) VALUES (?, ?)",
+                             enumerate(call[1]))
+        elif kind == "begin":
+            _, stem, start, picture, class_id, score = call
+            cur = conn.execute("INSERT OR REPLACE INTO events(stem, start, picture, class_id, score) "
+                               "VALUES (?, ?, ?, ?, ?)", (stem, start, picture, class_id, score))
+            self.open[stem] = cur.lastrowid
+        elif kind == "detections":
+            _, stem, rows = call
+            eid = self._event_id(conn, stem)
+            if eid is None:
+                return
+            conn.execute("UPDATE events SET frames = frames + 1 WHERE id = ?", (eid,))
+            if not rows:
+                return
+            conn.executemany("INSERT INTO detections(event_id, seq, t, class_id, score, x0, y0, x1, y1) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [(eid,) + r for r in rows])
+            best = {}
+            for r in rows:
+                b, n = best.get(r[2], (0.0, 0))
+                best[r[2]] = (max(b, r[3]), n + 1)
+            conn.executemany("INSERT INTO event_classes(event_id, class_id, best, count) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT(event_id, class_id) DO UPDATE SET "
+                             "best = max(best, excluded.best), count = count + excluded.count",
+                             [(eid, c, b, n) for c, (b, n) in best.items()])
+        elif kind == "end":
+            _, stem, stop = call
+            conn.execute("UPDATE events SET stop = ? WHERE stem = ?", (stop, stem))
+            self.open.pop(stem, None)
+        elif kind == "file":
+            _, stem, column, path = call
+            conn.execute("UPDATE events SET %s = ? WHERE stem = ?" % column, (path, stem))
+
+    def _writer(self):
+        conn = self._connect()
+        while True:
+            calls = [self.queue.get()]
+            end = time.monotonic() + self.interval
+            while len(calls) < self.batch:
+                try:
+                    calls.append(self.queue.get(timeout=max(end - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            flushed = []
+            try:
+                with conn:
+                    for call in calls:
+                        if call[0] == "flush":
+                            flushed.append(call[1])
+                        else:
+                            self._apply(conn, call)
+                self.written += len(calls) - len(flushed)
+            except sqlite3.Error as e:
+                print("Catalog", e)
+            for done in flushed:
+                done.set()
+
+    # queries, from any thread
+    def query(self, sql, args=()):
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            return [dict(r) for r in conn.execute(sql, args)]
+        finally:
+            conn.close()
+
+    def events(self, since=None, until=None, class_id=None, class_name=None, min_score=None, limit=None):
+        """Events, newest first, each with a {class name: best score} dict.
+        class_id/class_name and min_score select events where that class
+        (or any class) reached min_score."""
+        where, args = [], []
+        if since is not None:
+            where.append("e.start >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("e.start < ?")
+            args.append(until)
+        if class_name is not None:
+            where.append("ec.class_id = (SELECT class_id FROM classes WHERE name = ?)")
+            args.append(class_name)
+        elif class_id is not None:
+            where.append("ec.class_id = ?")
+            args.append(class_id)
+        if min_score is not None:
+            where.append("ec.best >= ?")
+            args.append(min_score)
+        sql = ("SELECT DISTINCT e.* FROM events e LEFT JOIN event_classes ec ON ec.event_id = e.id" +
+               (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY e.start DESC")
+        if limit:
+            sql += " LIMIT %d" % int(limit)
+        events = self.query(sql, args)
+        if events:
+            ids = [e["id"] for e in events]
+            best = {}
+            for r in self.query("SELECT ec.event_id, coalesce(c.name, ec.class_id) AS name, ec.best "
+                                "FROM event_classes ec LEFT JOIN classes c ON c.class_id = ec.class_id "
+                                "WHERE ec.event_id IN (%s)" % ",".join("?" * len(ids)), ids):
+                best.setdefault(r["event_id"], {})[r["name"]] = r["best"]
+            for e in events:
+                e["classes"] = best.get(e["id"], {})
+        return events
+
+    def species(self, since=None):
+        """[{name, events, best}] per class seen, most events first."""
+        sql = ("SELECT coalesce(c.name, ec.class_id) AS name, count(*) AS events, max(ec.best) AS best "
+               "FROM event_classes ec JOIN events e ON e.id = ec.event_id "
+               "LEFT JOIN classes c ON c.class_id = ec.class_id" +
+               (" WHERE e.start >= ?" if since is not None else "") +
+               " GROUP BY ec.class_id ORDER BY events DESC")
+        return self.query(sql, () if since is None else (since,))
+
+    def track(self, stem):
+        """Every detection of an event, in frame order."""
+        return self.query("SELECT d.seq, d.t, d.class_id, d.score, d.x0, d.y0, d.x1, d.y1 "
+                          "FROM detections d JOIN events e ON e.id = d.event_id "
+                          "WHERE e.stem = ? ORDER BY d.seq", (stem,))
+
+
+def benchmark(events=2000, frames=125, per_frame=2):
+    """Write synthetic events and time the writes and a class + week query."""
+    import os
+    import tempfile
+    import numpy as np
+    from .decode import DETECTION_DTYPE
+    tmp = tempfile.TemporaryDirectory(prefix="wildlife_catalog_")
+    path = os.path.join(tmp.name, "catalog.db")
+    cat = Catalog(path)
+    cat.set_classes(str(i) for i in range(80))
+    rng = np.random.default_rng(0)
+    now = time.time()
+    t0 = time.perf_counter()
+    for n in range(events):
+        stem = "e%06d" % n
+        start = now - 30 * 86400 + n * 30 * 86400 / events
+        cat.begin(stem, start, stem + ".jpg", 14, 0.8)
+        for f in range(frames):
+            dets = np.zeros(per_frame, DETECTION_DTYPE)
+            dets["class_id"] = rng.integers(0, 80, per_frame)
+            dets["score"] = rng.random(per_frame)
+            cat.detections(stem, f, start + f / 25, dets)
+        cat.end(stem, start + frames / 25)
+    queued = time.perf_counter() - t0
+    cat.flush()
+    written = time.perf_counter() - t0
+    t1 = time.perf_counter()
+    found = cat.events(since=now - 7 * 86400, class_id=14, min_score=0.5)
+    query = time.perf_counter() - t1
+    tmp.cleanup()
+    return {"queue_us_per_frame": queued / (events * frames) * 1e6,
+            "write_s": written, "query_ms": query * 1000, "found": len(found), "dropped": cat.dropped}
+
+
+if __name__ == "__main__":
+    print(benchmark())
@@ -0,0 +1,282 @@
+"""Camera settings and capture management, shared by the review window and
+a local control API.
+
+Controller holds the operations the review window buttons used to do
+inline: set MODE/SPEED/GAIN (applied to the camera and saved to the config
+file), list and delete captures, and queue moves to the USB drive, plus a
+status() built from registered collectors.  Every change bumps version, so
+the review window can redraw after a change made through the API.
+
+serve() exposes it as JSON over HTTP on a Unix socket and/or 127.0.0.1:port
+
+    curl --unix-socket /run/shm/wildlife.sock http://x/status
+    curl --unix-socket /run/shm/wildlife.sock -d '{"mode": 0, "speed": 20000}' http://x/settings
+    curl --unix-socket /run/shm/wildlife.sock http://x/captures
+    curl --unix-socket /run/shm/wildlife.sock -X DELETE http://x/captures/240518_061502
+    curl --unix-socket /run/shm/wildlife.sock -d '{"stems": ["240518_061502"]}' http://x/offload
+    curl --unix-socket /run/shm/wildlife.sock 'http://x/events?class=bear&min_score=0.7&days=7'
+
+GET /status, /settings, /captures, /events (with a catalog); POST /settings,
+/offload (no stems = everything); DELETE /captures/<stem>, /captures (all).
+"""
+
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+import urllib.parse
+
+from .storage import percent_used, usb_drive
+
+MODES = ["manual", "normal", "short", "long"]
+LIMITS = {"mode": (0, 3), "speed": (1000, 100000), "gain": (0, 64)}
+
+
+class Controller:
+
+    def __init__(self, index, storage, offload, config_file, media, mode=1, speed=1000, gain=0,
+                 tier="sd", usb_limit=90, on_delete=None, catalog=None):
+        """media is the folder USB drives are mounted in, on_delete(stem) is
+        called after a capture is deleted, eg to drop cached images."""
+        self.index = index
+        self.storage = storage
+        self.offloader = offload
+        self.config_file = config_file
+        self.media = media
+        self.mode = mode
+        self.speed = speed
+        self.gain = gain
+        self.tier = tier
+        self.usb_limit = usb_limit
+        self.on_delete = on_delete
+        self.catalog = catalog
+        # camera(mode, speed, gain) applies the settings, set once the camera is running
+        self.camera = None
+        self.collectors = []
+        self.version = 0
+        self.lock = threading.RLock()
+
+    # camera settings
+    def settings(self):
+        return {"mode": self.mode, "mode_name": MODES[self.mode], "speed": self.speed, "gain": self.gain}
+
+    def set(self, mode=None, speed=None, gain=None):
+        """Change any of the settings, raises ValueError if one is out of range."""
+        new = {"mode": self.mode if mode is None else mode,
+               "speed": self.speed if speed is None else speed,
+               "gain": self.gain if gain is None else gain}
+        for name, value in new.items():
+            lo, hi = LIMITS[name]
+            if isinstance(value, bool) or not isinstance(value, int) or not lo <= value <= hi:
+                raise ValueError("%s must be an integer from %d to %d" % (name, lo, hi))
+        with self.lock:
+            self.mode, self.speed, self.gain = new["mode"], new["speed"], new["gain"]
+            self.apply()
+            self.save()
+            self.version += 1
+        return self.settings()
+
+    def changed(self):
+        """Note a change to the captures made elsewhere, eg evicted to free space,
+        so views redraw.  Not under the lock, it is called with the storage lock held."""
+        self.version += 1
+
+    def apply(self):
+        if self.camera is not None:
+            self.camera(self.mode, self.speed, self.gain)
+
+    def save(self):
+        with open(self.config_file, "w") as f:
+            for item in (self.mode, self.speed, self.gain):
+                f.write("%s\n" % item)
+
+    # captures
+    def captures(self):
+        return [{"stem": stem, "picture": os.path.join(self.index.pictures, stem + self.index.pic_ext),
+                 "video": os.path.join(self.index.videos, stem + self.index.vid_ext) if video else None}
+                for stem, video in self.index.captures()]
+
+    def delete(self, stem):
+        """Delete the picture and video of a capture, False if there is no such capture."""
+        with self.lock:
+            if self.index.position(stem) < 0 and stem not in self.index.video_stems():
+                return False
+            self._delete(stem)
+        self._deleted(stem)
+        return True
+
+    def _delete(self, stem):
+        for path in (os.path.join(self.index.pictures, stem + self.index.pic_ext),
+                     os.path.join(self.index.videos, stem + self.index.vid_ext)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.storage.forget(self.tier, stem)
+        self.index.remove(stem)
+        self.version += 1
+
+    def _deleted(self, stem):
+        # outside the lock, on_delete takes other locks
+        if self.on_delete is not None:
+            self.on_delete(stem)
+        print("DELETED", stem)
+
+    def _files(self, folder, ext):
+        try:
+            return [name[:-len(ext)] for name in os.listdir(folder) if name.endswith(ext)]
+        except FileNotFoundError:
+            return []
+
+    def delete_all(self):
+        """Delete every picture and video, including videos without a picture
+        and files the index doesn't know about, returns the number of captures."""
+        with self.lock:
+            stems = {stem for stem, _ in self.index.captures()}
+            stems.update(self.index.video_stems())
+            stems.update(self._files(self.index.pictures, self.index.pic_ext))
+            stems.update(self._files(self.index.videos, self.index.vid_ext))
+            stems = sorted(stems)
+            for stem in stems:
+                self._delete(stem)
+        for stem in stems:
+            self._deleted(stem)
+        return len(stems)
+
+    def offload(self, stems=None):
+        """Queue captures (default all) to move to the USB drive, returns the
+        number of files queued, or raises OSError if there is no usable drive."""
+        drive = usb_drive(self.media)
+        if drive is None:
+            raise OSError("no USB drive")
+        if percent_used(drive) >= self.usb_limit:
+            raise OSError("USB drive over %d%% full" % self.usb_limit)
+        wanted = None if stems is None else set(stems)
+        files = []
+        for stem, video in self.index.captures():
+            if wanted is not None and stem not in wanted:
+                continue
+            p = self.index.position(stem)
+            if not os.path.exists(os.path.join(drive, "Pictures", self.index.name(p))):
+                files.append((self.index.picture(p), os.path.join(drive, "Pictures") + "/"))
+            if video and not os.path.exists(os.path.join(drive, "Videos", stem + self.index.vid_ext)):
+                files.append((self.index.video(p), os.path.join(drive, "Videos") + "/"))
+        self.offloader.queue(files)
+        return len(files)
+
+    def events(self, class_name=None, min_score=None, days=None, limit=100):
+        """Catalogued events, newest first, see Catalog.events()."""
+        if self.catalog is None:
+            raise OSError("no event catalog")
+        since = time.time() - days * 86400 if days is not None else None
+        return self.catalog.events(since=since, class_name=class_name, min_score=min_score, limit=limit)
+
+    # status
+    def collect(self, fn):
+        """fn() returns a dict merged into status()."""
+        self.collectors.append(fn)
+
+    def status(self):
+        caps = self.index.captures()
+        status = {"settings": self.settings(), "captures": len(caps),
+                  "videos": sum(1 for _, video in caps if video),
+                  "offload": self.offloader.progress()}
+        for fn in self.collectors:
+            try:
+                status.update(fn())
+            except Exception as e:
+                status.setdefault("errors", []).append(str(e))
+        return status
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _handler(control):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def _reply(self, code, body):
+            data = json.dumps(body, indent=1, default=str).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            if not length:
+                return {}
+            body = json.loads(self.rfile.read(length))
+            if not isinstance(body, dict):
+                raise ValueError("expected a JSON object")
+            return body
+
+        def _route(self, method):
+            url = urllib.parse.urlsplit(self.path)
+            parts = [p for p in url.path.split("/") if p]
+            q = dict(urllib.parse.parse_qsl(url.query))
+            try:
+                if method == "GET" and parts == ["status"]:
+                    return self._reply(200, control.status())
+                if method == "GET" and parts == ["settings"]:
+                    return self._reply(200, control.settings())
+                if method == "GET" and parts == ["captures"]:
+                    return self._reply(200, control.captures())
+                if method == "GET" and parts == ["events"]:
+                    return self._reply(200, control.events(
+                        q.get("class"), float(q["min_score"]) if "min_score" in q else None,
+                        float(q["days"]) if "days" in q else None, int(q.get("limit", 100))))
+                if method == "POST" and parts == ["settings"]:
+                    body = self._body()
+                    return self._reply(200, control.set(body.get("mode"), body.get("speed"), body.get("gain")))
+                if method == "POST" and parts == ["offload"]:
+                    return self._reply(200, {"queued": control.offload(self._body().get("stems"))})
+                if method == "DELETE" and parts == ["captures"]:
+                    return self._reply(200, {"deleted": control.delete_all()})
+                if method == "DELETE" and len(parts) == 2 and parts[0] == "captures":
+                    if control.delete(parts[1]):
+                        return self._reply(200, {"deleted": 1})
+                    return self._reply(404, {"error": "no capture " + parts[1]})
+                return self._reply(404, {"error": "unknown request %s %s" % (method, self.path)})
+            except ValueError as e:
+                return self._reply(400, {"error": str(e)})
+            except OSError as e:
+                return self._reply(503, {"error": str(e)})
+
+        def do_GET(self):
+            self._route("GET")
+
+        def do_POST(self):
+            self._route("POST")
+
+        def do_DELETE(self):
+            self._route("DELETE")
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(control, socket_path=None, port=0):
+    """Serve the API on a Unix socket (owner only) and/or 127.0.0.1:port,
+    in background threads.  Returns the servers."""
+    servers = []
+    if socket_path:
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        server = _UnixHTTPServer(socket_path, _handler(control))
+        os.chmod(socket_path, 0o600)
+        servers.append(server)
+    if port:
+        servers.append(http.server.ThreadingHTTPServer(("127.0.0.1", port), _handler(control)))
+    for server in servers:
+        threading.Thread(target=server.serve_forever, name="control-api", daemon=True).start()
+    return servers
@@ -0,0 +1,143 @@
+"""Vectorised decoding of the HailoRT-postprocess (NMS) output.
+
+hailo.run() returns, for each image, a list with one entry per class, each
+entry being an (n, 5) array of [y0, x0, y1, x1, score] rows.  decode() packs
+the whole thing into one NumPy structured array so thresholds, masks and
+box conversion are array operations instead of Python loops.
+
+Run "python3 -m wildlife.decode" for a per-frame micro-benchmark against the
+old string parsing.
+"""
+
+import numpy as np
+
+# one packed record per detection, bbox is normalised (x0, y0, x1, y1)
+DETECTION_DTYPE = np.dtype([("class_id", np.int16),
+                            ("score", np.float32),
+                            ("bbox", np.float32, (4,))])
+
+EMPTY = np.empty(0, DETECTION_DTYPE)
+
+
+def decode(hailo_output):
+    """Pack the per-class Hailo output of one image into a structured array."""
+    counts = np.fromiter((len(d) for d in hailo_output), dtype=np.intp,
+                         count=len(hailo_output))
+    total = int(counts.sum())
+    if total == 0:
+        return EMPTY
+    rows = np.concatenate([np.asarray(d, dtype=np.float32).reshape(-1, 5)
+                           for d in hailo_output if len(d)])
+    dets = np.empty(total, DETECTION_DTYPE)
+    dets["class_id"] = np.repeat(np.arange(len(counts), dtype=np.int16), counts)
+    dets["score"] = rows[:, 4]
+    dets["bbox"] = rows[:, [1, 0, 3, 2]]
+    return dets
+
+
+def class_thresholds(num_classes, class_ids, score):
+    """Per-class threshold table, classes not in class_ids can never pass.
+
+    score may be a single float or a sequence matching class_ids."""
+    table = np.full(num_classes, np.inf, dtype=np.float32)
+    table[np.asarray(class_ids, dtype=np.intp)] = score
+    return table
+
+
+def select(dets, thresholds, strict=True):
+    """Return the detections whose score passes their class threshold.
+
+    thresholds is either a float or a table from class_thresholds()."""
+    thr = np.asarray(thresholds, dtype=np.float32)
+    if thr.ndim:
+        thr = thr[dets["class_id"]]
+    if strict:
+        return dets[dets["score"] > thr]
+    return dets[dets["score"] >= thr]
+
+
+def best(dets):
+    """Highest scoring detection, or None."""
+    if len(dets) == 0:
+        return None
+    return dets[int(np.argmax(dets["score"]))]
+
+
+def to_pixels(dets, w, h):
+    """Integer (x0, y0, x1, y1) boxes scaled to a w x h image."""
+    return (dets["bbox"] * np.array([w, h, w, h], dtype=np.float32)).astype(np.int32)
+
+
+def labelled(dets, w, h, class_names):
+    """[class_name, bbox, score] lists as used by draw_objects()."""
+    boxes = to_pixels(dets, w, h).tolist()
+    return [[class_names[c], tuple(b), s] for c, b, s in
+            zip(dets["class_id"].tolist(), boxes, dets["score"].tolist())]
+
+
+def synthetic_output(num_classes=80, per_class=None, seed=0):
+    """Hailo-shaped NMS output, per_class maps class_id -> number of boxes."""
+    rng = np.random.default_rng(seed)
+    per_class = per_class or {}
+    out = []
+    for c in range(num_classes):
+        n = per_class.get(c, 0)
+        if n == 0:
+            out.append(np.empty((0, 5), dtype=np.float32))
+            continue
+        tl = rng.uniform(0, 0.5, (n, 2))
+        br = tl + rng.uniform(0.05, 0.5, (n, 2))
+        score = rng.uniform(0.2, 0.99, (n, 1))
+        out.append(np.hstack([tl, br, score]).astype(np.float32))
+    return out
+
+
+def _legacy(hailo_output, objts, w, h, class_names, threshold):
+    # the string parsing trigger and extract_detections() loop from v0.11
+    hit = None
+    for d in range(0, len(objts)):
+        if len(hailo_output[objts[d]]) != 0:
+            out1 = str(hailo_output[objts[d]])[2:-2].split(" ")
+            out1 = [x for x in out1 if x != '']
+            value = float(out1[4][0:5])
+            if value > threshold and value < 1 and hit is None:
+                hit = objts[d]
+    results = []
+    for class_id, detections in enumerate(hailo_output):
+        for detection in detections:
+            score = detection[4]
+            if score >= threshold:
+                y0, x0, y1, x1 = detection[:4]
+                bbox = (int(x0 * w), int(y0 * h), int(x1 * w), int(y1 * h))
+                results.append([class_names[class_id], bbox, score])
+    return hit, results
+
+
+def _vector(hailo_output, table, w, h, class_names, threshold):
+    dets = decode(hailo_output)
+    hits = select(dets, table)
+    hits = hits[hits["score"] < 1]
+    top = best(hits)
+    return top, labelled(select(dets, threshold, strict=False), w, h, class_names)
+
+
+def benchmark(frames=2000):
+    """Per-frame cost of the old and new decoding, returns {name: usec}."""
+    import timeit
+    class_names = [str(i) for i in range(80)]
+    objts = [15, 21, 14, 74]
+    table = class_thresholds(80, objts, 0.5)
+    cases = {"empty": {}, "busy": {0: 6, 14: 3, 15: 2, 56: 4, 74: 1}}
+    report = {}
+    for case, per_class in cases.items():
+        output = synthetic_output(per_class=per_class)
+        for name, fn, arg in (("legacy", _legacy, objts), ("vector", _vector, table)):
+            t = timeit.timeit(lambda: fn(output, arg, 1456, 1088, class_names, 0.5),
+                              number=frames)
+            report[case + "/" + name] = t / frames * 1e6
+    return report
+
+
+if __name__ == "__main__":
+    for key, usec in benchmark().items():
+        print("%-14s %8.1f us/frame" % (key, usec))
@@ -0,0 +1,141 @@
+"""Adaptive encoder bitrate and frame rate, chosen per clip.
+
+EncoderController picks a step from a ladder of (bitrate, fps) settings,
+best first, from three readings: the write throughput measured while clips
+are written, the space left where they are written (the SD card budget, or
+RAM above ram_limit when recording .h264 to /run/shm), and the expected clip
+length, a running average of recent clips.  A step fits if the video uses no
+more than headroom of the throughput and clips_ahead clips of the expected
+length still fit in the space left.  It steps down as far as needed straight
+away and only steps up when the better step fits with up_margin to spare, so
+the setting doesn't flip between clips.
+
+The controller only does arithmetic on the readings it is given, so it can
+be driven with simulated storage; "python3 -m wildlife.encoding" records
+bursts of clips into a simulated /run/shm and compares it with fixed bitrates.
+"""
+
+LADDER = ((4000000, 25), (2000000, 25), (1200000, 20), (800000, 15), (500000, 10))
+
+
+class EncoderController:
+
+    def __init__(self, ladder=LADDER, clip_seconds=10.0, clips_ahead=3, headroom=0.5, up_margin=1.25,
+                 smoothing=0.3, start=None):
+        """clip_seconds is the shortest clip expected, eg v_length + pre_frames,
+        start the initial bitrate (default the best step)."""
+        self.ladder = list(ladder)
+        self.min_clip = clip_seconds
+        self.clip_seconds = clip_seconds
+        self.clips_ahead = clips_ahead
+        self.headroom = headroom
+        self.up_margin = up_margin
+        self.smoothing = smoothing
+        self.level = 0
+        if start is not None:
+            self.level = min(range(len(self.ladder)), key=lambda i: abs(self.ladder[i][0] - start))
+        self.throughput = None
+        self.free = None
+        self.reason = "start"
+        self.changes = 0
+
+    def _average(self, old, new):
+        return new if old is None else old + self.smoothing * (new - old)
+
+    def wrote(self, nbytes, seconds):
+        """A throughput reading, nbytes written in seconds spent writing."""
+        if seconds > 0 and nbytes > 0:
+            self.throughput = self._average(self.throughput, nbytes / seconds)
+
+    def clip_done(self, seconds):
+        """A clip of seconds was recorded."""
+        self.clip_seconds = max(self._average(self.clip_seconds, seconds), self.min_clip)
+
+    def _limit(self, level, free, margin=1.0):
+        """What stops ladder step level being used, or None if it fits."""
+        rate = self.ladder[level][0] / 8 * margin
+        if self.throughput is not None and rate > self.throughput * self.headroom:
+            return "throughput"
+        if free is not None and rate * self.clip_seconds * self.clips_ahead > free:
+            return "space"
+        return None
+
+    def choose(self, free=None):
+        """(bitrate, fps) for the next clip, free is the bytes left where it
+        will be written, None if unknown."""
+        self.free = free
+        level = self.level
+        while level < len(self.ladder) - 1 and self._limit(level, free) is not None:
+            level += 1
+        while level > 0 and self._limit(level - 1, free, self.up_margin) is None:
+            level -= 1
+        # why this step: what rules out the one above it, or that even this one doesn't fit
+        limit = self._limit(level, free)
+        if limit is not None:
+            self.reason = "lowest, " + limit
+        else:
+            self.reason = self._limit(level - 1, free, self.up_margin) if level > 0 else "best"
+        if level != self.level:
+            self.changes += 1
+        self.level = level
+        return self.ladder[level]
+
+    def status(self):
+        bitrate, fps = self.ladder[self.level]
+        return {"bitrate": bitrate, "fps": fps, "level": self.level, "reason": self.reason,
+                "throughput_mbs": self.throughput / 1e6 if self.throughput is not None else None,
+                "free_mb": self.free / 1e6 if self.free is not None else None,
+                "clip_seconds": self.clip_seconds, "changes": self.changes}
+
+
+def simulate(hours=6, ram=100, throughput=1.5, bursts=12, burst_clips=(4, 20), clip_seconds=(8, 30),
+             fixed=None, seed=4):
+    """Record bursts of back to back clips into ram MB above ram_limit, which
+    the remux drains to the SD card at throughput MB/s between recordings.
+    fixed is a constant bitrate to compare with.  Returns the seconds
+    recorded and cut short by running out of RAM, and the bitrates used."""
+    import random
+    rng = random.Random(seed)
+    ctl = EncoderController(clip_seconds=clip_seconds[0])
+    starts = {}
+    for _ in range(bursts):
+        t = rng.randrange(0, hours * 3600)
+        for _ in range(rng.randint(*burst_clips)):
+            length = rng.uniform(*clip_seconds)
+            starts[t] = length
+            t += int(length) + 2
+    free = ram * 1e6
+    recorded = lost = 0.0
+    used = {}
+    left = 0
+    bitrate = 0
+    for t in range(hours * 3600):
+        if left <= 0 and t in starts:
+            bitrate = fixed or ctl.choose(free)[0]
+            left = length = starts[t]
+            used[bitrate] = used.get(bitrate, 0) + 1
+        if left > 0:
+            free -= bitrate / 8
+            if free < 0:
+                # ram_limit stops the recording
+                lost += left
+                free = 0
+                left = 0
+            else:
+                recorded += 1
+                left -= 1
+                if left <= 0:
+                    ctl.clip_done(length)
+        else:
+            drained = min(throughput * 1e6, ram * 1e6 - free)
+            free += drained
+            ctl.wrote(drained, drained / (throughput * 1e6))
+    return {"recorded": recorded, "lost": lost, "bitrates": used, "status": ctl.status()}
+
+
+if __name__ == "__main__":
+    for name, kw in (("fixed 4 Mbit/s", {"fixed": 4000000}), ("fixed 2 Mbit/s", {"fixed": 2000000}),
+                     ("adaptive", {})):
+        r = simulate(**kw)
+        print("%-15s %5.0f s recorded, %4.0f s cut short, clips per bitrate %s" %
+              (name, r["recorded"], r["lost"], dict(sorted(r["bitrates"].items(), reverse=True))))
@@ -0,0 +1,120 @@
+"""In-memory index of the captured pictures and videos.
+
+The Pictures and Videos folders are scanned once, after that the index is
+kept current by the code that writes, converts, moves and deletes captures,
+so the review window never has to glob thousands of files on a click.
+
+Captures are identified by their timestamp stem, eg "240518_061502", and are
+kept in sorted order so position p in the review window is index.stem(p).
+"""
+
+import bisect
+import os
+import threading
+
+
+class CaptureIndex:
+
+    def __init__(self, pictures, videos, pic_ext=".jpg", vid_ext=".mp4"):
+        self.pictures = pictures
+        self.videos = videos
+        self.pic_ext = pic_ext
+        self.vid_ext = vid_ext
+        self.lock = threading.RLock()
+        self.refresh()
+
+    def _scan(self, folder, ext):
+        try:
+            with os.scandir(folder) as it:
+                return [e.name[:-len(ext)] for e in it if e.name.endswith(ext) and e.is_file()]
+        except FileNotFoundError:
+            return []
+
+    def refresh(self):
+        """Rebuild from the folders, only needed if files change behind our back."""
+        with self.lock:
+            self.stems = sorted(self._scan(self.pictures, self.pic_ext))
+            self.vids = set(self._scan(self.videos, self.vid_ext))
+
+    @staticmethod
+    def stem_of(path):
+        return os.path.splitext(os.path.basename(path))[0]
+
+    # lookups
+    def __len__(self):
+        return len(self.stems)
+
+    def stem(self, p):
+        """Stem at position p.  A p left past the end, eg by a capture evicted in the
+        background, gives the last one, and "" if there are none."""
+        with self.lock:
+            if not self.stems:
+                return ""
+            return self.stems[min(max(p, 0), len(self.stems) - 1)]
+
+    def picture(self, p):
+        return os.path.join(self.pictures, self.stem(p) + self.pic_ext)
+
+    def video(self, p):
+        return os.path.join(self.videos, self.stem(p) + self.vid_ext)
+
+    def name(self, p):
+        return self.stem(p) + self.pic_ext
+
+    def has_video(self, p):
+        return 0 <= p < len(self.stems) and self.stems[p] in self.vids
+
+    def position(self, stem):
+        """Position of stem in the review order, or -1."""
+        i = bisect.bisect_left(self.stems, stem)
+        if i < len(self.stems) and self.stems[i] == stem:
+            return i
+        return -1
+
+    def with_video(self):
+        """Stems of the pictures that have a matching mp4."""
+        with self.lock:
+            return [s for s in self.stems if s in self.vids]
+
+    def video_stems(self):
+        with self.lock:
+            return sorted(self.vids)
+
+    def captures(self):
+        """[(stem, has video)] in review order."""
+        with self.lock:
+            return [(s, s in self.vids) for s in self.stems]
+
+    # updates from the code paths that change files
+    def add_picture(self, path):
+        stem = self.stem_of(path)
+        with self.lock:
+            i = bisect.bisect_left(self.stems, stem)
+            if i == len(self.stems) or self.stems[i] != stem:
+                self.stems.insert(i, stem)
+            return i
+
+    def add_video(self, path):
+        with self.lock:
+            self.vids.add(self.stem_of(path))
+
+    def remove_picture(self, stem):
+        with self.lock:
+            i = self.position(stem)
+            if i >= 0:
+                del self.stems[i]
+
+    def remove_video(self, stem):
+        with self.lock:
+            self.vids.discard(stem)
+
+    def remove(self, stem):
+        """Forget both the picture and the video of a capture."""
+        with self.lock:
+            self.remove_picture(stem)
+            self.remove_video(stem)
+
+    def clear(self):
+        with self.lock:
+            self.stems = []
+            self.vids = set()
@@ -0,0 +1,529 @@
+"""Shared memory frame ring, event channel and supervisor, for running the
+review window in its own process.
+
+The capture process (detect_002.py --headless) puts each trigger picture in
+a FrameRing.  This is a fixed size shared memory segment (/dev/shm/<name>)
+with slots for the lores frames.  It also sends small JSON events (trigger,
+status) to the review window's datagram socket with an EventSender.  Neither
+ever waits for the other.  Putting a frame costs one memcpy into the next
+slot, and an event nobody is listening for is dropped.
+
+The review window (wildlife/review.py) copies the frames out of the ring and
+picks up events with an EventListener.  It sends its commands through the
+control API with ApiClient.  Image scaling, font rendering and browsing
+then no longer share a GIL with the detection loop.
+
+Either process can restart on its own.  Neither one unlinks the segment when
+it exits.  A restarted capture process reuses the segment and carries on
+numbering frames from where it left off.  A restarted review window attaches
+to it and shows the latest trigger picture straight away, even before the
+JPEG is on the card.  Each slot has a sequence number that is odd while the
+slot is being written.  A reader that races the writer sees the number
+change and tries again.
+
+Supervisor runs both processes (python3 detect_002.py --split) and restarts
+whichever one stops.
+
+"python3 -m wildlife.ipc" measures detection loop frame times in three
+cases: no review window work, that work in a thread of the same process, and
+that work in a separate process reading from the ring.
+"""
+
+import http.client
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+MAGIC = 0x314752444C495700  # "\0WILDRG1"
+META = 256
+
+# header words
+_MAGIC, _SLOTS, _H, _W, _C, _HEAD, _PID = range(7)
+_HEADER = 8
+# slot table columns: sequence (odd while written), frame number, time (us), meta length
+_SEQ, _NUM, _STAMP, _LEN = range(4)
+
+
+def _open(name, create=False, size=0):
+    """A SharedMemory that outlives this process."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, create, size, track=False)
+    shm = shared_memory.SharedMemory(name, create, size)
+    # before Python 3.13 the resource tracker unlinks the segment when any process using it exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _unlink(shm):
+    if sys.version_info < (3, 13):
+        # unlink() unregisters it from the resource tracker, as it would have been
+        resource_tracker.register(shm._name, "shared_memory")
+    shm.unlink()
+
+
+def _size(slots, shape):
+    return 8 * _HEADER + 8 * 4 * slots + META * slots + slots * int(np.prod(shape))
+
+
+class FrameRing:
+
+    def __init__(self, name, shape=None, slots=4):
+        """With a frame shape, eg (640, 640, 3), this is the writer, which
+        creates the segment or reuses one of the same size from an earlier run.
+        Without it this is a reader, raising FileNotFoundError if there's no
+        segment yet."""
+        self.name = name
+        self.lock = threading.Lock()
+        self.writer = shape is not None
+        if self.writer:
+            shape = tuple(shape)
+            if len(shape) == 2:
+                shape += (1,)
+            self.shm = self._create(name, shape, slots)
+        else:
+            self.shm = _open(name)
+            self._map()
+            if int(self.header[_MAGIC]) != MAGIC:
+                self.close()
+                raise FileNotFoundError("no frame ring " + name)
+
+    def _create(self, name, shape, slots):
+        try:
+            shm = _open(name)
+        except FileNotFoundError:
+            shm = None
+        if shm is not None:
+            header = np.ndarray(_HEADER, np.int64, shm.buf)
+            if (int(header[_MAGIC]) == MAGIC and int(header[_SLOTS]) == slots and shm.size >= _size(slots, shape)
+                    and tuple(int(v) for v in header[_H:_C + 1]) == shape):
+                # left by an earlier run, any slot it was writing when it stopped is dropped
+                del header
+                self.shm = shm
+                self._map()
+                torn = self.table[:, _SEQ] % 2 == 1
+                self.table[torn, _NUM] = 0
+                self.table[torn, _SEQ] += 1
+                self.header[_PID] = os.getpid()
+                return shm
+            # a different size, readers still attached see it closed and reopen
+            header[_MAGIC] = 0
+            del header
+            shm.close()
+            _unlink(shm)
+        self.shm = _open(name, True, _size(slots, shape))
+        self._map(slots, shape)
+        self.header[_SLOTS] = slots
+        self.header[_H:_C + 1] = shape
+        self.header[_PID] = os.getpid()
+        self.header[_MAGIC] = MAGIC
+        return self.shm
+
+    def _map(self, slots=None, shape=None):
+        buf = self.shm.buf
+        self.header = np.ndarray(_HEADER, np.int64, buf)
+        if slots is None:
+            slots = int(self.header[_SLOTS])
+            shape = tuple(int(v) for v in self.header[_H:_C + 1])
+        self.slots = slots
+        self.shape = shape
+        offset = 8 * _HEADER
+        self.table = np.ndarray((slots, 4), np.int64, buf, offset)
+        offset += 8 * 4 * slots
+        self.meta = np.ndarray((slots, META), np.uint8, buf, offset)
+        offset += META * slots
+        self.frames = np.ndarray((slots,) + shape, np.uint8, buf, offset)
+
+    def _unmap(self):
+        # numpy views of the buffer have to go before the segment can be closed
+        self.header = self.table = self.meta = self.frames = None
+
+    @property
+    def head(self):
+        """Number of the last frame put in the ring, 0 if none."""
+        return int(self.header[_HEAD])
+
+    def put(self, frame, meta=None):
+        """Copy frame into the next slot, with a small JSON-able dict, returns its number."""
+        data = json.dumps(meta or {}, default=str).encode()
+        if len(data) > META:
+            raise ValueError("frame ring meta over %d bytes" % META)
+        with self.lock:
+            n = int(self.header[_HEAD]) + 1
+            slot = n % self.slots
+            seq = int(self.table[slot, _SEQ])
+            self.table[slot, _SEQ] = seq + 1
+            np.copyto(self.frames[slot], np.asarray(frame).reshape(self.shape))
+            self.meta[slot, :len(data)] = np.frombuffer(data, np.uint8)
+            self.table[slot, _NUM] = n
+            self.table[slot, _STAMP] = int(time.time() * 1e6)
+            self.table[slot, _LEN] = len(data)
+            self.table[slot, _SEQ] = seq + 2
+            self.header[_HEAD] = n
+        return n
+
+    def get(self, n=None, tries=3):
+        """(number, frame, meta, time) of frame n (default the latest), copied
+        out of the ring, or None if it has been overwritten or not put yet."""
+        for _ in range(tries):
+            m = self.head if n is None else n
+            if m <= 0:
+                return None
+            slot = m % self.slots
+            seq = int(self.table[slot, _SEQ])
+            if seq % 2 == 0 and int(self.table[slot, _NUM]) != m:
+                return None
+            if seq % 2 == 0:
+                frame = self.frames[slot].copy()
+                meta = bytes(self.meta[slot, :int(self.table[slot, _LEN])])
+                stamp = int(self.table[slot, _STAMP]) / 1e6
+                if int(self.table[slot, _SEQ]) == seq:
+                    if frame.shape[2] == 1:
+                        frame = frame[:, :, 0]
+                    return m, frame, json.loads(meta or b"{}"), stamp
+            time.sleep(0.001)
+        return None
+
+    def closed(self):
+        """True if the writer has replaced the segment, reopen to follow it."""
+        return int(self.header[_MAGIC]) != MAGIC
+
+    def writer_alive(self):
+        try:
+            os.kill(int(self.header[_PID]), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def close(self, unlink=False):
+        """Detach, the segment is left for the other process and the next run
+        unless unlink."""
+        if unlink and self.writer:
+            self.header[_MAGIC] = 0
+        self._unmap()
+        self.shm.close()
+        if unlink:
+            _unlink(self.shm)
+
+
+class EventSender:
+    """Sends events to a datagram socket, without ever waiting for its listener."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, kind, **fields):
+        """Returns False if the event was dropped (no listener, or its queue is full)."""
+        fields["type"] = kind
+        try:
+            self.sock.sendto(json.dumps(fields, default=str).encode(), self.path)
+        except OSError:
+            self.dropped += 1
+            return False
+        self.sent += 1
+        return True
+
+    def stats(self):
+        return {"sent": self.sent, "dropped": self.dropped}
+
+    def close(self):
+        self.sock.close()
+
+
+class EventListener:
+
+    def __init__(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        os.chmod(path, 0o600)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def poll(self, timeout=0.0):
+        """Events received, waiting up to timeout seconds for the first."""
+        events = []
+        if timeout and not select.select([self.sock], [], [], timeout)[0]:
+            return events
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return events
+            try:
+                events.append(json.loads(data))
+            except ValueError:
+                pass
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ApiClient:
+    """The control API of the capture process, with the Controller's methods.
+    They raise OSError if the capture process isn't running, or for a 503
+    (eg no USB drive), and ValueError for a bad request."""
+
+    def __init__(self, socket_path, timeout=5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, method, path, body=None):
+        conn = _UnixConnection(self.socket_path, self.timeout)
+        try:
+            data = json.dumps(body).encode() if body is not None else None
+            headers = {"Content-Type": "application/json"} if data is not None else {}
+            conn.request(method, path, data, headers)
+            r = conn.getresponse()
+            reply = json.loads(r.read() or b"null")
+        except http.client.HTTPException as e:
+            raise OSError("control API: %s" % e) from e
+        finally:
+            conn.close()
+        if r.status == 400:
+            raise ValueError(reply.get("error"))
+        if r.status >= 300:
+            raise OSError(reply.get("error") if isinstance(reply, dict) else r.reason)
+        return reply
+
+    def status(self):
+        return self.request("GET", "/status")
+
+    def settings(self):
+        return self.request("GET", "/settings")
+
+    def set(self, mode=None, speed=None, gain=None):
+        body = {k: v for k, v in (("mode", mode), ("speed", speed), ("gain", gain)) if v is not None}
+        return self.request("POST", "/settings", body)
+
+    def delete(self, stem):
+        try:
+            return self.request("DELETE", "/captures/" + stem)["deleted"] > 0
+        except OSError as e:
+            if "no capture" in str(e):
+                return False
+            raise
+
+    def delete_all(self):
+        return self.request("DELETE", "/captures")["deleted"]
+
+    def offload(self, stems=None):
+        return self.request("POST", "/offload", {"stems": stems} if stems is not None else {})["queued"]
+
+
+class Supervisor:
+    """Runs commands as child processes, restarting each one on its own when
+    it stops with an error, after a delay that doubles (up to backoff[1])
+    while it keeps stopping within healthy seconds."""
+
+    def __init__(self, commands, cwd=None, backoff=(1.0, 30.0), healthy=60.0):
+        """commands is {name: argv}."""
+        self.commands = dict(commands)
+        self.cwd = cwd
+        self.backoff = backoff
+        self.healthy = healthy
+        self.procs = {}
+        self.started = {}
+        self.delay = {name: backoff[0] for name in self.commands}
+        self.due = {}
+        self.restarts = {name: 0 for name in self.commands}
+        self.running = True
+
+    def _start(self, name, now):
+        print("Starting", name)
+        self.procs[name] = subprocess.Popen(self.commands[name], cwd=self.cwd)
+        self.started[name] = now
+
+    def start(self, now=None):
+        now = time.monotonic() if now is None else now
+        for name in self.commands:
+            self._start(name, now)
+        return self
+
+    def poll(self, now=None):
+        """Restart the children that are due, returns the names restarted."""
+        now = time.monotonic() if now is None else now
+        restarted = []
+        for name, proc in list(self.procs.items()):
+            if proc is None:
+                if now >= self.due[name]:
+                    self.restarts[name] += 1
+                    self._start(name, now)
+                    restarted.append(name)
+                continue
+            code = proc.poll()
+            if code is None:
+                continue
+            if code == 0:
+                # stopped on purpose, eg the review window was closed
+                print(name, "finished")
+                del self.procs[name]
+                continue
+            if now - self.started[name] >= self.healthy:
+                self.delay[name] = self.backoff[0]
+            print(name, "stopped (%d), restarting in %g s" % (code, self.delay[name]))
+            self.due[name] = now + self.delay[name]
+            self.delay[name] = min(self.delay[name] * 2, self.backoff[1])
+            self.procs[name] = None
+        return restarted
+
+    def status(self):
+        return {name: {"pid": proc.pid if proc is not None else None, "restarts": self.restarts[name]}
+                for name, proc in self.procs.items()}
+
+    def stop(self, timeout=10.0):
+        self.running = False
+        procs = [proc for proc in self.procs.values() if proc is not None]
+        for proc in procs:
+            proc.terminate()
+        end = time.monotonic() + timeout
+        for proc in procs:
+            try:
+                proc.wait(max(end - time.monotonic(), 0.1))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    def run(self, interval=0.5):
+        """Start the children and keep them running until SIGTERM/SIGINT or
+        they have all finished, returns an exit code."""
+        def stop(signum, frame):
+            self.running = False
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        self.start()
+        while self.running and self.procs:
+            time.sleep(interval)
+            self.poll()
+        self.stop()
+        return 0
+
+
+def _ui_work(ms):
+    """Pure Python work holding the GIL, like pygame scaling and font rendering."""
+    end = time.perf_counter() + ms / 1000
+    n = 0
+    while time.perf_counter() < end:
+        n += 1
+    return n
+
+
+def _ui_process(name, events, seconds, ms, every, read):
+    ring = None
+    listener = EventListener(events)
+    end = time.monotonic() + seconds
+    try:
+        while time.monotonic() < end:
+            for event in listener.poll(every):
+                if event["type"] == "trigger":
+                    if ring is None:
+                        ring = FrameRing(name)
+                    got = ring.get(event["n"])
+                    if got is not None and int(got[1][0, 0, 0]) == got[2]["check"]:
+                        read.value += 1
+            _ui_work(ms)
+    finally:
+        listener.close()
+        if ring is not None:
+            ring.close()
+
+
+def benchmark(seconds=4.0, fps=25, work_ms=8.0, ui_ms=20.0, ui_every=0.03, shape=(640, 640, 3)):
+    """Detection loop frame time (median, 95th percentile, worst) with review
+    window work: none, in a thread of this process, in a separate process."""
+    import multiprocessing
+    import tempfile
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, shape, dtype=np.uint8)
+    name = "wildlife_bench_%d" % os.getpid()
+    tmp = tempfile.TemporaryDirectory(prefix="wildlife_ipc_")
+    events = os.path.join(tmp.name, "ui.sock")
+    report = {}
+    for case in ("no ui", "ui thread", "ui process"):
+        stop = threading.Event()
+        read = multiprocessing.Value("i", 0)
+        ring = sender = worker = None
+        if case == "ui thread":
+            def ui():
+                while not stop.is_set():
+                    _ui_work(ui_ms)
+                    time.sleep(ui_every)
+            worker = threading.Thread(target=ui, daemon=True)
+            worker.start()
+        elif case == "ui process":
+            ring = FrameRing(name, shape, 4)
+            sender = EventSender(events)
+            worker = multiprocessing.get_context("fork").Process(
+                target=_ui_process, args=(name, events, seconds + 2, ui_ms, ui_every, read), daemon=True)
+            worker.start()
+            time.sleep(0.5)
+        times = []
+        sent = 0
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            start = time.perf_counter()
+            # numpy work, like the motion gate and decoding, then some Python
+            frame[::8, ::8].astype(np.int16).sum()
+            _ui_work(work_ms / 2)
+            if ring is not None and len(times) % fps == 0:
+                frame[0, 0, 0] = sent & 0xFF
+                n = ring.put(frame, {"check": sent & 0xFF})
+                sender.send("trigger", n=n)
+                sent += 1
+            times.append(time.perf_counter() - start)
+            time.sleep(max(1.0 / fps - (time.perf_counter() - start), 0))
+        stop.set()
+        if worker is not None:
+            worker.join(seconds + 5)
+        if ring is not None:
+            ring.close(unlink=True)
+            sender.close()
+        t = np.asarray(times) * 1000
+        report[case] = {"median_ms": float(np.median(t)), "p95_ms": float(np.percentile(t, 95)),
+                        "max_ms": float(t.max())}
+        if case == "ui process":
+            report[case]["frames_read"] = "%d/%d" % (read.value, sent)
+    tmp.cleanup()
+    return report
+
+
+if __name__ == "__main__":
+    for case, r in benchmark().items():
+        print("%-10s  frame time median %5.1f ms  95%% %5.1f ms  worst %5.1f ms  %s" %
+              (case, r["median_ms"], r["p95_ms"], r["max_ms"],
+               "ring frames read " + r["frames_read"] if "frames_read" in r else ""))
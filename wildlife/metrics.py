@@ -0,0 +1,204 @@
+"""Low overhead timing and counters for the detection loop.
+
+Stage timings go into fixed size ring buffers (the last 'size' samples, plus
+running totals), counters and gauges are plain numbers.  export() writes
+them as Prometheus text, start() can do that periodically and/or serve them
+on a localhost HTTP port, and a SIGUSR1 dumps a JSON snapshot including the
+stack of every thread, eg
+
+    kill -USR1 $(pgrep -f detect_002.py); cat /run/shm/wildlife_profile.json
+
+The main loop uses lap(): each call records the time since the previous one
+under the given stage name.
+"""
+
+import http.server
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+
+    def __init__(self, size=1024):
+        self.samples = np.zeros(size, dtype=np.float32)
+        self.pos = 0
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.samples[self.pos] = value
+        self.pos = (self.pos + 1) % len(self.samples)
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def recent(self):
+        return self.samples[:min(self.count, len(self.samples))]
+
+    def quantiles(self, qs=QUANTILES):
+        r = self.recent()
+        if len(r) == 0:
+            return [0.0 for _ in qs]
+        return np.quantile(r, qs).tolist()
+
+
+class Lap:
+    """Records the time since the previous call as a stage."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.t = time.perf_counter()
+
+    def __call__(self, stage):
+        now = time.perf_counter()
+        self.metrics.observe(stage, now - self.t)
+        self.t = now
+
+
+class Metrics:
+
+    def __init__(self, prefix="wildlife", size=1024):
+        self.prefix = prefix
+        self.size = size
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.collectors = []
+        self.started = time.time()
+        # reentrant, the SIGUSR1 snapshot runs in the main thread, which may be holding it
+        self.lock = threading.RLock()
+        self.server = None
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            h = self.stages.get(stage)
+            if h is None:
+                h = self.stages.setdefault(stage, Histogram(self.size))
+        h.observe(seconds)
+
+    def lap(self):
+        return Lap(self)
+
+    def inc(self, name, n=1):
+        # called from the main loop and the extra camera threads
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def collect(self, fn):
+        """fn() returns a {name: value} dict of gauges, called before each export."""
+        self.collectors.append(fn)
+
+    def _collect(self):
+        for fn in self.collectors:
+            try:
+                values = fn()
+            except Exception as e:
+                print("metrics collect", e)
+                continue
+            with self.lock:
+                self.gauges.update(values)
+
+    # export
+    def prometheus(self):
+        self._collect()
+        p = self.prefix
+        out = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            stages = sorted(self.stages.items())
+        for name, value in counters:
+            out.append("# TYPE %s_%s_total counter" % (p, name))
+            out.append("%s_%s_total %d" % (p, name, value))
+        for name, value in gauges:
+            out.append("# TYPE %s_%s gauge" % (p, name))
+            out.append("%s_%s %g" % (p, name, value))
+        out.append("# TYPE %s_stage_seconds summary" % p)
+        for stage, h in stages:
+            for q, v in zip(QUANTILES, h.quantiles()):
+                out.append('%s_stage_seconds{stage="%s",quantile="%g"} %.6f' % (p, stage, q, v))
+            out.append('%s_stage_seconds_sum{stage="%s"} %.6f' % (p, stage, h.sum))
+            out.append('%s_stage_seconds_count{stage="%s"} %d' % (p, stage, h.count))
+        out.append("# TYPE %s_uptime_seconds gauge" % p)
+        out.append("%s_uptime_seconds %.0f" % (p, time.time() - self.started))
+        return "\n".join(out) + "\n"
+
+    def export(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def snapshot(self, stacks=True):
+        self._collect()
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            stages = dict(self.stages)
+        snap = {"time": time.time(), "counters": counters, "gauges": gauges,
+                "stages": {s: {"count": h.count, "mean": h.sum / max(h.count, 1), "max": h.max,
+                               "quantiles": dict(zip(map(str, QUANTILES), h.quantiles()))}
+                           for s, h in stages.items()}}
+        if stacks:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            snap["threads"] = {names.get(ident, str(ident)): traceback.format_stack(frame)
+                               for ident, frame in sys._current_frames().items()}
+        return snap
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=1)
+
+    # background export
+    def start(self, path=None, port=0, interval=10, profile_path=None):
+        """Export to path every interval seconds, serve on 127.0.0.1:port if
+        port, and dump a snapshot to profile_path on SIGUSR1."""
+        if path:
+            def exporter():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        self.export(path)
+                    except OSError as e:
+                        print("metrics export", e)
+            threading.Thread(target=exporter, name="metrics", daemon=True).start()
+        if port:
+            metrics = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.startswith("/profile"):
+                        body = json.dumps(metrics.snapshot(), indent=1).encode()
+                        kind = "application/json"
+                    else:
+                        body = metrics.prometheus().encode()
+                        kind = "text/plain; version=0.0.4"
+                    self.send_response(200)
+                    self.send_header("Content-Type", kind)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+            threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+        if profile_path and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda *a: self.dump(profile_path))
+        return self
@@ -0,0 +1,115 @@
+"""Cheap motion gate in front of the Hailo inference.
+
+Each lores frame is subsampled and compared against a running average
+background.  Inference only runs while enough pixels differ, with hysteresis
+so it keeps running for hold frames after the motion stops, and at least
+once every min_interval seconds so a still animal is still seen.  Setting
+force (eg while recording) runs inference on every frame.
+
+"python3 -m wildlife.motion" replays synthetic frame sequences and reports the
+fraction of inference calls saved and the detection latency added.
+"""
+
+import time
+
+import numpy as np
+
+
+class MotionGate:
+
+    def __init__(self, step=8, alpha=0.05, pixel_thresh=20, on_frac=0.01, off_frac=0.004,
+                 hold=25, min_interval=2.0):
+        self.step = step
+        self.alpha = alpha
+        self.pixel_thresh = pixel_thresh
+        self.on_frac = on_frac
+        self.off_frac = off_frac
+        self.hold = hold
+        self.min_interval = min_interval
+        self.force = False
+        self.background = None
+        self.moving = False
+        self.quiet = 0
+        self.last_run = None
+        self.level = 0.0
+        self.frames = 0
+        self.inferred = 0
+
+    def small(self, frame):
+        """Subsampled grey image as float32."""
+        s = np.asarray(frame)[::self.step, ::self.step]
+        if s.ndim == 3:
+            s = s.mean(axis=2, dtype=np.float32)
+        return s.astype(np.float32, copy=False)
+
+    def check(self, frame, now=None):
+        """True if this frame should go to inference."""
+        now = time.monotonic() if now is None else now
+        self.frames += 1
+        s = self.small(frame)
+        if self.background is None or self.background.shape != s.shape:
+            self.background = s.copy()
+            self.level = 1.0
+        else:
+            diff = np.abs(s - self.background)
+            self.level = float(np.count_nonzero(diff > self.pixel_thresh)) / diff.size
+            self.background += self.alpha * (s - self.background)
+        if self.moving:
+            self.quiet = self.quiet + 1 if self.level < self.off_frac else 0
+            if self.quiet > self.hold:
+                self.moving = False
+        elif self.level > self.on_frac:
+            self.moving = True
+            self.quiet = 0
+        run = self.force or self.moving or self.last_run is None \
+            or now - self.last_run >= self.min_interval
+        if run:
+            self.last_run = now
+            self.inferred += 1
+        return run
+
+    __call__ = check
+
+    def saved(self):
+        """Fraction of frames that skipped inference."""
+        return 1.0 - self.inferred / max(self.frames, 1)
+
+
+def synthetic_frames(length=750, appear=None, shape=(640, 640, 3), seed=2):
+    """Noisy static scene with an 'animal' walking in at frame appear."""
+    rng = np.random.default_rng(seed)
+    scene = rng.integers(40, 200, shape, dtype=np.uint8)
+    for f in range(length):
+        frame = scene.copy()
+        # sensor noise and slow light changes
+        frame = np.clip(frame.astype(np.int16) + rng.integers(-6, 7, shape[:2])[:, :, None]
+                        + int(5 * np.sin(f / 200.0)), 0, 255).astype(np.uint8)
+        present = appear is not None and f >= appear
+        if present:
+            x = min(20 + 6 * (f - appear), shape[1] - 120)
+            frame[300:420, x:x + 100] = (150, 90, 30)
+        yield frame, present
+
+
+def replay(runs=4, length=750, fps=25, **kw):
+    """Saved inference fraction and mean added latency (ms) over runs."""
+    saved = []
+    delays = []
+    for r in range(runs):
+        appear = None if r % 2 else length // 2
+        gate = MotionGate(**kw)
+        seen = None
+        for f, (frame, present) in enumerate(synthetic_frames(length, appear, seed=r)):
+            if gate.check(frame, now=f / fps) and present and seen is None:
+                seen = f
+        saved.append(gate.saved())
+        if appear is not None and seen is not None:
+            delays.append(seen - appear)
+    return {"saved": float(np.mean(saved)),
+            "added_latency_ms": 1000.0 * float(np.mean(delays)) / fps if delays else 0.0}
+
+
+if __name__ == "__main__":
+    r = replay()
+    print("inference calls saved %4.1f%%, added latency %5.1f ms" %
+          (100 * r["saved"], r["added_latency_ms"]))
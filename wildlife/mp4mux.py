@@ -0,0 +1,402 @@
+"""Write the H.264 encoder output straight into fragmented MP4 files.
+
+Fmp4Writer turns Annex-B access units (as produced by H264Encoder with
+repeat=True, so every keyframe carries SPS/PPS) into an MP4 with an empty
+moov followed by one moof/mdat fragment per GOP, using the encoder
+timestamps.  A fragmented file is playable as soon as it is closed, and
+everything but the last GOP is playable even if recording is cut short.
+
+CircularMp4Output is a drop-in for picamera2's CircularOutput: it keeps the
+last buffersize frames in RAM and on start() writes them, from the first
+keyframe, followed by the live frames, into the MP4 named by fileoutput.
+The writes, and the fsync when the clip is closed, are done by a writer
+thread, so start() and stop() only queue work and don't wait for the SD
+card.  on_closed(path) is called from that thread once a clip is on disk.
+
+parse()/summary() read the boxes back for checking, "python3 -m
+wildlife.mp4mux" muxes synthetic access units and prints the summary.
+"""
+
+import collections
+import os
+import queue
+import struct
+import threading
+import time
+
+try:
+    from picamera2.outputs import Output
+except ImportError:
+    Output = object
+
+TIMESCALE = 90000
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+# trun sample flags
+SYNC_FLAGS = 0x02000000
+NON_SYNC_FLAGS = 0x01010000
+
+_MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def split_nals(data):
+    """NAL units of an Annex-B byte string, without start codes."""
+    data = bytes(data)
+    nals = []
+    i = data.find(b"\x00\x00\x01")
+    while i >= 0:
+        start = i + 3
+        j = data.find(b"\x00\x00\x01", start)
+        end = len(data) if j < 0 else j
+        # a 4 byte start code leaves a trailing zero on the previous unit
+        nal = data[start:end]
+        if j >= 0 and nal.endswith(b"\x00"):
+            nal = nal[:-1]
+        if nal:
+            nals.append(nal)
+        i = j
+    return nals
+
+
+def box(kind, *payload):
+    body = b"".join(payload)
+    return struct.pack(">I4s", 8 + len(body), kind) + body
+
+
+def full_box(kind, version, flags, *payload):
+    return box(kind, struct.pack(">I", (version << 24) | flags), *payload)
+
+
+def avcc(sps, pps):
+    out = struct.pack(">BBBBB", 1, sps[1], sps[2], sps[3], 0xFF)
+    out += struct.pack(">BH", 0xE1, len(sps)) + sps
+    out += struct.pack(">BH", 1, len(pps)) + pps
+    if sps[1] in (100, 110, 122, 144):
+        # 4:2:0, 8 bit, no SPS extensions
+        out += bytes([0xFD, 0xF8, 0xF8, 0])
+    return box(b"avcC", out)
+
+
+def init_segment(width, height, sps, pps, timescale=TIMESCALE):
+    """ftyp + moov for a single fragmented H.264 track."""
+    ftyp = box(b"ftyp", b"isom", struct.pack(">I", 0x200), b"isom", b"iso6", b"avc1", b"mp41")
+    mvhd = full_box(b"mvhd", 0, 0, struct.pack(">IIII", 0, 0, 1000, 0),
+                    struct.pack(">IH", 0x10000, 0x100), bytes(10), _MATRIX, bytes(24),
+                    struct.pack(">I", 2))
+    tkhd = full_box(b"tkhd", 0, 3, struct.pack(">IIIII", 0, 0, 1, 0, 0), bytes(8),
+                    struct.pack(">HHHH", 0, 0, 0, 0), _MATRIX,
+                    struct.pack(">II", width << 16, height << 16))
+    mdhd = full_box(b"mdhd", 0, 0, struct.pack(">IIII", 0, 0, timescale, 0),
+                    struct.pack(">HH", 0x55C4, 0))
+    hdlr = full_box(b"hdlr", 0, 0, struct.pack(">I4s", 0, b"vide"), bytes(12), b"VideoHandler\x00")
+    vmhd = full_box(b"vmhd", 0, 1, bytes(8))
+    dinf = box(b"dinf", full_box(b"dref", 0, 0, struct.pack(">I", 1), full_box(b"url ", 0, 1)))
+    avc1 = box(b"avc1", bytes(6), struct.pack(">H", 1), bytes(16),
+               struct.pack(">HHIIIH", width, height, 0x480000, 0x480000, 0, 1),
+               bytes(32), struct.pack(">Hh", 0x18, -1), avcc(sps, pps))
+    stbl = box(b"stbl", full_box(b"stsd", 0, 0, struct.pack(">I", 1), avc1),
+               full_box(b"stts", 0, 0, struct.pack(">I", 0)),
+               full_box(b"stsc", 0, 0, struct.pack(">I", 0)),
+               full_box(b"stsz", 0, 0, struct.pack(">II", 0, 0)),
+               full_box(b"stco", 0, 0, struct.pack(">I", 0)))
+    mdia = box(b"mdia", mdhd, hdlr, box(b"minf", vmhd, dinf, stbl))
+    mvex = box(b"mvex", full_box(b"trex", 0, 0, struct.pack(">IIIII", 1, 1, 0, 0, 0)))
+    return ftyp + box(b"moov", mvhd, box(b"trak", tkhd, mdia), mvex)
+
+
+def fragment(seq, base_time, samples):
+    """moof + mdat for [(avcc_bytes, duration, keyframe)] samples."""
+    trun_body = struct.pack(">I", len(samples)) + b"\x00\x00\x00\x00"
+    trun_body += b"".join(struct.pack(">III", d, len(data), SYNC_FLAGS if key else NON_SYNC_FLAGS)
+                          for data, d, key in samples)
+
+    def moof(offset):
+        trun = full_box(b"trun", 0, 0x000701, trun_body[:4], struct.pack(">i", offset), trun_body[8:])
+        traf = box(b"traf", full_box(b"tfhd", 0, 0x020000, struct.pack(">I", 1)),
+                   full_box(b"tfdt", 1, 0, struct.pack(">Q", base_time)), trun)
+        return box(b"moof", full_box(b"mfhd", 0, 0, struct.pack(">I", seq)), traf)
+
+    size = len(moof(0))
+    mdat = b"".join(data for data, _, _ in samples)
+    return moof(size + 8) + struct.pack(">I4s", 8 + len(mdat), b"mdat") + mdat
+
+
+class Fmp4Writer:
+
+    def __init__(self, file, width, height, fps=25, timescale=TIMESCALE):
+        """file is a path or a binary file object."""
+        self.own = isinstance(file, str)
+        self.file = open(file, "wb") if self.own else file
+        self.width = width
+        self.height = height
+        self.timescale = timescale
+        self.default = timescale // fps
+        self.started = False
+        self.seq = 0
+        self.t0 = None
+        self.base = 0
+        self.samples = []
+        self.last_ts = None
+        self.frames = 0
+        self.bytes = 0
+        # time spent in writes, flush and fsync, for the write throughput
+        self.write_seconds = 0.0
+
+    def _ticks(self, ts_us):
+        # strictly increasing, so every sample has a duration
+        t = (ts_us - self.t0) * self.timescale // 1000000
+        if self.samples:
+            t = max(t, self.samples[-1][1] + 1)
+        return max(t, self.base)
+
+    def add(self, au, keyframe, timestamp=None):
+        """Add one Annex-B access unit, timestamp in microseconds.
+        Frames before the first keyframe with SPS/PPS are dropped."""
+        nals = split_nals(au)
+        if not self.started:
+            if not keyframe:
+                return False
+            sps = next((n for n in nals if n[0] & 0x1F == NAL_SPS), None)
+            pps = next((n for n in nals if n[0] & 0x1F == NAL_PPS), None)
+            if sps is None or pps is None:
+                return False
+            self.file.write(init_segment(self.width, self.height, sps, pps, self.timescale))
+            self.started = True
+            self.t0 = timestamp if timestamp is not None else 0
+        if timestamp is None:
+            timestamp = (self.last_ts if self.last_ts is not None else self.t0) + \
+                1000000 * self.default // self.timescale
+        if keyframe and self.samples:
+            self._flush(self._ticks(timestamp))
+        data = b"".join(struct.pack(">I", len(n)) + n for n in nals
+                        if n[0] & 0x1F not in (NAL_SPS, NAL_PPS, NAL_AUD))
+        self.samples.append([data, self._ticks(timestamp), keyframe])
+        self.last_ts = timestamp
+        self.frames += 1
+        return True
+
+    def _flush(self, end):
+        samples = []
+        for i, (data, t, key) in enumerate(self.samples):
+            nxt = self.samples[i + 1][1] if i + 1 < len(self.samples) else end
+            samples.append((data, nxt - t, key))
+        self.seq += 1
+        frag = fragment(self.seq, self.base, samples)
+        t = time.perf_counter()
+        self.file.write(frag)
+        self.write_seconds += time.perf_counter() - t
+        self.bytes += len(frag)
+        self.base = end
+        self.samples = []
+
+    def close(self):
+        if self.samples:
+            last = self.samples[-1][1]
+            prev = self.samples[-2][1] if len(self.samples) > 1 else last - self.default
+            self._flush(last + max(last - prev, 1))
+        t = time.perf_counter()
+        self.file.flush()
+        if self.own:
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.write_seconds += time.perf_counter() - t
+
+
+class CircularMp4Output(Output):
+    """Pre-buffering output that records into fragmented MP4 files."""
+
+    def __init__(self, buffersize=125, width=1456, height=1088, fps=25, pts=None, on_closed=None):
+        if Output is not object:
+            super().__init__(pts=pts)
+        self.buffer = collections.deque(maxlen=buffersize)
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.on_closed = on_closed
+        self.lock = threading.Lock()
+        self.fileoutput = None
+        self.recording = False
+        # totals of closed clips, the last one may still be being written
+        self.written = 0
+        self.write_seconds = 0.0
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._writer, name="mp4writer", daemon=True)
+        self.thread.start()
+
+    def resize(self, buffersize):
+        """Keep buffersize frames before a trigger, eg when frames are skipped."""
+        with self.lock:
+            self.buffer = collections.deque(self.buffer, maxlen=buffersize)
+
+    def start(self):
+        """Start writing the buffered and live frames to self.fileoutput,
+        nothing if it isn't set, eg when the encoder is (re)started."""
+        with self.lock:
+            if self.fileoutput is None or self.recording:
+                return
+            self.jobs.put(("open", self.fileoutput, list(self.buffer)))
+            self.buffer.clear()
+            self.recording = True
+
+    def stop(self):
+        """Close the clip once its frames are written, see on_closed."""
+        with self.lock:
+            if self.recording:
+                self.recording = False
+                self.jobs.put(("close", None, None))
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        if audio:
+            return
+        with self.lock:
+            if self.recording:
+                self.jobs.put(("frame", None, (bytes(frame), keyframe, timestamp)))
+            else:
+                self.buffer.append((bytes(frame), keyframe, timestamp))
+
+    def _writer(self):
+        writer = None
+        path = None
+        while True:
+            kind, name, data = self.jobs.get()
+            try:
+                if kind == "open":
+                    path = name
+                    writer = Fmp4Writer(path, self.width, self.height, self.fps)
+                    for frame, keyframe, timestamp in data:
+                        writer.add(frame, keyframe, timestamp)
+                elif kind == "frame" and writer is not None:
+                    writer.add(*data)
+                elif kind == "close" and writer is not None:
+                    closing, writer = writer, None
+                    closing.close()
+                    with self.lock:
+                        self.written += closing.bytes
+                        self.write_seconds += closing.write_seconds
+                    if self.on_closed is not None:
+                        self.on_closed(path)
+            except Exception as e:
+                # a failed clip is dropped until the next start(), the writer carries on
+                print("Mp4 writer", path, e)
+                if writer is not None and kind != "close":
+                    try:
+                        writer.file.close()
+                    except OSError:
+                        pass
+                writer = None
+            finally:
+                self.jobs.task_done()
+
+    def wait(self):
+        """Wait until everything queued so far is written."""
+        self.jobs.join()
+
+
+# reading back
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"dinf", b"mvex", b"moof", b"traf"}
+
+
+def parse(data, offset=0, end=None):
+    """[(type, payload, children)] of the boxes in data."""
+    end = len(data) if end is None else end
+    out = []
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, offset)
+        if size < 8 or offset + size > end:
+            raise ValueError("bad box %r at %d" % (kind, offset))
+        payload = data[offset + 8:offset + size]
+        children = parse(data, offset + 8, offset + size) if kind in CONTAINERS else []
+        out.append((kind, payload, children))
+        offset += size
+    return out
+
+
+def find(boxes, *path):
+    for kind, payload, children in boxes:
+        if kind == path[0]:
+            if len(path) == 1:
+                return payload, children
+            found = find(children, *path[1:])
+            if found is not None:
+                return found
+    return None
+
+
+def summary(path):
+    """Check a fragmented MP4 written by Fmp4Writer and describe it."""
+    with open(path, "rb") as f:
+        data = f.read()
+    boxes = parse(data)
+    kinds = [b[0] for b in boxes]
+    if kinds[:2] != [b"ftyp", b"moov"]:
+        raise ValueError("expected ftyp, moov got %r" % kinds[:2])
+    tkhd, _ = find(boxes, b"moov", b"trak", b"tkhd")
+    width, height = struct.unpack_from(">II", tkhd, len(tkhd) - 8)
+    mdhd, _ = find(boxes, b"moov", b"trak", b"mdia", b"mdhd")
+    timescale = struct.unpack_from(">I", mdhd, 12)[0]
+    stsd, _ = find(boxes, b"moov", b"trak", b"mdia", b"minf", b"stbl", b"stsd")
+    if b"avcC" not in stsd:
+        raise ValueError("no avcC")
+    frags = samples = keyframes = 0
+    duration = 0
+    expected = 0
+    pos = 0
+    for i, (kind, payload, children) in enumerate(boxes):
+        start = pos
+        pos += len(payload) + 8
+        if kind != b"moof":
+            continue
+        frags += 1
+        tfdt, _ = find(children, b"traf", b"tfdt")
+        base = struct.unpack_from(">Q", tfdt, 4)[0]
+        if base != expected:
+            raise ValueError("fragment %d starts at %d, expected %d" % (frags, base, expected))
+        trun, _ = find(children, b"traf", b"trun")
+        count, offset = struct.unpack_from(">Ii", trun, 4)
+        mdat_kind = boxes[i + 1][0] if i + 1 < len(boxes) else None
+        if mdat_kind != b"mdat" or offset != len(payload) + 16:
+            raise ValueError("fragment %d data offset" % frags)
+        total = 0
+        for s in range(count):
+            d, size, flags = struct.unpack_from(">III", trun, 12 + 12 * s)
+            duration += d
+            total += size
+            keyframes += flags == SYNC_FLAGS
+        if total != len(boxes[i + 1][1]):
+            raise ValueError("fragment %d sample sizes" % frags)
+        samples += count
+        expected = duration
+    return {"width": width >> 16, "height": height >> 16, "fragments": frags,
+            "samples": samples, "keyframes": keyframes, "seconds": duration / timescale}
+
+
+def synthetic_stream(frames=125, gop=25, fps=25, size=2000, t0=1000000):
+    """(access unit, keyframe, timestamp_us) tuples shaped like H264Encoder output."""
+    sps = b"\x67\x64\x00\x28\xac\xd9\x40\x5b\x04\x5a\x10"
+    pps = b"\x68\xeb\xe3\xcb\x22\xc0"
+    for n in range(frames):
+        key = n % gop == 0
+        if key:
+            au = b"\x00\x00\x00\x01" + sps + b"\x00\x00\x00\x01" + pps + b"\x00\x00\x00\x01\x65" + bytes(size)
+        else:
+            au = b"\x00\x00\x00\x01\x41" + bytes(size // 4)
+        yield au, key, t0 + n * 1000000 // fps
+
+
+if __name__ == "__main__":
+    import tempfile
+    tmp = tempfile.TemporaryDirectory(prefix="wildlife_mp4mux_")
+    out = CircularMp4Output(buffersize=125, width=1456, height=1088)
+    stream = list(synthetic_stream(frames=300))
+    for au, key, ts in stream[:140]:
+        out.outputframe(au, key, ts)
+    out.fileoutput = os.path.join(tmp.name, "test.mp4")
+    out.start()
+    for au, key, ts in stream[140:]:
+        out.outputframe(au, key, ts)
+    out.stop()
+    out.wait()
+    print(out.fileoutput, summary(out.fileoutput))
+    tmp.cleanup()
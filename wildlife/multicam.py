@@ -0,0 +1,287 @@
+"""Several cameras sharing one Hailo.
+
+SharedDevice puts a round-robin scheduler in front of one inference device.
+Each camera gets a lane, which looks like the device (run, run_async,
+get_input_shape) so a Pipeline can use it unchanged.  Queued requests are
+dispatched one lane at a time in turn, with up to in_flight on the device,
+so a camera with a busy scene can't starve the others, and each lane counts
+its fps and the time its requests waited.
+
+CameraUnit runs one camera's pipeline, trigger state and recording in its
+own thread.  detect_002.py keeps camera 0 in its main loop, with the review
+window, and runs a CameraUnit for each extra camera.
+
+"python3 -m wildlife.multicam" runs 1 to 3 replay cameras on one stand-in
+Hailo and prints the fps of each.
+"""
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+from . import decode
+from .pipeline import Closed, Pipeline
+
+
+class Lane:
+    """One camera's view of a SharedDevice."""
+
+    def __init__(self, shared, name):
+        self.shared = shared
+        self.name = name
+        self.pending = collections.deque()
+        self.submitted = 0
+        self.completed = 0
+        self.waited = 0.0
+        self.started = time.monotonic()
+
+    def run_async(self, frame):
+        future = concurrent.futures.Future()
+        self.shared._enqueue(self, (frame, future, time.monotonic()))
+        return future
+
+    def run(self, frame):
+        return self.run_async(frame).result()
+
+    def get_input_shape(self):
+        return self.shared.device.get_input_shape()
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {"fps": self.completed / elapsed, "inferred": self.completed,
+                "wait_ms": 1000 * self.waited / max(self.submitted, 1)}
+
+
+class SharedDevice:
+
+    def __init__(self, device, in_flight=2):
+        self.device = device
+        self.in_flight = in_flight
+        self.lanes = []
+        self.turn = 0
+        self.running = 0
+        self.busy = 0.0
+        self.started = time.monotonic()
+        self.closed = False
+        self.cond = threading.Condition()
+        self.pool = None
+        if not hasattr(device, "run_async"):
+            self.pool = concurrent.futures.ThreadPoolExecutor(in_flight, "hailo")
+        self.thread = threading.Thread(target=self._dispatcher, name="hailo-share", daemon=True)
+        self.thread.start()
+
+    def lane(self, name):
+        with self.cond:
+            lane = Lane(self, name)
+            self.lanes.append(lane)
+            return lane
+
+    def _enqueue(self, lane, request):
+        with self.cond:
+            lane.pending.append(request)
+            self.cond.notify_all()
+
+    def _next(self):
+        """The oldest request of the next lane in turn that has one."""
+        n = len(self.lanes)
+        for i in range(n):
+            lane = self.lanes[(self.turn + i) % n]
+            if lane.pending:
+                self.turn = (self.turn + i + 1) % n
+                return lane, lane.pending.popleft()
+        return None
+
+    def _dispatcher(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or
+                                   (self.running < self.in_flight and any(l.pending for l in self.lanes)))
+                if self.closed:
+                    return
+                lane, (frame, future, queued) = self._next()
+                self.running += 1
+            start = time.monotonic()
+            lane.submitted += 1
+            lane.waited += start - queued
+            if self.pool is not None:
+                inner = self.pool.submit(self.device.run, frame)
+            else:
+                inner = self.device.run_async(frame)
+            inner.add_done_callback(lambda f, lane=lane, future=future, start=start:
+                                    self._done(lane, future, start, f))
+
+    def _done(self, lane, future, start, inner):
+        with self.cond:
+            self.running -= 1
+            self.busy += time.monotonic() - start
+            lane.completed += 1
+            self.cond.notify_all()
+        try:
+            future.set_result(inner.result())
+        except Exception as e:
+            future.set_exception(e)
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        s = {lane.name: lane.stats() for lane in self.lanes}
+        s["duty"] = self.busy / elapsed / self.in_flight
+        return s
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+
+class CameraUnit(threading.Thread):
+    """Pipeline, trigger state and recording of one camera."""
+
+    def __init__(self, name, camera, device, output, thresholds, v_length=5, stream="lores",
+                 in_flight=1, gate=None, tracker=None, start_clip=None, stop_clip=None, on_frame=None,
+                 pool=False, mapped=None):
+        """output is the camera's encoder output (fileoutput, start(), stop()).
+        thresholds is a decode.class_thresholds() table, or a function(dets)
+        returning the detections that can trigger, eg policy.Policy.apply.
+        start_clip(unit, frame, hit) returns the file to record to, or None
+        not to record, stop_clip(unit, path) is called when a clip is done
+        and on_frame(unit, item, dets) after every frame.  pool and mapped
+        are passed to the Pipeline, frames are then only valid in the callbacks."""
+        super().__init__(name="camera-" + name, daemon=True)
+        self.unit = name
+        self.camera = camera
+        self.output = output
+        self.thresholds = thresholds
+        self.v_length = v_length
+        self.gate = gate
+        self.tracker = tracker
+        self.start_clip = start_clip
+        self.stop_clip = stop_clip
+        self.on_frame = on_frame
+        self.pipe = Pipeline(camera, device, stream, in_flight, gate=gate, pool=pool, mapped=mapped)
+        self.running = True
+        self.encoding = False
+        self.startrec = 0.0
+        self.clip = None
+        self.triggers = 0
+        self.clips = 0
+        self.error = None
+
+    def step(self, item, now=None):
+        """Trigger and record on one inferred frame, returns its detections."""
+        now = time.monotonic() if now is None else now
+        dets = decode.decode(item.results[0]) if item.results is not None else decode.EMPTY
+        if callable(self.thresholds):
+            hits = self.thresholds(dets)
+        else:
+            hits = decode.select(dets, self.thresholds)
+        hits = hits[hits["score"] < 1]
+        hit = decode.best(hits)
+        triggered = hit is not None
+        if self.tracker is not None:
+            # frames the gate skipped aren't misses
+            if item.results is not None:
+                triggered = len(self.tracker.update(hits)) > 0 or self.tracker.active()
+            else:
+                triggered = self.tracker.active()
+        if triggered:
+            self.startrec = now
+            if not self.encoding and hit is not None:
+                path = self.start_clip(self, item.frame, hit) if self.start_clip else None
+                if path:
+                    self.output.fileoutput = path
+                    self.output.start()
+                    self.encoding = True
+                    self.clip = path
+                    self.triggers += 1
+        if self.gate is not None:
+            self.gate.force = self.encoding
+        if self.on_frame is not None:
+            self.on_frame(self, item, dets)
+        if self.encoding and now - self.startrec > self.v_length:
+            self._stop_recording()
+        return dets
+
+    def _stop_recording(self):
+        self.output.stop()
+        self.encoding = False
+        self.clips += 1
+        if self.stop_clip is not None:
+            self.stop_clip(self, self.clip)
+
+    def run(self):
+        self.pipe.start()
+        try:
+            while self.running:
+                try:
+                    item = self.pipe.get(timeout=1)
+                except Closed as e:
+                    # a stage failed, recorded below
+                    if e.__cause__ is not None:
+                        raise
+                    break
+                if item is not None:
+                    self.step(item)
+                elif self.encoding and time.monotonic() - self.startrec > self.v_length:
+                    self._stop_recording()
+        except Exception as e:
+            self.error = e
+            print("Camera", self.unit, e)
+        finally:
+            self.pipe.stop()
+            if self.encoding:
+                self._stop_recording()
+
+    def stop(self, timeout=5):
+        self.running = False
+        self.join(timeout)
+
+    def stats(self):
+        s = self.pipe.stats()
+        s.update(triggers=self.triggers, clips=self.clips, encoding=self.encoding)
+        return s
+
+
+def measure(cameras=2, seconds=5.0, latency=0.02, fps=25, in_flight=2):
+    """Per-camera fps with replay cameras sharing one stand-in Hailo."""
+    import os
+    import tempfile
+    from . import replay
+    replay.setup("synthetic", fps=fps, latency=latency, appear=50)
+    tmp = tempfile.TemporaryDirectory(prefix="wildlife_multicam_")
+    out = tmp.name
+    shared = SharedDevice(replay.Hailo(), in_flight)
+    thresholds = decode.class_thresholds(replay.NUM_CLASSES, [replay.ANIMAL_CLASS], 0.5)
+    units = []
+    for n in range(cameras):
+        cam = replay.Picamera2(n)
+        cam.configure(cam.create_preview_configuration({"size": (1456, 1088), "format": "XRGB8888"},
+                                                       lores={"size": (640, 640), "format": "RGB888"},
+                                                       controls={"FrameRate": fps}))
+        encoder = replay.H264Encoder(2000000)
+        encoder.output = replay.CircularOutput()
+        cam.start()
+        cam.start_encoder(encoder)
+        units.append(CameraUnit("cam%d" % n, cam, shared.lane("cam%d" % n), encoder.output, thresholds,
+                                v_length=1, in_flight=1,
+                                start_clip=lambda u, frame, hit: os.path.join(out, "%s_%d.h264" % (u.unit, u.triggers))))
+    for unit in units:
+        unit.start()
+    time.sleep(seconds)
+    for unit in units:
+        unit.stop()
+    shared.close()
+    tmp.cleanup()
+    s = shared.stats()
+    return {unit.unit: {"fps": unit.stats()["fps"], "inferred": s[unit.unit]["inferred"],
+                        "wait_ms": s[unit.unit]["wait_ms"], "clips": unit.clips} for unit in units}, s["duty"]
+
+
+if __name__ == "__main__":
+    for n in (1, 2, 3):
+        per_camera, duty = measure(cameras=n)
+        print("%d camera(s), hailo duty %3.0f%%  " % (n, 100 * duty) +
+              "  ".join("%s %5.1f fps (wait %4.1f ms, %d clips)" % (name, s["fps"], s["wait_ms"], s["clips"])
+                        for name, s in per_camera.items()))
@@ -0,0 +1,198 @@
+"""Background, resumable, checksummed moves of captures to a USB drive.
+
+queue() adds files to a small JSON journal and a worker thread copies them in
+batches to a temporary name on the drive, throttled to rate bytes/second so
+SD card reads don't starve the encoder.  Each copy is fsynced, renamed,
+checked against the SHA-256 of the source taken while reading, and only then
+is the source deleted.  If the drive is pulled or the process restarts the
+journal is picked up again: partial copies are redone, verified copies just
+have their source deleted.
+
+Works between any two folders, eg two temporary directories.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+QUEUED = "queued"
+COPIED = "copied"
+ERROR = "error"
+
+
+def sha256(path, chunk=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class OffloadEngine:
+
+    def __init__(self, journal, rate=8 * 1024 * 1024, chunk=256 * 1024, batch=8,
+                 retry_delay=10, on_moved=None):
+        """on_moved(src, dest) is called after each file is moved."""
+        self.journal = journal
+        self.rate = rate
+        self.chunk = chunk
+        self.batch = batch
+        self.retry_delay = retry_delay
+        self.on_moved = on_moved
+        self.jobs = []
+        self.lock = threading.Condition()
+        self.current = None
+        self.moved = 0
+        self.moved_bytes = 0
+        self.error = None
+        self._load()
+        self.thread = threading.Thread(target=self._worker, name="offload", daemon=True)
+        self.thread.start()
+
+    # journal
+    def _load(self):
+        try:
+            with open(self.journal, "r") as f:
+                self.jobs = json.load(f)
+        except (OSError, ValueError):
+            self.jobs = []
+        for job in self.jobs:
+            if job["state"] == ERROR:
+                job["state"] = QUEUED
+
+    def _save(self):
+        tmp = self.journal + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.jobs, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal)
+
+    def _try_save(self):
+        # in the worker, a journal that can't be written (card full, drive pulled)
+        # mustn't stop the moves, the next save catches up
+        try:
+            self._save()
+        except OSError as e:
+            print("Offload journal", e)
+
+    # public
+    def queue(self, files):
+        """Queue (source path, destination folder) pairs."""
+        with self.lock:
+            known = {j["src"] for j in self.jobs}
+            for src, dest in files:
+                if src not in known and os.path.exists(src):
+                    self.jobs.append({"src": src, "dest": dest, "size": os.path.getsize(src),
+                                      "sha": None, "state": QUEUED})
+            self._save()
+            self.error = None
+            self.lock.notify_all()
+
+    def pending(self):
+        with self.lock:
+            return len(self.jobs)
+
+    def progress(self):
+        with self.lock:
+            left = sum(j["size"] for j in self.jobs)
+            return {"files_left": len(self.jobs), "bytes_left": left, "moved": self.moved,
+                    "moved_bytes": self.moved_bytes, "current": self.current,
+                    "error": self.error}
+
+    def wait(self, timeout=None):
+        """Wait until the queue is empty, returns True if it is."""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.jobs:
+                left = None if end is None else end - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self.lock.wait(1 if left is None else min(left, 1))
+        return True
+
+    # worker
+    def _copy(self, job):
+        """Throttled copy to a temporary name, returns the source SHA-256."""
+        dest = os.path.join(job["dest"], os.path.basename(job["src"]))
+        part = dest + ".part"
+        os.makedirs(job["dest"], exist_ok=True)
+        h = hashlib.sha256()
+        start = time.monotonic()
+        done = 0
+        with open(job["src"], "rb") as fi, open(part, "wb") as fo:
+            for block in iter(lambda: fi.read(self.chunk), b""):
+                h.update(block)
+                fo.write(block)
+                done += len(block)
+                ahead = done / self.rate - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+            fo.flush()
+            os.fsync(fo.fileno())
+        os.replace(part, dest)
+        dfd = os.open(job["dest"], os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+        return h.hexdigest()
+
+    def _move(self, job):
+        dest = os.path.join(job["dest"], os.path.basename(job["src"]))
+        if job["state"] != COPIED or not os.path.exists(dest):
+            job["sha"] = self._copy(job)
+            job["state"] = COPIED
+            with self.lock:
+                self._save()
+        if sha256(dest) != job["sha"]:
+            os.remove(dest)
+            job["state"] = QUEUED
+            raise OSError("checksum mismatch " + dest)
+        os.remove(job["src"])
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                while not self.jobs or self.error is not None:
+                    self.lock.wait(self.retry_delay)
+                    if self.error is not None and self.jobs:
+                        # retry after a failure, eg the drive was re-inserted
+                        self.error = None
+                batch = self.jobs[:self.batch]
+            for job in batch:
+                if not os.path.exists(job["src"]):
+                    # already moved, or deleted by the user
+                    if job["state"] != COPIED:
+                        self._finish(job, moved=False)
+                        continue
+                self.current = os.path.basename(job["src"])
+                try:
+                    if os.path.exists(job["src"]):
+                        self._move(job)
+                except OSError as e:
+                    print("Offload", job["src"], e)
+                    with self.lock:
+                        self.error = str(e)
+                        self._try_save()
+                    break
+                self._finish(job, moved=True)
+            self.current = None
+
+    def _finish(self, job, moved):
+        if moved and self.on_moved is not None:
+            try:
+                self.on_moved(job["src"], os.path.join(job["dest"], os.path.basename(job["src"])))
+            except Exception as e:
+                # the file has moved, a bookkeeping error mustn't stop the moves after it
+                print("Offload", job["src"], "moved, but", repr(e))
+        with self.lock:
+            if job in self.jobs:
+                self.jobs.remove(job)
+            if moved:
+                self.moved += 1
+                self.moved_bytes += job["size"]
+            self._try_save()
+            self.lock.notify_all()
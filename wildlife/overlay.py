@@ -0,0 +1,127 @@
+"""Timestamp and detection box overlay for the main (video) stream.
+
+The timestamp only changes once a second, so Overlay renders it, with its
+black background, into a small patch plus mask when the second changes and
+each frame just copies that patch into its corner of the mapped buffer.
+Detection boxes are drawn in the same call, so both overlays can be on at
+once for the price of one pre_callback.
+
+Run "python3 -m wildlife.overlay" for a per-frame micro-benchmark against
+the old apply_timestamp/draw_objects callbacks at 1456x1088.
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+TIME_FORMAT = "%Y/%m/%d %T"
+BOX_COLOUR = (0, 255, 0, 0)
+
+
+class Overlay:
+
+    def __init__(self, origin, font=cv2.FONT_HERSHEY_SIMPLEX, scale=1, colour=(255, 255, 255),
+                 thickness=2, timestamp=True, boxes=False):
+        """origin is the text baseline, as for cv2.putText."""
+        self.origin = origin
+        self.font = font
+        self.scale = scale
+        self.colour = colour
+        self.thickness = thickness
+        self.timestamp = timestamp
+        self.boxes = boxes
+        # [(label, (x0, y0, x1, y1), score)] in main stream pixels, set by the main loop
+        self.detections = None
+        self.second = None
+        self.region = None
+        self.patch = None
+        self.mask = None
+        self.renders = 0
+
+    def _region(self, shape):
+        """Rows and columns covered by the timestamp and its background."""
+        (w, h), baseline = cv2.getTextSize(time.strftime(TIME_FORMAT, time.gmtime(0)),
+                                           self.font, self.scale, self.thickness)
+        x, y = self.origin
+        y0 = max(min(y - 20, y - h - self.thickness), 0)
+        y1 = min(y + baseline + self.thickness, shape[0])
+        x1 = min(x + max(365, w + self.thickness) + 1, shape[1])
+        return slice(y0, y1), slice(max(x, 0), x1)
+
+    def _render(self, second, shape, dtype):
+        if self.region is None:
+            self.region = self._region(shape)
+        rows, cols = self.region
+        size = (rows.stop - rows.start, cols.stop - cols.start)
+        self.patch = np.zeros(size + shape[2:], dtype)
+        mask = np.zeros(size, np.uint8)
+        x, y = self.origin[0] - cols.start, self.origin[1] - rows.start
+        cv2.rectangle(mask, (x, y), (x + 365, y - 20), 255, -1)
+        text = time.strftime(TIME_FORMAT, time.localtime(second))
+        cv2.putText(self.patch, text, (x, y), self.font, self.scale, self.colour, self.thickness)
+        cv2.putText(mask, text, (x, y), self.font, self.scale, 255, self.thickness)
+        self.mask = (mask > 0)[..., None] if len(shape) > 2 else mask > 0
+        self.second = second
+        self.renders += 1
+
+    def draw(self, array, now=None):
+        """Draw the overlays onto one frame, array is the mapped main buffer."""
+        if self.timestamp:
+            second = int(time.time() if now is None else now)
+            if second != self.second:
+                self._render(second, array.shape, array.dtype)
+            rows, cols = self.region
+            np.copyto(array[rows, cols], self.patch, where=self.mask)
+        current = self.detections
+        if self.boxes and current:
+            for class_name, (x0, y0, x1, y1), score in current:
+                cv2.rectangle(array, (x0, y0), (x1, y1), BOX_COLOUR, 2)
+                cv2.putText(array, "%s %%%d" % (class_name, int(score * 100)), (x0 + 5, y0 + 15),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, BOX_COLOUR, 1, cv2.LINE_AA)
+
+    def reset(self):
+        """Re-render on the next frame, eg after changing origin or colour."""
+        self.second = None
+        self.region = None
+
+
+# the callbacks detect_002.py used before, for the benchmark
+def _legacy_timestamp(array, origin, font, scale, colour, thickness):
+    timestamp = time.strftime(TIME_FORMAT)
+    end_point = (origin[0] + 365, origin[1] - 20)
+    cv2.rectangle(array, origin, end_point, (0, 0, 0), -1)
+    cv2.putText(array, timestamp, origin, font, scale, colour, thickness)
+
+
+def _legacy_objects(array, detections):
+    for class_name, bbox, score in detections:
+        x0, y0, x1, y1 = bbox
+        label = f"{class_name} %{int(score * 100)}"
+        cv2.rectangle(array, (x0, y0), (x1, y1), (0, 255, 0, 0), 2)
+        cv2.putText(array, label, (x0 + 5, y0 + 15),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0, 0), 1, cv2.LINE_AA)
+
+
+def benchmark(frames=1000, width=1456, height=1088):
+    """Per-frame callback cost of the old and new overlays, returns {name: usec}."""
+    import timeit
+    array = np.zeros((height, width, 4), np.uint8)
+    origin = (10, height - 50)
+    args = (origin, cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    detections = [("bird", (200, 150, 420, 380), 0.91), ("cat", (700, 500, 1100, 900), 0.66),
+                  ("bear", (30, 40, 300, 260), 0.55)]
+    stamp_only = Overlay(origin)
+    both = Overlay(origin, boxes=True)
+    both.detections = detections
+    cases = {"timestamp/legacy": lambda: _legacy_timestamp(array, *args),
+             "timestamp/overlay": lambda: stamp_only.draw(array),
+             # before, show_detects replaced the timestamp callback, so "both" cost two callbacks
+             "both/legacy": lambda: (_legacy_timestamp(array, *args), _legacy_objects(array, detections)),
+             "both/overlay": lambda: both.draw(array)}
+    return {name: timeit.timeit(fn, number=frames) / frames * 1e6 for name, fn in cases.items()}
+
+
+if __name__ == "__main__":
+    for key, usec in benchmark().items():
+        print("%-18s %8.1f us/frame" % (key, usec))
@@ -0,0 +1,371 @@
+"""Capture -> inference -> consumer pipeline joined by bounded queues.
+
+The capture thread pulls lores frames from the camera, the inference stage
+keeps up to in_flight hailo requests running, and the main loop consumes
+(frame, results) pairs for the trigger / UI work.  An optional gate(frame)
+callable can skip inference, skipped frames are still passed on with results
+None so the consumer keeps running.  A stage that fails, the camera or
+max_failures inferences in a row, stops the pipeline and get() raises Closed
+from its error, so the caller can stop and be restarted.  A slow consumer or a slow
+accelerator no longer stalls capture, frames are dropped instead and the drops
+are counted.
+
+With pool set, frames are copied out of the camera's mapped request buffers
+(capture_request() and a MappedArray class) into a FramePool of preallocated
+arrays instead of capture_array() allocating a new one every frame.  A
+pooled frame goes back to the pool when it is dropped or when the consumer
+calls get() again, so the consumer must copy a frame it wants to keep.
+
+The camera only needs capture_array(stream) and the device run(frame), plus
+run_async(frame) returning a Future if it has one, so stand-ins can be used to
+measure fps and latency on any Linux box: "python3 -m wildlife.pipeline".
+"""
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+
+Frame = collections.namedtuple("Frame", "seq captured frame results inferred")
+
+
+class Closed(Exception):
+    """Raised by FrameQueue.get() once the queue is closed and empty."""
+
+
+class FrameQueue:
+    """Bounded queue that either drops its oldest item or blocks when full."""
+
+    def __init__(self, maxsize, policy=DROP_OLDEST, on_drop=None):
+        """on_drop(item) is called with every item dropped or not queued."""
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError("unknown queue policy " + repr(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.put_count = 0
+        self.dropped = 0
+
+    def put(self, item, timeout=None):
+        """Queue item, returns False if it could not be queued."""
+        dropped = item
+        with self.cond:
+            if self.closed:
+                queued = False
+            elif len(self.items) < self.maxsize:
+                queued = True
+            elif self.policy == DROP_OLDEST:
+                dropped = self.items.popleft()
+                self.dropped += 1
+                queued = True
+            elif not self.cond.wait_for(lambda: self.closed or len(self.items) < self.maxsize, timeout) \
+                    or self.closed:
+                self.dropped += 1
+                queued = False
+            else:
+                queued = True
+            if queued:
+                self.items.append(item)
+                self.put_count += 1
+                self.cond.notify_all()
+        if self.on_drop is not None and (dropped is not item or not queued):
+            self.on_drop(dropped)
+        return queued
+
+    def get(self, timeout=None):
+        """Next item, None on timeout, raises Closed when closed and drained."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items or self.closed, timeout):
+                return None
+            if not self.items:
+                raise Closed()
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class FramePool:
+    """Up to count preallocated frame arrays, made as the first frames
+    arrive.  acquire() allocates a one-off array when they are all in use."""
+
+    def __init__(self, count):
+        self.count = count
+        self.free = []
+        # the pool's arrays by id, kept referenced so an id can't be reused
+        self.owned = {}
+        self.lock = threading.Lock()
+        self.allocated = 0
+        self.reused = 0
+
+    def acquire(self, shape, dtype=np.uint8):
+        with self.lock:
+            while self.free:
+                buf = self.free.pop()
+                if buf.shape == tuple(shape) and buf.dtype == dtype:
+                    self.reused += 1
+                    return buf
+                # the stream was reconfigured
+                del self.owned[id(buf)]
+            self.allocated += 1
+            buf = np.empty(shape, dtype)
+            if len(self.owned) < self.count:
+                self.owned[id(buf)] = buf
+            return buf
+
+    def release(self, buf):
+        if buf is not None and self.owned.get(id(buf)) is buf:
+            with self.lock:
+                self.free.append(buf)
+
+    def stats(self):
+        return {"pool_allocated": self.allocated, "pool_reused": self.reused}
+
+
+class CaptureStage(threading.Thread):
+    """Pulls frames from camera.capture_array(stream), or copies them from
+    mapped request buffers into pool arrays, into a FrameQueue."""
+
+    def __init__(self, camera, out_q, stream="lores", pool=None, mapped=None):
+        super().__init__(name="capture", daemon=True)
+        self.camera = camera
+        self.out_q = out_q
+        self.stream = stream
+        self.pool = pool if mapped is not None and hasattr(camera, "capture_request") else None
+        self.mapped = mapped
+        self.running = True
+        self.seq = 0
+        self.error = None
+
+    def _capture_into_pool(self):
+        request = self.camera.capture_request()
+        try:
+            with self.mapped(request, self.stream) as m:
+                frame = self.pool.acquire(m.array.shape, m.array.dtype)
+                np.copyto(frame, m.array)
+        finally:
+            request.release()
+        return frame
+
+    def run(self):
+        try:
+            while self.running and not self.out_q.closed:
+                if self.pool is not None:
+                    frame = self._capture_into_pool()
+                else:
+                    frame = self.camera.capture_array(self.stream)
+                self.seq += 1
+                self.out_q.put(Frame(self.seq, time.monotonic(), frame, None, None))
+        except Exception as e:
+            print("Capture", repr(e))
+            self.error = e
+        finally:
+            self.out_q.close()
+
+
+class InferenceStage(threading.Thread):
+    """Runs device inference with up to in_flight requests outstanding."""
+
+    def __init__(self, device, in_q, out_q, in_flight=2, gate=None, on_drop=None, max_failures=10):
+        """After max_failures inferences in a row fail the stage stops."""
+        super().__init__(name="inference", daemon=True)
+        self.device = device
+        self.gate = gate
+        self.on_drop = on_drop
+        self.skipped = 0
+        self.in_q = in_q
+        self.out_q = out_q
+        self.slots = threading.Semaphore(in_flight)
+        self.in_flight = in_flight
+        self.pool = None
+        if not hasattr(device, "run_async"):
+            self.pool = concurrent.futures.ThreadPoolExecutor(in_flight, "hailo")
+        self.inferred = 0
+        self.busy = 0.0
+        self.max_failures = max_failures
+        self.failures = 0
+        self.error = None
+
+    def _submit(self, frame):
+        if self.pool is not None:
+            return self.pool.submit(self.device.run, frame)
+        return self.device.run_async(frame)
+
+    def _done(self, item, start, future):
+        try:
+            results = future.result()
+            self.failures = 0
+        except Exception as e:
+            print("Inference", repr(e))
+            self.error = e
+            self.failures += 1
+            if self.failures == self.max_failures:
+                print("Inference failed %d times in a row, stopping" % self.failures)
+                self.in_q.close()
+            results = None
+        finally:
+            self.slots.release()
+        now = time.monotonic()
+        self.busy += now - start
+        self.inferred += 1
+        if results is not None:
+            self.out_q.put(item._replace(results=results, inferred=now))
+        elif self.on_drop is not None:
+            self.on_drop(item)
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    item = self.in_q.get()
+                except Closed:
+                    break
+                if self.gate is not None and not self.gate(item.frame):
+                    self.skipped += 1
+                    self.out_q.put(item)
+                    continue
+                self.slots.acquire()
+                start = time.monotonic()
+                future = self._submit(item.frame)
+                future.add_done_callback(lambda f, item=item, start=start: self._done(item, start, f))
+            # wait for the outstanding requests
+            for _ in range(self.in_flight):
+                self.slots.acquire()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+            self.out_q.close()
+
+
+class Pipeline:
+    """Capture and inference stages, the caller is the consumer stage."""
+
+    def __init__(self, camera, device, stream="lores", in_flight=2,
+                 capture_queue=2, result_queue=4,
+                 capture_policy=DROP_OLDEST, result_policy=DROP_OLDEST, gate=None,
+                 pool=False, mapped=None):
+        """pool reuses preallocated frames, mapped is picamera2's MappedArray."""
+        # enough frames for every queue slot and request in flight, plus the
+        # one being captured, one waiting for a request slot and the consumer's
+        self.pool = FramePool(capture_queue + in_flight + result_queue + 3) if pool else None
+        release = self._release if self.pool is not None else None
+        self.frames = FrameQueue(capture_queue, capture_policy, on_drop=release)
+        self.results = FrameQueue(result_queue, result_policy, on_drop=release)
+        self.capture = CaptureStage(camera, self.frames, stream, self.pool, mapped)
+        self.inference = InferenceStage(device, self.frames, self.results, in_flight, gate, on_drop=release)
+        self.started = None
+        self.consumed = 0
+        self.latency = 0.0
+        self.held = None
+
+    def _release(self, item):
+        self.pool.release(item.frame)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.inference.start()
+        self.capture.start()
+        return self
+
+    def get(self, timeout=None):
+        """Next inferred Frame, None on timeout, raises Closed when stopped.
+        With a pool, the previous frame is reused from now on."""
+        if self.held is not None:
+            self._release(self.held)
+            self.held = None
+        try:
+            item = self.results.get(timeout)
+        except Closed as e:
+            error = self.capture.error or (self.inference.error if self.inference.failures else None)
+            if error is not None:
+                raise Closed("pipeline stopped by %r" % error) from error
+            raise
+        if item is not None and self.pool is not None:
+            self.held = item
+        if item is not None:
+            self.consumed += 1
+            self.latency += time.monotonic() - item.captured
+        return item
+
+    def stop(self, timeout=2):
+        self.capture.running = False
+        self.frames.close()
+        self.capture.join(timeout)
+        self.inference.join(timeout)
+        self.results.close()
+
+    def stats(self):
+        elapsed = max(time.monotonic() - (self.started or time.monotonic()), 1e-9)
+        return {
+            "captured": self.capture.seq,
+            "inferred": self.inference.inferred,
+            "skipped": self.inference.skipped,
+            "consumed": self.consumed,
+            "dropped_capture": self.frames.dropped,
+            "dropped_results": self.results.dropped,
+            "fps": self.consumed / elapsed,
+            "latency_ms": 1000 * self.latency / max(self.consumed, 1),
+            "duty": self.inference.busy / elapsed / self.inference.in_flight,
+            **(self.pool.stats() if self.pool is not None else {}),
+        }
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _StandInCamera:
+    def __init__(self, fps, shape=(640, 640, 3)):
+        self.period = 1.0 / fps
+        self.frame = bytearray(shape[0] * shape[1] * shape[2])
+        self.next = time.monotonic()
+
+    def capture_array(self, stream):
+        self.next += self.period
+        time.sleep(max(0.0, self.next - time.monotonic()))
+        return self.frame
+
+
+class _StandInHailo:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def run(self, frame):
+        time.sleep(self.latency)
+        return [[]]
+
+
+def measure(seconds=3.0, camera_fps=30, infer_ms=45, in_flight=2, consumer_ms=5):
+    """Sustained fps and capture-to-consumer latency with stand-in devices."""
+    pipe = Pipeline(_StandInCamera(camera_fps), _StandInHailo(infer_ms / 1000.0),
+                    in_flight=in_flight)
+    with pipe:
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            if pipe.get(timeout=1) is not None:
+                time.sleep(consumer_ms / 1000.0)
+        return pipe.stats()
+
+
+if __name__ == "__main__":
+    for n in (1, 2, 3):
+        s = measure(in_flight=n)
+        print("in_flight=%d fps=%5.1f latency=%5.1fms dropped=%d" %
+              (n, s["fps"], s["latency_ms"], s["dropped_capture"] + s["dropped_results"]))
@@ -0,0 +1,268 @@
+"""Declarative trigger policy: per-class thresholds, box size limits and zones.
+
+A policy is a small JSON file, eg
+
+    {"default": {"score": 0.5, "min_area": 0.001},
+     "classes": {"bird": {"score": 0.4}, "bear": {"score": 0.7, "min_area": 0.02}},
+     "exclude": [[[0.60, 0.10], [0.85, 0.10], [0.85, 0.45], [0.60, 0.45]]],
+     "anchor": "bottom"}
+
+"classes" lists the classes that can trigger (default: the detection
+objects), each with its own score threshold and min/max box area as a
+fraction of the frame.  "include" and "exclude" are polygons in normalised
+(x, y) image coordinates.  A box counts only if its anchor point (the
+"centre" or "bottom" middle of the box) is in an include zone, if there are
+any, and in no exclude zone.  The zones are rasterised once into a grid
+mask, so Policy.apply() is a few array operations per frame whatever the
+number of zones.
+
+dry_run() replays logged detections (DetectionLog / tracker.save_sequence()
+.npz files) and counts the clips each policy would have recorded:
+
+    python3 -m wildlife.policy --labels coco.txt --policy a.json --policy b.json log/*.npz
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+
+from . import decode
+from .tracker import Tracker, load_sequence, save_sequence
+
+GRID = 128
+
+
+def polygon_mask(polygon, grid=GRID):
+    """(grid, grid) bool mask of the cells whose centres are inside polygon."""
+    pts = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    if len(pts) < 3:
+        raise ValueError("a zone needs at least 3 points")
+    ys, xs = (np.mgrid[0:grid, 0:grid] + 0.5) / grid
+    inside = np.zeros((grid, grid), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(pts, np.roll(pts, -1, axis=0)):
+        if y0 == y1:
+            continue
+        crosses = (y0 > ys) != (y1 > ys)
+        inside ^= crosses & (xs < (x1 - x0) * (ys - y0) / (y1 - y0) + x0)
+    return inside
+
+
+class Policy:
+
+    def __init__(self, class_names, spec=None, objects=(), score=0.5, name="policy"):
+        """spec is a policy dict as above, objects and score give the default
+        classes and threshold, as with --score_thresh."""
+        spec = spec or {}
+        self.name = name
+        self.spec = spec
+        n = len(class_names)
+        ids = {c: i for i, c in enumerate(class_names)}
+        default = dict({"score": score, "min_area": 0.0, "max_area": 1.0}, **spec.get("default", {}))
+        classes = spec.get("classes", {c: {} for c in objects if c in ids})
+        self.scores = np.full(n, np.inf, dtype=np.float32)
+        self.min_area = np.zeros(n, dtype=np.float32)
+        self.max_area = np.ones(n, dtype=np.float32)
+        for cname, rule in classes.items():
+            if cname not in ids:
+                raise ValueError("unknown class %r in policy %s" % (cname, name))
+            rule = dict(default, **(rule or {}))
+            c = ids[cname]
+            self.scores[c] = rule["score"]
+            self.min_area[c] = rule["min_area"]
+            self.max_area[c] = rule["max_area"]
+        self.anchor = spec.get("anchor", "centre")
+        if self.anchor not in ("centre", "bottom"):
+            raise ValueError("anchor must be 'centre' or 'bottom'")
+        self.grid = int(spec.get("grid", GRID))
+        include = spec.get("include", [])
+        exclude = spec.get("exclude", [])
+        self.mask = None
+        if include or exclude:
+            mask = np.zeros((self.grid, self.grid), dtype=bool) if include else \
+                np.ones((self.grid, self.grid), dtype=bool)
+            for poly in include:
+                mask |= polygon_mask(poly, self.grid)
+            for poly in exclude:
+                mask &= ~polygon_mask(poly, self.grid)
+            self.mask = mask
+
+    @classmethod
+    def load(cls, path, class_names, objects=(), score=0.5):
+        """Policy from a JSON file, or the default one if path doesn't exist."""
+        if not path or not os.path.exists(path):
+            return cls(class_names, None, objects, score, name="default")
+        with open(path, "r") as f:
+            return cls(class_names, json.load(f), objects, score, name=os.path.basename(path))
+
+    def apply(self, dets):
+        """The detections that pass the policy, ie can trigger a recording."""
+        if len(dets) == 0:
+            return dets
+        c = dets["class_id"]
+        box = dets["bbox"]
+        w = box[:, 2] - box[:, 0]
+        h = box[:, 3] - box[:, 1]
+        area = w * h
+        ok = (dets["score"] > self.scores[c]) & (area >= self.min_area[c]) & (area <= self.max_area[c])
+        if self.mask is not None:
+            x = box[:, 0] + w / 2
+            y = box[:, 3] if self.anchor == "bottom" else box[:, 1] + h / 2
+            ix = np.clip((x * self.grid).astype(np.intp), 0, self.grid - 1)
+            iy = np.clip((y * self.grid).astype(np.intp), 0, self.grid - 1)
+            ok &= self.mask[iy, ix]
+        return dets[ok]
+
+    __call__ = apply
+
+
+class DetectionLog:
+    """Logs the decoded detections of every frame to .npz files for dry runs,
+    frames_per_file frames per file, saved in a background thread."""
+
+    def __init__(self, folder, frames_per_file=9000, min_score=0.3):
+        self.folder = folder
+        self.frames_per_file = frames_per_file
+        self.min_score = min_score
+        self.frames = []
+        self.saving = None
+        os.makedirs(folder, exist_ok=True)
+
+    def add(self, dets, stamp):
+        """stamp names the file the frame goes in if it is the first one, eg a timestamp."""
+        if not self.frames:
+            self.name = os.path.join(self.folder, str(stamp) + ".npz")
+        self.frames.append(dets[dets["score"] >= self.min_score].copy())
+        if len(self.frames) >= self.frames_per_file:
+            self.save()
+
+    def save(self):
+        if self.frames:
+            frames, self.frames = self.frames, []
+            self.saving = threading.Thread(target=save_sequence, args=(self.name, frames), name="detect-log")
+            self.saving.start()
+
+    def close(self):
+        """Save the frames logged since the last file and wait for it, eg on exit."""
+        self.save()
+        if self.saving is not None:
+            self.saving.join()
+
+
+def dry_run(sequences, policies, fps=25, v_length=5, confirm=0, window=5):
+    """Clips each policy would have recorded from logged detections.
+
+    sequences is a list of per-frame detection lists, each replayed from an
+    idle start, policies a list of Policy.  Returns {name: {clips, seconds}}."""
+    report = {}
+    for policy in policies:
+        clips = 0
+        recorded = 0
+        for frames in sequences:
+            tracker = Tracker(confirm, window) if confirm else None
+            encoding = False
+            startrec = start = 0
+            for f, dets in enumerate(frames):
+                hits = policy.apply(dets)
+                hits = hits[hits["score"] < 1]
+                triggered = len(hits) > 0
+                if tracker is not None:
+                    triggered = len(tracker.update(hits)) > 0 or tracker.active()
+                if triggered:
+                    startrec = f
+                    if not encoding and len(hits):
+                        encoding = True
+                        start = f
+                        clips += 1
+                if encoding and (f - startrec) / fps > v_length:
+                    encoding = False
+                    recorded += f - start
+            if encoding:
+                recorded += len(frames) - start
+        report[policy.name] = {"clips": clips, "seconds": recorded / fps}
+    return report
+
+
+def synthetic_log(minutes=30, fps=25, visits=6, seed=2):
+    """One long sequence with a swaying feeder that looks like a bird, small
+    insects, and a few real visits, (frames, feeder zone)."""
+    rng = np.random.default_rng(seed)
+    n = int(minutes * 60 * fps)
+    feeder = (0.70, 0.20, 0.80, 0.40)
+    visit_at = sorted(rng.integers(0, n - 30 * fps, visits))
+    frames = []
+    for f in range(n):
+        dets = []
+        if rng.random() < 0.02:
+            # the feeder swinging, detected as a bird
+            dx = rng.normal(0, 0.01)
+            dets.append((14, rng.uniform(0.5, 0.75), feeder[0] + dx, feeder[1], feeder[2] + dx, feeder[3]))
+        if rng.random() < 0.01:
+            # insects close to the lens, tiny boxes
+            x, y = rng.uniform(0, 0.95, 2)
+            dets.append((14, rng.uniform(0.5, 0.7), x, y, x + 0.02, y + 0.02))
+        for v in visit_at:
+            if v <= f < v + 20 * fps and rng.random() < 0.8:
+                dets.append((14, rng.uniform(0.6, 0.95), 0.2, 0.5, 0.45, 0.8))
+        arr = np.empty(len(dets), decode.DETECTION_DTYPE)
+        for i, d in enumerate(dets):
+            arr[i] = (d[0], d[1], d[2:])
+        frames.append(arr)
+    zone = [[feeder[0] - 0.05, feeder[1] - 0.05], [feeder[2] + 0.05, feeder[1] - 0.05],
+            [feeder[2] + 0.05, feeder[3] + 0.05], [feeder[0] - 0.05, feeder[3] + 0.05]]
+    return frames, zone
+
+
+def benchmark(frames=20000):
+    """Per-frame cost of apply() with and without zones, returns {name: usec}."""
+    import timeit
+    names = [str(i) for i in range(80)]
+    output = decode.synthetic_output(per_class={0: 6, 14: 3, 15: 2, 56: 4, 74: 1})
+    dets = decode.decode(output)
+    zone = [[0.6, 0.1], [0.85, 0.1], [0.85, 0.45], [0.6, 0.45]]
+    thresholds = decode.class_thresholds(80, [14, 15], 0.5)
+    cases = {"select": lambda d: decode.select(d, thresholds),
+             "policy": Policy(names, {"classes": {"14": {}, "15": {"score": 0.6}}}),
+             "policy+zones": Policy(names, {"classes": {"14": {"min_area": 0.01}, "15": {}},
+                                            "exclude": [zone] * 4, "include": [[[0, 0], [1, 0], [1, 1], [0, 1]]]})}
+    return {name: timeit.timeit(lambda: fn(dets), number=frames) / frames * 1e6 for name, fn in cases.items()}
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Count the clips trigger policies would record")
+    parser.add_argument("logs", nargs="*", help="detection logs (.npz), default a synthetic one")
+    parser.add_argument("--labels", help="labels file, eg coco.txt, default class numbers")
+    parser.add_argument("--policy", action="append", default=[], help="policy JSON file, can be repeated")
+    parser.add_argument("--objects", default="bird", help="comma separated default trigger classes")
+    parser.add_argument("--score", type=float, default=0.5)
+    parser.add_argument("--v_length", type=float, default=5)
+    parser.add_argument("--fps", type=float, default=25)
+    args = parser.parse_args(argv)
+
+    if args.labels:
+        with open(args.labels, "r", encoding="utf-8") as f:
+            names = f.read().splitlines()
+    else:
+        names = [str(i) for i in range(80)]
+        names[14] = "bird"
+    objects = args.objects.split(",")
+    policies = [Policy(names, None, objects, args.score, name="score %.2f only" % args.score)]
+    if args.logs:
+        sequences = [load_sequence(p) for p in args.logs]
+    else:
+        frames, zone = synthetic_log(fps=int(args.fps))
+        sequences = [frames]
+        policies.append(Policy(names, {"default": {"score": args.score, "min_area": 0.002},
+                                       "classes": {c: {} for c in objects}, "exclude": [zone]},
+                               name="min area + feeder zone"))
+    policies += [Policy.load(p, names, objects, args.score) for p in args.policy]
+    frames = sum(len(s) for s in sequences)
+    print("%d frames, %.0f minutes" % (frames, frames / args.fps / 60))
+    for name, r in dry_run(sequences, policies, args.fps, args.v_length).items():
+        print("%-28s %4d clips  %6.0f s recorded" % (name, r["clips"], r["seconds"]))
+
+
+if __name__ == "__main__":
+    main()
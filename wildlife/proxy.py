@@ -0,0 +1,266 @@
+"""Small proxy clips for previewing captures in the review window.
+
+After each clip is finished (remuxed, or closed with direct_mp4) a worker
+at nice 19 makes a proxy: the clip at fps frames a second, scaled to width
+pixels wide and saved as a stream of JPEGs (.mjpg, which ffplay and VLC also
+play).  The time of each frame in the clip goes in a .times file next to it.
+Only keyframes would be cheaper to decode, but the encoder's keyframe
+interval is a couple of seconds, too few frames for a preview.  The worker
+is held while recording.  Proxies are kept in their own folder next to the
+event catalog, named by capture stem, and removed with their clip.
+
+ProxyPlayer plays one in the review window at the clip's own pace,
+decoding a single small JPEG each time a frame is due, so playing costs next
+to nothing.
+
+ffmpeg is just an executable path, so a stub script is enough to exercise
+ProxyService, as with remux.RemuxService.
+"""
+
+import collections
+import glob
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+
+EXT = ".mjpg"
+TIMES = ".times"
+
+
+def split_jpegs(data):
+    """The JPEG images of a .mjpg stream, as bytes."""
+    frames = []
+    start = data.find(b"\xff\xd8")
+    while start >= 0:
+        end = data.find(b"\xff\xd9", start + 2)
+        if end < 0:
+            break
+        frames.append(data[start:end + 2])
+        start = data.find(b"\xff\xd8", end + 2)
+    return frames
+
+
+class ProxyService:
+
+    def __init__(self, folder, ffmpeg="ffmpeg", width=320, fps=2, quality=8, nice=19, on_done=None):
+        """quality is the ffmpeg -q:v JPEG quality, 2 (best) to 31."""
+        self.folder = folder
+        self.ffmpeg = ffmpeg
+        self.width = width
+        self.fps = fps
+        self.quality = quality
+        self.nice = nice
+        self.on_done = on_done
+        self.pending = collections.deque()
+        self.made = 0
+        self.failed = 0
+        self.busy = False
+        self.lock = threading.Condition()
+        self.allowed = threading.Event()
+        self.allowed.set()
+        self.running = True
+        os.makedirs(folder, exist_ok=True)
+        self.thread = threading.Thread(target=self._worker, name="proxy", daemon=True)
+        self.thread.start()
+
+    def path(self, stem):
+        return os.path.join(self.folder, stem + EXT)
+
+    def get(self, stem):
+        """The proxy of a capture, or None if it has none (yet)."""
+        path = self.path(stem)
+        return path if os.path.exists(path) else None
+
+    def submit(self, video):
+        with self.lock:
+            if video not in self.pending:
+                self.pending.append(video)
+                self.lock.notify_all()
+
+    def scan(self, videos):
+        """Make proxies for videos that don't have one, eg after a restart,
+        and remove those whose video has gone."""
+        stems = {}
+        for video in videos:
+            stems[os.path.basename(video).split(".")[0]] = video
+        for path in glob.glob(os.path.join(self.folder, "*" + EXT)):
+            stem = os.path.basename(path)[:-len(EXT)]
+            if stem not in stems:
+                self.remove(stem)
+        for stem, video in sorted(stems.items()):
+            if not os.path.exists(self.path(stem)):
+                self.submit(video)
+
+    def remove(self, stem):
+        for path in (self.path(stem), self.path(stem)[:-len(EXT)] + TIMES):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def hold(self):
+        """Stop starting new proxies, eg while recording."""
+        self.allowed.clear()
+
+    def release(self):
+        self.allowed.set()
+
+    def status(self):
+        with self.lock:
+            return {"pending": len(self.pending), "made": self.made, "failed": self.failed,
+                    "held": not self.allowed.is_set()}
+
+    def wait(self, timeout=None):
+        """Wait until nothing is pending, returns True if idle."""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.pending or self.busy:
+                left = None if end is None else end - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self.lock.wait(1 if left is None else min(left, 1))
+        return True
+
+    def stop(self):
+        self.running = False
+        self.allowed.set()
+        with self.lock:
+            self.lock.notify_all()
+
+    def _worker(self):
+        while self.running:
+            self.allowed.wait()
+            with self.lock:
+                if not self.pending:
+                    self.lock.wait(1)
+                    continue
+                video = self.pending.popleft()
+                self.busy = True
+            try:
+                ok = self._make(video)
+            except Exception as e:
+                print("Proxy", video, repr(e))
+                ok = False
+            with self.lock:
+                self.busy = False
+                if ok:
+                    self.made += 1
+                else:
+                    self.failed += 1
+                self.lock.notify_all()
+
+    def _make(self, video):
+        stem = os.path.basename(video).split(".")[0]
+        path = self.path(stem)
+        part = path + ".part"
+        # showinfo logs the time of each frame written
+        cmd = [self.ffmpeg, "-y", "-hide_banner", "-nostats", "-loglevel", "info", "-threads", "1",
+               "-i", video, "-an", "-vf", "fps=%g,scale=%d:-2,showinfo" % (self.fps, self.width),
+               "-c:v", "mjpeg", "-q:v", str(self.quality), "-f", "mjpeg", part]
+        try:
+            r = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               preexec_fn=lambda: os.nice(self.nice))
+        except OSError as e:
+            print("ffmpeg", e)
+            return False
+        if r.returncode != 0 or not os.path.exists(part) or not os.path.exists(video):
+            # the clip may have been deleted while its proxy was made
+            if r.returncode != 0:
+                print("ffmpeg", video, r.stderr.decode(errors="replace").strip().splitlines()[-1:])
+            if os.path.exists(part):
+                os.remove(part)
+            return False
+        times = [float(t) for t in re.findall(rb"pts_time:\s*(-?[0-9.]+)", r.stderr)]
+        if times:
+            with open(path[:-len(EXT)] + TIMES, "w") as f:
+                json.dump([t - times[0] for t in times], f)
+        os.replace(part, path)
+        if self.on_done is not None:
+            try:
+                self.on_done(stem, path)
+            except Exception as e:
+                print("Proxy", path, "made, but", repr(e))
+        return True
+
+
+def load_jpeg(data):
+    """Default frame loader, a pygame surface."""
+    import io
+    import pygame
+    return pygame.image.load(io.BytesIO(data), "frame.jpg")
+
+
+def read_times(path):
+    """Frame times (seconds) of a proxy, or None if it has no .times file."""
+    try:
+        with open(path[:-len(EXT)] + TIMES, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class ProxyPlayer:
+    """Plays a proxy one frame at a time, frame() returns the next image
+    when it is due, decoded then, and None otherwise.  Frames are spaced as
+    in the clip, or 1/fps apart for a proxy without frame times."""
+
+    def __init__(self, loader=load_jpeg, fps=2, loops=1):
+        self.loader = loader
+        self.fps = fps
+        self.loops = loops
+        self.frames = []
+        self.gaps = []
+        self.stem = None
+        self.pos = 0
+        self.due = 0.0
+        self.played = 0
+
+    @property
+    def playing(self):
+        return self.stem is not None
+
+    def start(self, stem, path, now=None):
+        """Returns False if the proxy couldn't be read."""
+        try:
+            with open(path, "rb") as f:
+                self.frames = split_jpegs(f.read())
+        except OSError:
+            self.frames = []
+        if not self.frames:
+            self.stop()
+            return False
+        times = read_times(path)
+        if times is None or len(times) != len(self.frames):
+            times = [i / self.fps for i in range(len(self.frames))]
+        # time from each frame to the next, the last one stays up for a frame
+        self.gaps = [b - a for a, b in zip(times, times[1:])] + [1.0 / self.fps]
+        self.stem = stem
+        self.pos = 0
+        self.played = 0
+        self.due = time.monotonic() if now is None else now
+        return True
+
+    def stop(self):
+        self.stem = None
+        self.frames = []
+
+    def frame(self, now=None):
+        if self.stem is None:
+            return None
+        now = time.monotonic() if now is None else now
+        if now < self.due:
+            return None
+        if self.pos >= len(self.frames):
+            self.played += 1
+            if self.played >= self.loops:
+                self.stop()
+                return None
+            self.pos = 0
+        image = self.loader(self.frames[self.pos])
+        gap = self.gaps[self.pos]
+        self.pos += 1
+        self.due = max(self.due + gap, now - gap)
+        return image
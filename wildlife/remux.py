@@ -0,0 +1,206 @@
+"""Background h264 -> mp4 conversion.
+
+Finished clips are queued with submit() and converted by a small pool of
+worker threads running "ffmpeg -c copy" at low priority, then moved to the
+Videos folder.  The queue is kept in a small JSON journal so clips left in
+/run/shm by a restart are picked up again, failed conversions are retried,
+and hold()/release() let capture pause conversion while it is recording.
+Holds are counted, so with several cameras conversion only resumes once
+every one that held it has released it.
+
+ffmpeg is just an executable path, so a stub script and synthetic .h264
+files are enough to exercise the service.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+PENDING = "pending"
+RUNNING = "running"
+FAILED = "failed"
+
+
+class RemuxService:
+
+    def __init__(self, dest, journal, workers=1, ffmpeg="ffmpeg", framerate=25,
+                 retries=3, retry_delay=5, nice=10, on_done=None):
+        self.dest = dest
+        self.journal = journal
+        self.ffmpeg = ffmpeg
+        self.framerate = framerate
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.nice = nice
+        self.on_done = on_done
+        self.jobs = {}
+        self.done = 0
+        # bytes moved to dest and the time it took, the write throughput
+        self.moved = 0
+        self.move_seconds = 0.0
+        self.lock = threading.Condition()
+        self.allowed = threading.Event()
+        self.allowed.set()
+        self.holds = 0
+        self.running = True
+        self._load()
+        self.threads = [threading.Thread(target=self._worker, name="remux%d" % i, daemon=True)
+                        for i in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    # journal
+    def _load(self):
+        if not os.path.exists(self.journal):
+            return
+        try:
+            with open(self.journal, "r") as f:
+                jobs = json.load(f)
+        except (OSError, ValueError):
+            return
+        for job in jobs:
+            if os.path.exists(job["src"]):
+                if job["state"] == RUNNING:
+                    job["state"] = PENDING
+                job["after"] = 0
+                self.jobs[job["src"]] = job
+
+    def _save(self):
+        tmp = self.journal + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(list(self.jobs.values()), f)
+            os.replace(tmp, self.journal)
+        except OSError as e:
+            # the queue carries on in memory, it just won't survive a restart
+            print("Remux journal", e)
+
+    # public
+    def submit(self, src):
+        """Queue a finished .h264 file for conversion."""
+        with self.lock:
+            if src not in self.jobs:
+                self.jobs[src] = {"src": src, "state": PENDING, "attempts": 0, "after": 0}
+                self._save()
+                self.lock.notify()
+
+    def scan(self, pattern):
+        """Queue any files matching pattern that are not already queued."""
+        import glob
+        for src in sorted(glob.glob(pattern)):
+            self.submit(src)
+
+    def hold(self):
+        """Stop starting new conversions, eg while recording, until release()
+        has been called as many times."""
+        with self.lock:
+            self.holds += 1
+            self.allowed.clear()
+
+    def release(self):
+        with self.lock:
+            self.holds = max(self.holds - 1, 0)
+            if self.holds == 0:
+                self.allowed.set()
+
+    def status(self):
+        with self.lock:
+            states = [j["state"] for j in self.jobs.values()]
+        return {"pending": states.count(PENDING), "running": states.count(RUNNING),
+                "failed": states.count(FAILED), "done": self.done,
+                "held": not self.allowed.is_set(), "moved": self.moved, "move_seconds": self.move_seconds}
+
+    def busy(self):
+        s = self.status()
+        return s["pending"] + s["running"] > 0
+
+    def wait(self, timeout=None):
+        """Wait until nothing is pending or running, returns True if idle."""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while any(j["state"] in (PENDING, RUNNING) for j in self.jobs.values()):
+                left = None if end is None else end - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self.lock.wait(left if left is None else min(left, 1))
+        return True
+
+    def stop(self):
+        self.running = False
+        self.allowed.set()
+        with self.lock:
+            self.lock.notify_all()
+
+    # workers
+    def _next(self):
+        now = time.monotonic()
+        for job in self.jobs.values():
+            if job["state"] == PENDING and job["after"] <= now:
+                return job
+        return None
+
+    def _worker(self):
+        while self.running:
+            self.allowed.wait()
+            with self.lock:
+                job = self._next()
+                if job is None:
+                    self.lock.wait(1)
+                    continue
+                job["state"] = RUNNING
+                job["attempts"] += 1
+                self._save()
+            try:
+                target = self._convert(job["src"])
+            except Exception as e:
+                print("Remux", job["src"], repr(e))
+                target = None
+            ok = target is not None
+            if ok and self.on_done is not None:
+                try:
+                    self.on_done(target)
+                except Exception as e:
+                    # the clip is converted, only the bookkeeping after it failed
+                    print("Remux", target, "saved, but", repr(e))
+            with self.lock:
+                if ok:
+                    del self.jobs[job["src"]]
+                    self.done += 1
+                elif job["attempts"] >= self.retries:
+                    job["state"] = FAILED
+                    print("Failed to convert", job["src"])
+                else:
+                    job["state"] = PENDING
+                    job["after"] = time.monotonic() + self.retry_delay
+                self._save()
+                self.lock.notify_all()
+
+    def _convert(self, src):
+        """Returns the mp4 in dest, or None if the conversion failed."""
+        mp4 = src[:-5] + ".mp4"
+        cmd = [self.ffmpeg, "-y", "-loglevel", "error", "-framerate", str(self.framerate),
+               "-i", src, "-c", "copy", mp4]
+        try:
+            r = subprocess.run(cmd, stdin=subprocess.DEVNULL,
+                               preexec_fn=lambda: os.nice(self.nice))
+        except OSError as e:
+            print("ffmpeg", e)
+            return None
+        if r.returncode != 0 or not os.path.exists(mp4):
+            return None
+        target = os.path.join(self.dest, os.path.basename(mp4))
+        if not os.path.exists(target):
+            size = os.path.getsize(mp4)
+            t = time.monotonic()
+            shutil.move(mp4, target)
+            with self.lock:
+                self.moved += size
+                self.move_seconds += time.monotonic() - t
+        else:
+            os.remove(mp4)
+        os.remove(src)
+        print("Saved", target)
+        return target
@@ -0,0 +1,346 @@
+"""Stand-ins for the Pi hardware so detect_002.py can run on any Linux box.
+
+Picamera2, MappedArray, Preview, Hailo, H264Encoder, CircularOutput,
+libcamera controls and gpiozero LED are replaced by local classes with the
+parts of their interfaces that detect_002.py uses.  Frames come from a
+directory of images or a video file (needs cv2) or from a synthetic scene,
+and detections from a recorded sequence (tracker.save_sequence() .npz) or
+from a simple colour detector run on the synthetic scene.
+
+Call setup() before the camera or Hailo is opened, eg
+
+    python3 detect_002.py --replay synthetic
+    python3 detect_002.py --replay ~/clips/fox.mp4 --detections fox.npz
+"""
+
+import glob
+import os
+import threading
+import time
+import types
+
+import numpy as np
+
+from . import decode, motion
+
+NUM_CLASSES = 80
+ANIMAL_CLASS = 14     # "bird" in coco.txt
+ANIMAL_COLOUR = (150, 90, 30)
+
+_source = {"frames": "synthetic", "detections": None, "fps": 25, "latency": 0.02,
+           "loop": True, "appear": 100}
+
+
+def setup(frames="synthetic", detections=None, fps=25, latency=0.02, loop=True, appear=100):
+    """Choose the replayed frames and detections.
+
+    frames is "synthetic", a directory of images or a video file, detections an
+    optional .npz of per-frame decoded detections, latency the simulated
+    hailo.run() time in seconds."""
+    _source.update(frames=frames, detections=detections, fps=fps, latency=latency,
+                   loop=loop, appear=appear)
+
+
+# frame sources
+def _synthetic(size):
+    w, h = size
+    while True:
+        for frame, _ in motion.synthetic_frames(length=1000, appear=_source["appear"], shape=(h, w, 3)):
+            yield frame
+        if not _source["loop"]:
+            return
+
+
+def _files(path, size):
+    import cv2
+    if os.path.isdir(path):
+        names = sorted(glob.glob(os.path.join(path, "*.jpg")) + glob.glob(os.path.join(path, "*.png")))
+        while True:
+            for name in names:
+                yield cv2.resize(cv2.imread(name), size)
+            if not _source["loop"]:
+                return
+    while True:
+        cap = cv2.VideoCapture(path)
+        ok, frame = cap.read()
+        while ok:
+            yield cv2.resize(frame, size)
+            ok, frame = cap.read()
+        cap.release()
+        if not _source["loop"]:
+            return
+
+
+def frames(size):
+    """Generator of RGB888 frames of size (w, h)."""
+    if _source["frames"] in (None, "synthetic"):
+        return _synthetic(size)
+    return _files(_source["frames"], size)
+
+
+# picamera2
+class _Request:
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def make_array(self, stream):
+        return self.arrays[stream]
+
+    def release(self):
+        pass
+
+
+class MappedArray:
+
+    def __init__(self, request, stream):
+        self.array = request.make_array(stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+Preview = types.SimpleNamespace(QTGL="QTGL", QT="QT", DRM="DRM", NULL="NULL")
+
+
+class Picamera2:
+
+    def __init__(self, camera_num=0):
+        self.camera_num = camera_num
+        self.camera_properties = {"Model": "replay"}
+        self.config = None
+        self.pre_callback = None
+        self.title_fields = []
+        self.controls = {}
+        self.encoders = []
+        self.frames = None
+        self.next = None
+        self.lock = threading.Lock()
+        self.captured = 0
+        self.main_buf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def create_preview_configuration(self, main=None, lores=None, controls=None, **kw):
+        return {"main": dict(main or {"size": (640, 480), "format": "XRGB8888"}),
+                "lores": dict(lores) if lores else None, "controls": dict(controls or {})}
+
+    create_video_configuration = create_preview_configuration
+
+    def configure(self, config):
+        self.config = config
+        self.controls.update(config.get("controls", {}))
+
+    def start_preview(self, *args, **kw):
+        pass
+
+    def start(self):
+        stream = self.config["lores"] or self.config["main"]
+        self.frames = frames(tuple(stream["size"]))
+        self.next = time.monotonic()
+
+    def stop(self):
+        self.frames = None
+
+    def close(self):
+        self.stop()
+
+    def set_controls(self, controls):
+        self.controls.update(controls)
+
+    def start_encoder(self, encoder, *args, **kw):
+        self.encoders.append(encoder)
+
+    def stop_encoder(self, *args):
+        self.encoders = []
+
+    def _main_array(self):
+        w, h = self.config["main"]["size"]
+        if self.main_buf is None or self.main_buf.shape[:2] != (h, w):
+            self.main_buf = np.zeros((h, w, 4), dtype=np.uint8)
+        return self.main_buf
+
+    def _frame(self):
+        # pace frames at the camera frame rate
+        fps = self.controls.get("FrameRate", _source["fps"])
+        with self.lock:
+            self.next += 1.0 / fps
+            delay = self.next - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.next = time.monotonic()
+            frame = next(self.frames)
+            self.captured += 1
+        lores = self.config["lores"]
+        arrays = {"lores": frame, "main": None}
+        if self.pre_callback is not None or self.encoders:
+            arrays["main"] = self._main_array()
+            if self.pre_callback is not None:
+                self.pre_callback(_Request(arrays))
+            for encoder in self.encoders:
+                encoder.encode(arrays["main"])
+        if lores is None:
+            arrays["main"] = frame
+        return arrays
+
+    def capture_array(self, stream="main"):
+        return self._frame()[stream]
+
+    def capture_request(self):
+        return _Request(self._frame())
+
+
+controls = types.SimpleNamespace(
+    AfModeEnum=types.SimpleNamespace(Manual=0, Auto=1, Continuous=2),
+    AfTriggerEnum=types.SimpleNamespace(Start=0, Cancel=1),
+    AeExposureModeEnum=types.SimpleNamespace(Normal=0, Short=1, Long=2, Custom=3))
+
+
+# encoder and outputs
+class CircularOutput:
+    """Writes every frame straight to fileoutput while started, without a pre-buffer."""
+
+    def __init__(self, file=None, buffersize=150):
+        self.buffersize = buffersize
+        self.fileoutput = file
+        self.file = None
+        self.recording = False
+        self.frames = 0
+        self.bytes = 0
+        self.files = []
+
+    def start(self):
+        self.file = open(self.fileoutput, "wb")
+        self.files.append(self.fileoutput)
+        self.recording = True
+
+    def stop(self):
+        self.recording = False
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kw):
+        if self.recording and self.file is not None:
+            self.file.write(frame)
+            self.frames += 1
+            self.bytes += len(frame)
+
+
+class H264Encoder:
+    """Emits a fixed size fake access unit per frame at the configured bitrate,
+    keyframes carry SPS/PPS when repeat is set, as with the real encoder."""
+
+    SPS = b"\x00\x00\x00\x01\x67\x64\x00\x28\xac\xd9\x40\x5b\x04\x5a\x10"
+    PPS = b"\x00\x00\x00\x01\x68\xeb\xe3\xcb\x22\xc0"
+
+    def __init__(self, bitrate=2000000, repeat=True, iperiod=30, framerate=25):
+        self.bitrate = bitrate
+        self.repeat = repeat
+        self.iperiod = iperiod
+        self.framerate = framerate
+        # encode every frame_skip_count'th frame, as picamera2's encoders can
+        self.frame_skip_count = 1
+        self.output = None
+        self.count = 0
+        self.frames = 0
+
+    def encode(self, array):
+        if self.output is None:
+            return
+        self.frames += 1
+        if (self.frames - 1) % self.frame_skip_count:
+            return
+        size = max(int(self.bitrate / 8 / self.framerate), 16)
+        keyframe = self.count % self.iperiod == 0
+        unit = (b"\x00\x00\x00\x01\x65" if keyframe else b"\x00\x00\x00\x01\x41") + bytes(size - 5)
+        if keyframe and self.repeat:
+            unit = self.SPS + self.PPS + unit
+        self.output.outputframe(unit, keyframe, int(time.monotonic() * 1e6))
+        self.count += 1
+
+
+class LED:
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.is_lit = False
+
+    def on(self):
+        self.is_lit = True
+
+    def off(self):
+        self.is_lit = False
+
+
+# hailo
+def encode(dets, num_classes=NUM_CLASSES):
+    """Inverse of decode.decode(), Hailo-shaped per-class (n, 5) arrays."""
+    out = []
+    for c in range(num_classes):
+        d = dets[dets["class_id"] == c]
+        rows = np.empty((len(d), 5), dtype=np.float32)
+        rows[:, [1, 0, 3, 2]] = d["bbox"]
+        rows[:, 4] = d["score"]
+        out.append(rows)
+    return out
+
+
+def colour_detector(frame, colour=ANIMAL_COLOUR, class_id=ANIMAL_CLASS, step=4):
+    """Finds the synthetic animal, returns a decoded detection array."""
+    small = np.asarray(frame)[::step, ::step, :3].astype(np.int16)
+    mask = (np.abs(small - np.array(colour)) < 12).all(axis=2)
+    if mask.sum() < 20:
+        return decode.EMPTY
+    ys, xs = np.nonzero(mask)
+    h, w = mask.shape
+    det = np.empty(1, decode.DETECTION_DTYPE)
+    det[0] = (class_id, 0.8, (xs.min() / w, ys.min() / h, (xs.max() + 1) / w, (ys.max() + 1) / h))
+    return det
+
+
+class Hailo:
+
+    def __init__(self, model=None, input_shape=(640, 640, 3)):
+        self.model = model
+        self.input_shape = input_shape
+        self.recorded = None
+        if _source["detections"]:
+            from .tracker import load_sequence
+            self.recorded = load_sequence(_source["detections"])
+        self.calls = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+    def get_input_shape(self):
+        return self.input_shape
+
+    def run(self, frame):
+        start = time.monotonic()
+        with self.lock:
+            n = self.calls
+            self.calls += 1
+            if self.recorded is not None:
+                dets = self.recorded[n % len(self.recorded)]
+            else:
+                dets = colour_detector(frame)
+            time.sleep(_source["latency"])
+        self.busy += time.monotonic() - start
+        return [encode(dets)]
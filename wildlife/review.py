@@ -0,0 +1,379 @@
+"""Review window in its own process.
+
+python3 detect_002.py --split runs this next to the camera process
+(detect_002.py --headless).  It can also be started on its own against a
+headless run:
+
+    python3 -m wildlife.review
+
+It draws the same window as detect_002.py.  The captures are read from the
+Pictures and Videos folders into a CaptureIndex, which is refreshed when the
+capture process reports a change.  MODE/SPEED/GAIN, deletes and moves to USB
+go through the control API.  Trigger pictures are read from the capture
+process's FrameRing as soon as they are taken, and its trigger and status
+events arrive on an EventListener (see wildlife/ipc.py).  While the capture
+process is down the window shows "no camera" and can still step through
+captures.  It carries on when the capture process comes back.
+"""
+
+import argparse
+import os
+import time
+
+import pygame
+from pygame.locals import MOUSEBUTTONUP, QUIT, Rect
+
+from .control import MODES
+from .index import CaptureIndex
+from .ipc import ApiClient, EventListener, FrameRing
+from .proxy import EXT, ProxyPlayer
+from .thumbs import ThumbCache, from_frame, neighbours
+from .ui import Panel
+
+GREY = (100, 100, 100)
+
+
+class Review:
+
+    def __init__(self, surface, index, api, listener, ring_name, media, proxies=None, proxy_fps=2,
+                 thumb_mb=32, prefetch=2, timeout=3.0):
+        """proxies is the folder of the proxy clips, timeout the seconds
+        without a status event before the capture process counts as stopped."""
+        self.surface = surface
+        self.panel = Panel(surface)
+        self.index = index
+        self.api = api
+        self.listener = listener
+        self.ring_name = ring_name
+        self.ring = None
+        self.media = media
+        self.proxies = proxies
+        self.player = ProxyPlayer(fps=proxy_fps)
+        self.thumbs = ThumbCache(max_bytes=thumb_mb * 1024 * 1024)
+        self.prefetch = prefetch
+        self.timeout = timeout
+        self.settings = {"mode": 1, "speed": 1000, "gain": 0}
+        self.status = {}
+        self.connected = False
+        self.heard = 0.0
+        self.p = max(len(index) - 1, 0)
+
+    def text(self, msg, cr, cg, cb, x, y, ft, bw):
+        self.panel.text(msg, (cr, cg, cb), x, y, ft, bw)
+
+    # capture process
+    def open_ring(self):
+        """Attach to the frame ring, or follow it if the capture process replaced it."""
+        if self.ring is not None and self.ring.closed():
+            self.ring.close()
+            self.ring = None
+        if self.ring is None:
+            try:
+                self.ring = FrameRing(self.ring_name)
+            except FileNotFoundError:
+                pass
+        return self.ring
+
+    def connect(self):
+        """Read the settings and captures again, after a start or a restart of either process."""
+        try:
+            self.settings = self.api.settings()
+        except (OSError, ValueError) as e:
+            print("Capture process", e)
+            self.connected = False
+            return False
+        self.connected = True
+        self.heard = time.monotonic()
+        self.refresh()
+        self.open_ring()
+        return True
+
+    def refresh(self):
+        """Rescan the captures, keeping the position on one that is still there."""
+        self.index.refresh()
+        if self.p > len(self.index) - 1:
+            self.p = max(len(self.index) - 1, 0)
+
+    def call(self, fn, *args, **kw):
+        """A control API request, None if the capture process couldn't do it."""
+        try:
+            return fn(*args, **kw)
+        except (OSError, ValueError) as e:
+            print("Capture process", e)
+            if not os.path.exists(self.api.socket_path):
+                self.connected = False
+                self.show_state()
+            return None
+
+    def picture(self, stem, n=None):
+        """Review image of a trigger picture from the ring, None if it has gone."""
+        ring = self.open_ring()
+        got = ring.get(n) if ring is not None else None
+        if got is None or got[2].get("stem") != stem:
+            return None
+        image = from_frame(got[1], (320, 320))
+        self.thumbs.put(stem, image)
+        return image
+
+    # drawing
+    def draw_frame(self):
+        for rect in ((1, 1, 80, 50), (80, 1, 80, 50), (160, 1, 80, 50), (240, 1, 80, 50),
+                     (1, 400, 80, 50), (80, 400, 80, 50), (240, 400, 80, 50), (160, 400, 80, 50)):
+            pygame.draw.rect(self.surface, GREY, Rect(rect), 1)
+        self.text("PREV", 100, 100, 100, 10, 15, 18, 60)
+        self.text("NEXT", 100, 100, 100, 90, 15, 18, 60)
+        self.text("MODE", 100, 100, 100, 90, 402, 18, 60)
+        self.text("GAIN", 100, 100, 100, 250, 402, 18, 60)
+
+    def show_capture(self, p):
+        self.player.stop()
+        stem = self.index.stem(p)
+        path = self.index.picture(p)
+        if stem in self.thumbs or os.path.exists(path):
+            self.panel.blit(self.thumbs.get(stem, path), (0, 51))
+        else:
+            # still being written, or gone
+            self.panel.rect((0, 0, 0), Rect(0, 51, 320, 320))
+        self.thumbs.prefetch(neighbours(self.index, p, self.prefetch))
+
+    def show_settings(self):
+        s = self.settings
+        self.text(str(MODES[s["mode"]]), 100, 100, 100, 95, 420, 18, 60)
+        if s["mode"] == 0:
+            self.text("SPEED", 100, 100, 100, 170, 402, 18, 60)
+            self.text(str(s["speed"]), 100, 100, 100, 170, 420, 18, 60)
+        else:
+            self.text(" ", 100, 100, 100, 170, 402, 18, 60)
+            self.text(" ", 100, 100, 100, 170, 420, 18, 60)
+        if s["gain"] != 0:
+            self.text(str(s["gain"]), 100, 100, 100, 250, 420, 18, 60)
+        else:
+            self.text("Auto", 100, 100, 100, 250, 420, 18, 60)
+
+    def show_buttons(self, p):
+        index = self.index
+        if len(index) > 0 and index.has_video(p):
+            self.text("DELETE", 100, 100, 100, 163, 15, 18, 60)
+            self.text("DEL ALL", 100, 100, 100, 10, 415, 16, 60)
+            if len(os.listdir(self.media)) > 0:
+                self.text("  to USB", 100, 100, 100, 243, 15, 18, 60)
+        else:
+            self.text("    ", 100, 100, 100, 163, 15, 18, 70)
+            self.text("    ", 100, 100, 100, 243, 15, 18, 70)
+            self.text("    ", 100, 100, 100, 10, 415, 18, 70)
+        if len(index) > 0:
+            msg = str(p + 1) + "/" + str(len(index))
+            self.text(index.name(p), 100, 120, 100, 160, 375, 18, 320)
+        else:
+            msg = str(len(index))
+        self.text(msg, 100, 120, 100, 10, 375, 18, 60)
+
+    def show_state(self):
+        """Conversions and USB moves left, recording, or the capture process stopped."""
+        if not self.connected:
+            self.text("no camera", 150, 50, 50, 10, 32, 14, 68)
+            return
+        st = self.status
+        self.text("REC" if st.get("recording") else "", 150, 50, 50, 10, 32, 14, 68)
+        if st.get("mp4", 0) > 0:
+            self.text("mp4 " + str(st["mp4"]), 100, 100, 100, 80, 375, 18, 75)
+        else:
+            self.text("    ", 100, 100, 100, 80, 375, 18, 75)
+        if st.get("usb_error") is not None:
+            self.text("USB error", 150, 50, 50, 243, 30, 14, 70)
+        elif st.get("usb_left", 0) > 0:
+            self.text(str(st["usb_left"]) + " to move", 100, 100, 100, 243, 30, 14, 70)
+        else:
+            self.text("    ", 100, 100, 100, 243, 30, 14, 70)
+
+    def redraw(self):
+        if self.p > len(self.index) - 1:
+            self.p = max(len(self.index) - 1, 0)
+        if len(self.index) > 0:
+            self.show_capture(self.p)
+        else:
+            self.panel.rect((0, 0, 0), Rect(0, 51, 320, 344))
+        self.show_settings()
+        self.show_buttons(self.p)
+        self.show_state()
+
+    # events from the capture process
+    def triggered(self, event):
+        stem = event["stem"]
+        self.index.add_picture(event["picture"])
+        self.p = self.index.position(stem)
+        self.player.stop()
+        image = self.picture(stem, event.get("n"))
+        if image is not None:
+            self.panel.blit(image, (0, 51))
+        else:
+            self.show_capture(self.p)
+        self.text(str(self.p + 1) + "/" + str(len(self.index)), 100, 120, 100, 10, 375, 18, 60)
+        self.text(self.index.name(self.p), 100, 120, 100, 160, 375, 18, 320)
+        self.text("    ", 100, 100, 100, 163, 15, 18, 70)
+        self.text("    ", 100, 100, 100, 243, 15, 18, 70)
+
+    def status_event(self, event):
+        self.heard = time.monotonic()
+        if not self.connected:
+            # the capture process (or this one) has restarted
+            if self.connect():
+                self.status = event
+                self.redraw()
+            return
+        old = self.status
+        self.status = event
+        if any(old.get(k) != event.get(k) for k in ("version", "captures", "videos")):
+            # changed through the control API, evicted, converted or moved to USB
+            self.refresh()
+            if old.get("version") != event.get("version"):
+                self.settings = self.call(self.api.settings) or self.settings
+                self.show_settings()
+            if not event.get("recording"):
+                # leave the trigger picture up while recording, as detect_002.py does
+                self.redraw()
+        self.show_state()
+
+    def event(self, event):
+        kind = event.get("type")
+        if kind == "trigger":
+            self.heard = time.monotonic()
+            self.triggered(event)
+        elif kind == "status":
+            self.status_event(event)
+
+    # clicks
+    def click(self, event):
+        index = self.index
+        mousex, mousey = event.pos
+        s = self.settings
+        # delete ALL Pictures and Videos
+        if mousex < 80 and mousey > 400 and event.button == 3:
+            if self.call(self.api.delete_all) is not None:
+                index.clear()
+                self.thumbs.clear()
+                self.panel.rect((0, 0, 0), Rect(0, 371, 320, 28))
+                self.panel.rect((0, 0, 0), Rect(0, 51, 320, 320))
+                self.p = 0
+        # MODE
+        if mousex > 80 and mousex < 160 and mousey > 400:
+            if event.button == 3 or event.button == 5:
+                self.set(mode=(s["mode"] - 1) % 4)
+            else:
+                self.set(mode=(s["mode"] + 1) % 4)
+        # SHUTTER SPEED
+        if mousex > 160 and mousex < 240 and mousey > 400 and s["mode"] == 0:
+            if event.button == 3 or event.button == 5:
+                self.set(speed=max(1000, s["speed"] - 1000))
+            else:
+                self.set(speed=min(100000, s["speed"] + 1000))
+        # GAIN
+        if mousex > 240 and mousey > 400:
+            if event.button == 3 or event.button == 5:
+                self.set(gain=max(0, s["gain"] - 1))
+            else:
+                self.set(gain=min(64, s["gain"] + 1))
+        # show previous
+        elif mousex < 80 and mousey < 50:
+            self.p = max(self.p - 1, 0)
+            if len(index) > 0:
+                self.show_capture(self.p)
+        # show next
+        elif mousex > 80 and mousex < 160 and mousey < 50:
+            self.p = max(min(self.p + 1, len(index) - 1), 0)
+            if len(index) > 0:
+                self.show_capture(self.p)
+        # delete picture and video
+        elif mousex > 160 and mousex < 240 and mousey < 50 and event.button == 3:
+            if len(index) > 0 and index.has_video(self.p):
+                stem = index.stem(self.p)
+                if self.call(self.api.delete, stem):
+                    index.remove(stem)
+                    self.thumbs.invalidate(stem)
+            self.redraw()
+        # move picture and video to USB
+        elif mousex > 240 and mousey < 50:
+            if len(index) > 0 and index.has_video(self.p):
+                self.call(self.api.offload, [index.stem(self.p)])
+        # play the proxy clip of the capture, click again to stop
+        elif mousey > 50 and mousey < 371 and len(index) > 0:
+            if self.player.playing:
+                self.show_capture(self.p)
+            elif self.proxies and self.player.start(index.stem(self.p),
+                                                    os.path.join(self.proxies, index.stem(self.p) + EXT)):
+                self.panel.rect((0, 0, 0), Rect(0, 51, 320, 320))
+        self.show_buttons(self.p)
+
+    def set(self, **settings):
+        new = self.call(self.api.set, **settings)
+        if new is not None:
+            self.settings = new
+            self.show_settings()
+
+    def run(self):
+        """Until the window is closed."""
+        self.draw_frame()
+        if not self.connect():
+            self.show_state()
+        if len(self.index) > 0:
+            # the latest trigger picture may still be in the ring and not written yet
+            self.picture(self.index.stem(self.p))
+        self.redraw()
+        self.panel.flush(full=True)
+        while True:
+            for event in self.listener.poll(0.01 if self.player.playing else 0.05):
+                self.event(event)
+            if self.connected and time.monotonic() - self.heard > self.timeout:
+                self.connected = False
+                self.show_state()
+            for event in pygame.event.get():
+                if event.type == QUIT:
+                    return
+                if event.type == MOUSEBUTTONUP:
+                    self.click(event)
+            # proxy clip playing, one small frame when it is due
+            if self.player.playing:
+                image = self.player.frame()
+                if image is not None:
+                    self.panel.blit(image, (0, 51 + max(320 - image.get_height(), 0) // 2))
+                elif not self.player.playing:
+                    self.show_capture(self.p)
+            self.panel.flush()
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+        self.listener.close()
+
+
+def main(argv=None):
+    home = os.path.expanduser("~")
+    parser = argparse.ArgumentParser(description="Review window for a headless detect_002.py")
+    parser.add_argument("--api", default="/run/shm/wildlife.sock", help="control API socket")
+    parser.add_argument("--events", default="/run/shm/wildlife_ui.sock", help="socket to receive events on")
+    parser.add_argument("--ring", default="wildlife_ring", help="shared memory frame ring")
+    parser.add_argument("--pictures", default=os.path.join(home, "Pictures"))
+    parser.add_argument("--videos", default=os.path.join(home, "Videos"))
+    parser.add_argument("--media", default="/media/" + os.getlogin(), help="folder USB drives are mounted in")
+    parser.add_argument("--proxies", default=os.path.join(home, "wildlife", "proxies"),
+                        help="proxy clips folder, '' = none")
+    parser.add_argument("--proxy_fps", type=float, default=2)
+    parser.add_argument("--thumb_mb", type=int, default=32)
+    parser.add_argument("--prefetch", type=int, default=2)
+    args = parser.parse_args(argv)
+
+    pygame.init()
+    surface = pygame.display.set_mode((320, 450), 1, 24)
+    pygame.display.set_caption("Review Captures")
+    review = Review(surface, CaptureIndex(args.pictures, args.videos), ApiClient(args.api),
+                    EventListener(args.events), args.ring, args.media, args.proxies or None, args.proxy_fps,
+                    args.thumb_mb, args.prefetch)
+    try:
+        review.run()
+    finally:
+        review.close()
+        pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Adaptive inference rate driven by recent activity and time of day.
+
+The scheduler runs inference at full rate while recording or just after a
+detection, steps the rate down through levels the longer nothing is seen,
+and jumps straight back to full rate on any hit.  Time of day windows can cap
+the rate, eg at night when nothing is expected.  status() reports the current
+rate and decision counts for monitoring.
+
+"python3 -m wildlife.scheduler" simulates a day with a stand-in detector and
+reports the accelerator duty cycle against running on every frame.
+"""
+
+import datetime
+import time
+
+
+def _minutes(hhmm):
+    h, m = hhmm.split(":")
+    return int(h) * 60 + int(m)
+
+
+class RateScheduler:
+
+    def __init__(self, levels=(25, 10, 5, 2), step_after=60, windows=(), clock=time.monotonic,
+                 wallclock=datetime.datetime.now):
+        """levels are inference rates in fps, fastest first.  windows are
+        ("HH:MM", "HH:MM", max_fps) tuples, they may wrap past midnight."""
+        self.levels = list(levels)
+        self.step_after = step_after
+        self.windows = [(_minutes(a), _minutes(b), cap) for a, b, cap in windows]
+        self.clock = clock
+        self.wallclock = wallclock
+        self.level = 0
+        self.last_hit = clock()
+        self.last_run = None
+        self.runs = 0
+        self.skips = 0
+        self.reason = "start"
+        self.encoding = False
+
+    def cap(self):
+        """Rate limit of the current time of day window, or None."""
+        now = self.wallclock()
+        m = now.hour * 60 + now.minute
+        for a, b, cap in self.windows:
+            if (a <= m < b) if a <= b else (m >= a or m < b):
+                return cap
+        return None
+
+    def _decide(self, encoding):
+        """(rate, level, reason), without changing anything."""
+        if encoding:
+            return self.levels[0], self.level, "recording"
+        idle = self.clock() - self.last_hit
+        level = min(int(idle // self.step_after), len(self.levels) - 1)
+        rate = self.levels[level]
+        reason = "idle %ds" % idle if level else "active"
+        cap = self.cap()
+        if cap is not None and cap < rate:
+            reason = "window"
+            rate = cap
+        return rate, level, reason
+
+    def rate(self, encoding=False):
+        rate, self.level, self.reason = self._decide(encoding)
+        return rate
+
+    def due(self, encoding=False):
+        """True if inference is due now.  Nothing is counted as run until
+        ran() is called, eg once the motion gate has also let the frame through."""
+        now = self.clock()
+        self.encoding = encoding
+        rate = self.rate(encoding)
+        if rate > 0 and (self.last_run is None or now - self.last_run >= 1.0 / rate - 1e-6):
+            return True
+        self.skips += 1
+        return False
+
+    def ran(self):
+        """A frame went to inference."""
+        self.last_run = self.clock()
+        self.runs += 1
+
+    def allow(self, encoding=False):
+        """True if inference should run now, counted as run."""
+        if self.due(encoding):
+            self.ran()
+            return True
+        return False
+
+    def record(self, hit):
+        """Report the result of an inference, any hit ramps straight back up."""
+        if hit:
+            self.last_hit = self.clock()
+            self.level = 0
+
+    def status(self):
+        rate, level, reason = self._decide(self.encoding)
+        return {"rate": rate, "level": level, "reason": reason, "runs": self.runs, "skips": self.skips}
+
+
+def simulate(hours=24, fps=25, visits=12, visit_secs=40, **kw):
+    """Duty cycle over a simulated day with a stand-in detector."""
+    import random
+    rng = random.Random(3)
+    t = [0.0]
+    start = datetime.datetime(2024, 6, 1)
+    sched = RateScheduler(clock=lambda: t[0],
+                          wallclock=lambda: start + datetime.timedelta(seconds=t[0]), **kw)
+    seconds = int(hours * 3600)
+    visit_of = {}
+    for _ in range(visits):
+        s = rng.randrange(6 * 3600, 20 * 3600)
+        for sec in range(s, s + visit_secs):
+            visit_of.setdefault(sec, s)
+    frames = inferred = 0
+    seen = {}
+    for n in range(seconds * fps):
+        t[0] = n / fps
+        frames += 1
+        if sched.allow():
+            inferred += 1
+            v = visit_of.get(int(t[0]))
+            sched.record(v is not None)
+            if v is not None:
+                seen.setdefault(v, t[0] - v)
+    return {"duty": inferred / frames, "visits": len(set(visit_of.values())),
+            "visits_seen": len(seen),
+            "latency_ms": 1000.0 * sum(seen.values()) / max(len(seen), 1)}
+
+
+if __name__ == "__main__":
+    r = simulate(windows=[("22:00", "05:00", 1)])
+    print("duty cycle %4.1f%% of full rate, visits seen %d/%d, latency %.0f ms" %
+          (100 * r["duty"], r["visits_seen"], r["visits"], r["latency_ms"]))
@@ -0,0 +1,87 @@
+"""Concurrent, timed startup.
+
+Startup runs the slow, independent parts of starting up (opening the camera,
+loading the Hailo model, scanning the capture folders) in threads, so
+starting takes as long as the slowest of them instead of the sum, and
+report() prints when each ran and how long it has been since the process
+was started, eg after a watchdog or power-cycle restart.
+
+retry() replaces fixed sleeps: it calls fn until it succeeds, eg a camera or
+Hailo device that is not ready yet after boot, or until timeout.
+"""
+
+import concurrent.futures
+import os
+import time
+
+
+def retry(fn, timeout=30.0, interval=0.25, exceptions=(Exception,)):
+    """fn(), retried every interval seconds until it succeeds or timeout."""
+    end = time.monotonic() + timeout
+    while True:
+        try:
+            return fn()
+        except exceptions as e:
+            if time.monotonic() >= end:
+                raise
+            print("Waiting for", getattr(fn, "__name__", fn), e)
+            time.sleep(interval)
+
+
+def process_age():
+    """Seconds since this process was started, including interpreter and
+    import time, or 0 if /proc isn't available."""
+    try:
+        with open("/proc/self/stat") as f:
+            started = int(f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0]) - started
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class Startup:
+
+    def __init__(self, workers=4):
+        self.t0 = time.monotonic()
+        self.before = process_age()
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="startup")
+        self.tasks = {}
+        self.times = {}
+        self.marks = []
+
+    def _now(self):
+        return time.monotonic() - self.t0
+
+    def submit(self, name, fn, *args, **kw):
+        """Start fn(*args, **kw) in the background as task name."""
+        def timed():
+            start = self._now()
+            try:
+                return fn(*args, **kw)
+            finally:
+                self.times[name] = (start, self._now())
+        self.tasks[name] = self.pool.submit(timed)
+
+    def result(self, name, timeout=None):
+        """Wait for task name, returns its result or raises its exception."""
+        return self.tasks[name].result(timeout)
+
+    def mark(self, name):
+        """Record that the main thread reached a point, eg "recording"."""
+        self.marks.append((name, self._now()))
+
+    def elapsed(self):
+        """Seconds since the process started."""
+        return self.before + self._now()
+
+    def report(self):
+        print("Startup %.2f s, %.2f s before startup timing began" % (self.elapsed(), self.before))
+        for name, (start, end) in sorted(self.times.items(), key=lambda kv: kv[1]):
+            print("  %-10s %5.2f - %5.2f s  (%.2f s)" % (name, start, end, end - start))
+        for name, at in self.marks:
+            print("  %-10s at %5.2f s" % (name, at))
+        self.pool.shutdown(wait=False)
+        return {"total": self.elapsed(), "before": self.before,
+                "tasks": {name: end - start for name, (start, end) in self.times.items()},
+                "marks": dict(self.marks)}
@@ -0,0 +1,249 @@
+"""Storage tiers with byte budgets, retention rules and eviction.
+
+Each tier (RAM staging, SD card, USB stick) is a set of folders whose files
+are tracked incrementally, grouped by capture stem, after one scan at start.
+Free space comes from a cached statvfs (or a fixed capacity, for testing with
+temporary folders), so nothing has to call statvfs every frame.
+
+enforce() deletes captures from a tier until it is inside its budget, its
+minimum free space and its maximum age, oldest first or lowest detection
+score first, so the SD card never fills up and stops recording.  If the
+space is taken by other files, so deleting every capture still wouldn't be
+enough, it deletes none and says so.
+"""
+
+import os
+import threading
+import time
+
+OLDEST = "oldest"
+LOWEST_SCORE = "lowest_score"
+
+MB = 1024 * 1024
+
+
+class Tier:
+
+    def __init__(self, name, folders, budget=0, min_free=0, max_age=0, policy=OLDEST,
+                 evictable=True, capacity=None, refresh=2.0):
+        """budget and min_free in bytes, max_age in seconds, 0 = no limit.
+        capacity fixes the size of the tier instead of using statvfs."""
+        self.name = name
+        self.folders = list(folders)
+        self.budget = budget
+        self.min_free = min_free
+        self.max_age = max_age
+        self.policy = policy
+        self.evictable = evictable
+        self.capacity = capacity
+        self.refresh = refresh
+        self.captures = {}
+        self.used = 0
+        self.checked = 0.0
+        self.fs_free = 0
+        self.fs_total = 0
+        self.unreclaimable = False
+
+    def _statvfs(self):
+        now = time.monotonic()
+        if now - self.checked >= self.refresh:
+            st = os.statvfs(self.folders[0])
+            self.fs_free = st.f_bavail * st.f_frsize
+            self.fs_total = st.f_blocks * st.f_frsize
+            self.checked = now
+        return self.fs_free, self.fs_total
+
+    def free(self):
+        """Bytes that can still be written before a limit is reached."""
+        if self.capacity is not None:
+            free = self.capacity - self.used
+        else:
+            free = self._statvfs()[0]
+        free -= self.min_free
+        if self.budget:
+            free = min(free, self.budget - self.used)
+        return free
+
+    def percent_used(self):
+        if self.capacity is not None:
+            return 100.0 * self.used / max(self.capacity, 1)
+        free, total = self._statvfs()
+        return 100.0 * (1 - free / max(total, 1))
+
+    def invalidate(self):
+        """Force the next free() to call statvfs."""
+        self.checked = 0.0
+
+
+class StorageManager:
+
+    def __init__(self, tiers=(), on_evict=None):
+        self.tiers = {}
+        self.on_evict = on_evict
+        self.lock = threading.RLock()
+        self.evicted = 0
+        for tier in tiers:
+            self.add_tier(tier)
+
+    def add_tier(self, tier, scan=True):
+        with self.lock:
+            self.tiers[tier.name] = tier
+            tier.captures = {}
+            tier.used = 0
+            if scan:
+                for folder in tier.folders:
+                    try:
+                        with os.scandir(folder) as it:
+                            for e in it:
+                                if e.is_file():
+                                    st = e.stat()
+                                    self._add(tier, e.path, st.st_size, st.st_mtime, None)
+                    except FileNotFoundError:
+                        pass
+        return tier
+
+    def tier(self, name):
+        return self.tiers.get(name)
+
+    @staticmethod
+    def stem(path):
+        # every extension, so a clip still being written (.mp4.part) belongs to its capture
+        return os.path.basename(path).split(".")[0]
+
+    def _add(self, tier, path, size, mtime, score):
+        c = tier.captures.setdefault(self.stem(path), {"files": {}, "time": mtime, "score": None})
+        old = c["files"].get(path, 0)
+        c["files"][path] = size
+        c["time"] = min(c["time"], mtime)
+        if score is not None:
+            c["score"] = score if c["score"] is None else max(c["score"], score)
+        tier.used += size - old
+
+    # incremental updates
+    def add(self, name, path, score=None):
+        """Record a file written to a tier, score is its best detection score."""
+        with self.lock:
+            tier = self.tiers[name]
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return
+            self._add(tier, path, st.st_size, st.st_mtime, score)
+            tier.invalidate()
+
+    def remove(self, name, path):
+        """Record a file deleted or moved off a tier."""
+        with self.lock:
+            tier = self.tiers[name]
+            stem = self.stem(path)
+            c = tier.captures.get(stem)
+            if c is None:
+                return
+            tier.used -= c["files"].pop(path, 0)
+            if not c["files"]:
+                del tier.captures[stem]
+            tier.invalidate()
+
+    def forget(self, name, stem):
+        """Record all files of a capture deleted from a tier."""
+        with self.lock:
+            tier = self.tiers[name]
+            c = tier.captures.pop(stem, None)
+            if c is not None:
+                tier.used -= sum(c["files"].values())
+                tier.invalidate()
+
+    def clear(self, name):
+        with self.lock:
+            tier = self.tiers[name]
+            tier.captures = {}
+            tier.used = 0
+            tier.invalidate()
+
+    # queries
+    def free(self, name):
+        with self.lock:
+            return self.tiers[name].free()
+
+    def free_mb(self, name):
+        return self.free(name) / MB
+
+    def used(self, name):
+        return self.tiers[name].used
+
+    def percent_used(self, name):
+        return self.tiers[name].percent_used()
+
+    def can_write(self, name, need):
+        return self.free(name) >= need
+
+    # eviction
+    def _victims(self, tier):
+        if tier.policy == LOWEST_SCORE:
+            key = lambda kv: (kv[1]["score"] if kv[1]["score"] is not None else 0.0, kv[1]["time"])
+        else:
+            key = lambda kv: kv[1]["time"]
+        return sorted(tier.captures.items(), key=key)
+
+    def _evict(self, tier, stem, c):
+        for path in c["files"]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        tier.used -= sum(c["files"].values())
+        del tier.captures[stem]
+        tier.invalidate()
+        self.evicted += 1
+        print("Evicted", tier.name, stem)
+        if self.on_evict is not None:
+            self.on_evict(tier.name, stem, list(c["files"]))
+
+    def enforce(self, name, need=0, keep=()):
+        """Evict captures until the tier has need bytes free and meets its
+        retention rules, never evicting stems in keep.  Returns the stems evicted."""
+        evicted = []
+        with self.lock:
+            tier = self.tiers[name]
+            if not tier.evictable:
+                return evicted
+            if tier.max_age:
+                limit = time.time() - tier.max_age
+                for stem, c in list(tier.captures.items()):
+                    if c["time"] < limit and stem not in keep:
+                        self._evict(tier, stem, c)
+                        evicted.append(stem)
+            free = tier.free()
+            if free < need:
+                victims = [(stem, c) for stem, c in self._victims(tier) if stem not in keep]
+                reclaimable = sum(sum(c["files"].values()) for _, c in victims)
+                if free + reclaimable < need:
+                    if not tier.unreclaimable:
+                        print("Storage", tier.name, "%.0f MB short, and only %.0f MB of captures can be deleted" %
+                              ((need - free) / MB, reclaimable / MB))
+                    tier.unreclaimable = True
+                    return evicted
+                tier.unreclaimable = False
+                for stem, c in victims:
+                    self._evict(tier, stem, c)
+                    evicted.append(stem)
+                    if tier.free() >= need:
+                        break
+        return evicted
+
+
+def percent_used(path):
+    """Percentage of the filesystem holding path that is in use."""
+    st = os.statvfs(path)
+    return 100.0 * (1 - st.f_bavail / max(st.f_blocks, 1))
+
+
+def usb_drive(media):
+    """First mounted drive under /media/<user>, or None."""
+    try:
+        drives = sorted(os.listdir(media))
+    except FileNotFoundError:
+        return None
+    if not drives:
+        return None
+    return os.path.join(media, drives[0])
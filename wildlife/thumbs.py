@@ -0,0 +1,178 @@
+"""Memory capped LRU cache of ready to blit review window images.
+
+Images are keyed by capture stem.  get() loads on a miss, prefetch() loads the
+neighbouring captures in a background thread so PREV/NEXT normally hit the
+cache, and invalidate()/clear() drop entries when captures are deleted or
+moved to USB.
+
+"python3 -m wildlife.thumbs" scrolls through 5000 synthetic captures with and
+without the cache.
+"""
+
+import collections
+import threading
+import time
+
+SIZE = (320, 320)
+
+
+def load_scaled(path, size=SIZE):
+    """Default loader, a pygame surface scaled for the review window."""
+    import pygame
+    return pygame.transform.scale(pygame.image.load(path), size)
+
+
+def from_frame(frame, size=SIZE):
+    """Review window image of a lores RGB888 frame.  The frame is decimated,
+    its colours swapped and its axes transposed as a numpy view, so pygame
+    makes the surface in one small copy, with no rotate or flip."""
+    import pygame
+    h, w = frame.shape[:2]
+    view = frame[::max(h // size[1], 1), ::max(w // size[0], 1), ::-1].swapaxes(0, 1)
+    image = pygame.surfarray.make_surface(view)
+    if image.get_size() != tuple(size):
+        image = pygame.transform.scale(image, size)
+    return image
+
+
+def nbytes(image):
+    """Memory used by a pygame surface or numpy array."""
+    if hasattr(image, "get_bytesize"):
+        w, h = image.get_size()
+        return w * h * image.get_bytesize()
+    return getattr(image, "nbytes", 0)
+
+
+class ThumbCache:
+
+    def __init__(self, loader=load_scaled, max_bytes=32 * 1024 * 1024):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.items = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.wanted = collections.deque()
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self._prefetcher, name="thumbs", daemon=True)
+        self.thread.start()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, key, image):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.bytes -= nbytes(old)
+            self.items[key] = image
+            self.bytes += nbytes(image)
+            while self.bytes > self.max_bytes and len(self.items) > 1:
+                _, dropped = self.items.popitem(last=False)
+                self.bytes -= nbytes(dropped)
+
+    def get(self, key, path):
+        """Cached image for key, loaded from path on a miss."""
+        with self.lock:
+            image = self.items.get(key)
+            if image is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+        image = self.loader(path)
+        self.put(key, image)
+        return image
+
+    def invalidate(self, key):
+        with self.lock:
+            image = self.items.pop(key, None)
+            if image is not None:
+                self.bytes -= nbytes(image)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+            self.wanted.clear()
+
+    def prefetch(self, items):
+        """Load (key, path) items in the background, replacing older requests."""
+        with self.lock:
+            self.wanted.clear()
+            self.wanted.extend(kp for kp in items if kp[0] not in self.items)
+        if self.wanted:
+            self.wake.set()
+
+    def _prefetcher(self):
+        while True:
+            self.wake.wait()
+            with self.lock:
+                if not self.wanted:
+                    self.wake.clear()
+                    continue
+                key, path = self.wanted.popleft()
+                if key in self.items:
+                    continue
+            try:
+                image = self.loader(path)
+            except Exception as e:
+                print("thumbnail", path, e)
+                continue
+            self.put(key, image)
+
+
+def neighbours(index, p, n=2):
+    """(stem, picture) of the n captures either side of p, nearest first."""
+    out = []
+    for d in range(1, n + 1):
+        for q in (p + d, p - d):
+            if 0 <= q < len(index):
+                out.append((index.stem(q), index.picture(q)))
+    return out
+
+
+def benchmark(count=5000, load_ms=8.0, think_ms=60.0, clicks=300):
+    """Average click stall scrolling through count captures."""
+    import numpy as np
+
+    def loader(path):
+        time.sleep(load_ms / 1000.0)
+        return np.zeros(SIZE + (3,), dtype=np.uint8)
+
+    class _Index:
+        def __len__(self):
+            return count
+
+        def stem(self, q):
+            return "%06d" % q
+
+        def picture(self, q):
+            return self.stem(q)
+
+    index = _Index()
+    report = {}
+    for name, cache in (("uncached", None), ("cached", ThumbCache(loader))):
+        stall = 0.0
+        p = count - 1
+        for _ in range(clicks):
+            p = max(p - 1, 0)
+            t = time.perf_counter()
+            if cache is None:
+                loader(index.picture(p))
+            else:
+                cache.get(index.stem(p), index.picture(p))
+                cache.prefetch(neighbours(index, p))
+            stall += time.perf_counter() - t
+            time.sleep(think_ms / 1000.0)
+        report[name] = 1000 * stall / clicks
+    return report
+
+
+if __name__ == "__main__":
+    for name, ms in benchmark().items():
+        print("%-9s %6.2f ms stall per PREV click" % (name, ms))
@@ -0,0 +1,214 @@
+"""Multi-frame trigger confirmation with a small IoU / centroid tracker.
+
+Detections (decode.DETECTION_DTYPE arrays) are matched to short lived tracks
+of the same class, a track is confirmed once it has been seen in confirm of
+the last window frames, and stays alive until it has been missed for
+max_missed frames.  update() returns the tracks confirmed on this frame, so a
+single noisy frame no longer starts a recording, and active() tells the main
+loop to keep recording while a confirmed animal is still in view.
+
+"python3 -m wildlife.tracker" replays synthetic detection sequences and
+reports the false trigger rate and the trigger latency added by the
+confirmation.  Given .npz files saved with save_sequence(), which aren't
+labelled, it reports how many of them would trigger.
+"""
+
+import numpy as np
+
+from . import decode
+
+# number of set bits for the 8 frame history of each track
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def iou_matrix(a, b):
+    """IoU of every (x0, y0, x1, y1) box in a against every box in b."""
+    x0 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y0 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x1 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y1 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def centre_distance(a, b):
+    ca = (a[:, :2] + a[:, 2:]) / 2
+    cb = (b[:, :2] + b[:, 2:]) / 2
+    return np.linalg.norm(ca[:, None, :] - cb[None, :, :], axis=2)
+
+
+class Tracker:
+
+    def __init__(self, confirm=3, window=5, iou=0.3, max_dist=0.1, max_missed=5):
+        if not 1 <= confirm <= window <= 8:
+            raise ValueError("need 1 <= confirm <= window <= 8")
+        self.confirm = confirm
+        self.mask = (1 << window) - 1
+        self.iou = iou
+        self.max_dist = max_dist
+        self.max_missed = max_missed
+        self.next_id = 1
+        self.reset()
+
+    def reset(self):
+        self.ids = np.empty(0, np.int32)
+        self.boxes = np.empty((0, 4), np.float32)
+        self.classes = np.empty(0, np.int16)
+        self.hist = np.empty(0, np.uint8)
+        self.missed = np.empty(0, np.int16)
+        self.confirmed = np.empty(0, bool)
+        self.best = np.empty(0, np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _match(self, dets):
+        """Greedy (track, detection) pairs of the same class."""
+        if len(self.ids) == 0 or len(dets) == 0:
+            return []
+        boxes = dets["bbox"]
+        score = iou_matrix(self.boxes, boxes)
+        near = centre_distance(self.boxes, boxes) < self.max_dist
+        # centroid matches rank below any IoU match
+        score = np.where(score >= self.iou, 1.0 + score, np.where(near, 0.5, 0.0))
+        score[self.classes[:, None] != dets["class_id"][None, :]] = 0.0
+        pairs = []
+        ti, di = np.nonzero(score)
+        order = np.argsort(-score[ti, di], kind="stable")
+        used_t = set()
+        used_d = set()
+        for k in order:
+            t, d = int(ti[k]), int(di[k])
+            if t not in used_t and d not in used_d:
+                used_t.add(t)
+                used_d.add(d)
+                pairs.append((t, d))
+        return pairs
+
+    def update(self, dets):
+        """Add one frame of detections, returns ids of newly confirmed tracks."""
+        pairs = self._match(dets)
+        hit = np.zeros(len(self.ids), bool)
+        matched = np.zeros(len(dets), bool)
+        if pairs:
+            t, d = np.array(pairs).T
+            hit[t] = True
+            matched[d] = True
+            self.boxes[t] = dets["bbox"][d]
+            self.best[t] = np.maximum(self.best[t], dets["score"][d])
+        self.hist = (((self.hist.astype(np.uint16) << 1) | hit) & self.mask).astype(np.uint8)
+        self.missed = np.where(hit, 0, self.missed + 1).astype(np.int16)
+
+        # new tracks for unmatched detections
+        new = dets[~matched]
+        if len(new):
+            n = len(new)
+            self.ids = np.concatenate([self.ids, np.arange(self.next_id, self.next_id + n, dtype=np.int32)])
+            self.next_id += n
+            self.boxes = np.concatenate([self.boxes, new["bbox"]])
+            self.classes = np.concatenate([self.classes, new["class_id"]])
+            self.hist = np.concatenate([self.hist, np.ones(n, np.uint8)])
+            self.missed = np.concatenate([self.missed, np.zeros(n, np.int16)])
+            self.confirmed = np.concatenate([self.confirmed, np.zeros(n, bool)])
+            self.best = np.concatenate([self.best, new["score"]])
+
+        fresh = ~self.confirmed & (_POPCOUNT[self.hist] >= self.confirm)
+        self.confirmed |= fresh
+        newly = self.ids[fresh].tolist()
+
+        # drop tracks missed for too long
+        keep = self.missed <= self.max_missed
+        if not keep.all():
+            for name in ("ids", "boxes", "classes", "hist", "missed", "confirmed", "best"):
+                setattr(self, name, getattr(self, name)[keep])
+        return newly
+
+    def active(self):
+        """True while a confirmed track is still alive."""
+        return bool(self.confirmed.any())
+
+    def track(self, track_id):
+        """(class_id, best score) of a track."""
+        i = int(np.nonzero(self.ids == track_id)[0][0])
+        return int(self.classes[i]), float(self.best[i])
+
+
+def save_sequence(path, frames):
+    """Save a list of per-frame detection arrays to an .npz file."""
+    np.savez_compressed(path, *frames)
+
+
+def load_sequence(path):
+    with np.load(path) as f:
+        return [f["arr_%d" % i] for i in range(len(f.files))]
+
+
+def synthetic_sequences(count=200, length=60, seed=1):
+    """(frames, first_true_frame) pairs, first_true_frame None for noise only."""
+    rng = np.random.default_rng(seed)
+    seqs = []
+    for n in range(count):
+        animal = n % 2 == 0
+        start = int(rng.integers(5, length // 2)) if animal else None
+        pos = rng.uniform(0.2, 0.6, 2)
+        frames = []
+        for f in range(length):
+            dets = []
+            # single frame false positives, eg leaves or insects
+            if rng.random() < 0.04:
+                tl = rng.uniform(0, 0.8, 2)
+                dets.append((14, rng.uniform(0.5, 0.7), *tl, *(tl + 0.1)))
+            if animal and f >= start and rng.random() < 0.85:
+                pos = np.clip(pos + rng.normal(0, 0.01, 2), 0, 0.7)
+                dets.append((14, rng.uniform(0.55, 0.9), *pos, *(pos + 0.25)))
+            arr = np.empty(len(dets), decode.DETECTION_DTYPE)
+            for i, d in enumerate(dets):
+                arr[i] = (d[0], d[1], d[2:])
+            frames.append(arr)
+        seqs.append((frames, start))
+    return seqs
+
+
+def first_trigger(frames, confirm=3, window=5):
+    """Frame a sequence would trigger on, or None."""
+    tracker = Tracker(confirm, window)
+    for f, dets in enumerate(frames):
+        if tracker.update(dets):
+            return f
+    return None
+
+
+def replay(sequences, confirm=3, window=5, fps=25):
+    """False trigger rate and mean added trigger latency (ms) of a policy,
+    sequences are (frames, first_true_frame) as from synthetic_sequences()."""
+    false_triggers = noise = 0
+    delays = []
+    for frames, start in sequences:
+        fired = first_trigger(frames, confirm, window)
+        if start is None:
+            noise += 1
+            false_triggers += fired is not None
+        elif fired is not None:
+            first = next(f for f in range(start, len(frames)) if len(frames[f]))
+            delays.append(max(fired - first, 0))
+    return {"false_trigger_rate": false_triggers / max(noise, 1),
+            "added_latency_ms": 1000.0 * float(np.mean(delays)) / fps if delays else 0.0,
+            "missed": sum(1 for _, s in sequences if s is not None) - len(delays)}
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        # recorded sequences don't say whether an animal was there, so only count the triggers
+        logs = [load_sequence(p) for p in sys.argv[1:]]
+        for confirm, window in ((1, 1), (2, 3), (3, 5)):
+            fired = sum(1 for frames in logs if first_trigger(frames, confirm, window) is not None)
+            print("%d of %d: %d of %d sequences trigger" % (confirm, window, fired, len(logs)))
+        sys.exit()
+    seqs = synthetic_sequences()
+    for confirm, window in ((1, 1), (2, 3), (3, 5)):
+        r = replay(seqs, confirm, window)
+        print("%d of %d: false triggers %4.1f%%, added latency %5.1f ms, missed %d" %
+              (confirm, window, 100 * r["false_trigger_rate"], r["added_latency_ms"], r["missed"]))
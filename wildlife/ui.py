@@ -0,0 +1,68 @@
+"""Review window drawing with cached fonts/labels and dirty rectangle updates.
+
+Font objects are created once per size and rendered labels are cached by
+(text, colour, size).  Drawing only marks the changed rectangles, flush() then
+pushes them to the display in one pygame.display.update() call per frame.
+"""
+
+import collections
+import os
+
+import pygame
+
+FREESERIF = '/usr/share/fonts/truetype/freefont/FreeSerif.ttf'
+
+
+class Panel:
+
+    def __init__(self, surface, font_file=FREESERIF, max_labels=256):
+        self.surface = surface
+        self.font_file = font_file if os.path.exists(font_file) else None
+        self.fonts = {}
+        self.labels = collections.OrderedDict()
+        self.max_labels = max_labels
+        self.dirty = []
+
+    def font(self, size):
+        f = self.fonts.get(size)
+        if f is None:
+            f = self.fonts[size] = pygame.font.Font(self.font_file, size)
+        return f
+
+    def label(self, msg, colour, size):
+        key = (msg, colour, size)
+        image = self.labels.get(key)
+        if image is None:
+            image = self.font(size).render(msg, False, colour)
+            self.labels[key] = image
+            if len(self.labels) > self.max_labels:
+                self.labels.popitem(last=False)
+        else:
+            self.labels.move_to_end(key)
+        return image
+
+    def mark(self, rect):
+        self.dirty.append(pygame.Rect(rect))
+
+    def rect(self, colour, rect, width=0):
+        self.mark(pygame.draw.rect(self.surface, colour, rect, width))
+
+    def blit(self, image, pos):
+        self.mark(self.surface.blit(image, pos))
+
+    def text(self, msg, colour, x, y, size, bw):
+        """Clear a bw wide box at x,y and draw msg in it."""
+        self.rect((0, 0, 0), pygame.Rect(x, y, bw, 20))
+        if msg:
+            self.blit(self.label(msg, colour, size), (x, y))
+
+    def flush(self, full=False):
+        """Update the dirty parts of the display, returns True if anything changed."""
+        if full:
+            pygame.display.update()
+        elif not self.dirty:
+            return False
+        else:
+            pygame.display.update(self.dirty)
+        self.dirty = []
+        return True